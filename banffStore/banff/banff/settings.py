@@ -87,6 +87,52 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'banff-store',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# Share the cache between server processes when Redis is available. Cache
+# invalidation only reaches other processes through a shared cache, so
+# deployments with several workers need it (`check --deploy` says so)
+REDIS_URL = os.environ.get('REDIS_URL')
+if REDIS_URL:
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    }
+
+# Seconds a cached catalog API response may be served
+STORE_RESPONSE_CACHE_TIMEOUT = int(os.environ.get('STORE_RESPONSE_CACHE_TIMEOUT', 300))
+
+# Processes resizing uploaded catalog images; 0 resizes inline on save
+STORE_RENDITION_WORKERS = int(os.environ.get('STORE_RENDITION_WORKERS', 2))
+
+# Seconds adding to a cart holds the units before the sweeper reclaims them
+STORE_CART_HOLD_SECONDS = int(os.environ.get('STORE_CART_HOLD_SECONDS', 900))
+
+# Where anonymous carts live until login or checkout: 'db', 'cookie' or 'cache'
+STORE_ANONYMOUS_CART_STORAGE = os.environ.get('STORE_ANONYMOUS_CART_STORAGE', 'db')
+
+# Lines an anonymous cookie or cache cart may have before it moves to the database
+STORE_ANONYMOUS_CART_MAX_LINES = int(os.environ.get('STORE_ANONYMOUS_CART_MAX_LINES', 10))
+
+# Days an anonymous cart may sit unchanged before purge_abandoned_carts deletes it
+STORE_ABANDONED_CART_DAYS = int(os.environ.get('STORE_ABANDONED_CART_DAYS', 7))
+
+# Sub-requests one /api/store/batch/ call may carry, and threads for its reads
+STORE_BATCH_MAX_REQUESTS = int(os.environ.get('STORE_BATCH_MAX_REQUESTS', 20))
+STORE_BATCH_WORKERS = int(os.environ.get('STORE_BATCH_WORKERS', 4))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -166,6 +212,17 @@ SESSION_COOKIE_SECURE = not DEBUG
 SESSION_COOKIE_HTTPONLY = True
 SESSION_COOKIE_AGE = 86400  # 24 hours
 SESSION_SAVE_EVERY_REQUEST = True
+# Cache-backed sessions that are only written when changed or due for
+# a refresh (see store.sessions). They need a cache every server process
+# shares, so they are only the default with REDIS_URL; on the per-process
+# LocMemCache each worker would serve its own stale copy of a session.
+SESSION_ENGINE = os.environ.get(
+    'SESSION_ENGINE', 'store.sessions' if REDIS_URL else 'django.contrib.sessions.backends.db'
+)
+# Also keep sessions in the database, so they survive a cache restart
+STORE_SESSION_WRITE_THROUGH = os.environ.get('STORE_SESSION_WRITE_THROUGH', 'True').lower() in ['true', '1', 'yes']
+# Seconds an unchanged session goes without being rewritten
+STORE_SESSION_REFRESH_SECONDS = int(os.environ.get('STORE_SESSION_REFRESH_SECONDS', 3600))
 
 # CSRF Settings
 CSRF_COOKIE_SECURE = not DEBUG
@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils.safestring import mark_safe
+from . import carts
 from .models import (
     Category, Brand, Product, ProductImage, ProductAttribute, ProductAttributeValue,
     ProductVariant, ProductReview, Wishlist, Cart, CartItem, Order, OrderItem,
@@ -135,12 +136,17 @@ class CartAdmin(admin.ModelAdmin):
     def total_amount_display(self, obj):
         return f"R$ {obj.total_amount:.2f}"
     total_amount_display.short_description = 'Total Amount'
+    
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Lines edited here bypass store.carts, so total them up again
+        carts.recompute(Cart.objects.filter(pk=form.instance.pk))
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
     extra = 0
-    fields = ['product', 'variant', 'quantity', 'unit_price', 'total_price']
-    readonly_fields = ['total_price']
+    fields = ['product', 'variant', 'product_name', 'variant_label', 'quantity', 'unit_price', 'total_price']
+    readonly_fields = ['product_name', 'variant_label', 'total_price']
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
@@ -0,0 +1,220 @@
+"""
+Anonymous carts that cost no database writes.
+
+A visitor's cart only becomes a Cart row once there is a reason to keep
+one. Where STORE_ANONYMOUS_CART_STORAGE is 'cookie' or 'cache', a small
+anonymous cart lives outside the database entirely:
+
+    cookie  the lines themselves, in a signed cookie
+    cache   a random token in a signed cookie, the lines in the cache
+
+The lines are stored as [[line id, product id, variant id, quantity], ...].
+Line ids are small numbers local to the cart, so cart item URLs work the
+same way as for stored carts. Once the cart has more than
+STORE_ANONYMOUS_CART_MAX_LINES lines, or its owner logs in or checks out,
+materialize() copies it into Cart/CartItem rows and the client copy is
+dropped. Lines kept this way hold no stock (see store.inventory) until
+they are materialized.
+
+With the default 'db' storage anonymous carts are Cart rows keyed by the
+session. Either way nothing is written until the first item is added.
+"""
+import secrets
+from decimal import Decimal
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import transaction
+
+from . import carts, inventory
+from .models import Cart, CartItem, Product, ProductVariant
+
+COOKIE_NAME = 'store_cart'
+CACHE_KEY = 'store:cart:{}'
+SALT = 'store.anonymous_carts'
+
+
+def get_storage():
+    return getattr(settings, 'STORE_ANONYMOUS_CART_STORAGE', 'db')
+
+
+def get_max_lines():
+    return getattr(settings, 'STORE_ANONYMOUS_CART_MAX_LINES', 10)
+
+
+def get_max_age():
+    return settings.SESSION_COOKIE_AGE
+
+
+def _check(quantity):
+    if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+        raise ValueError(f'Cart quantities must be whole numbers of at least 1, got {quantity!r}')
+
+
+def _valid(line):
+    """Whether a stored line is well formed, so a bad one can't reach materialize()"""
+    return (
+        isinstance(line, (list, tuple)) and len(line) == 4
+        and all(isinstance(value, int) and not isinstance(value, bool) for value in (line[0], line[1], line[3]))
+        and (line[2] is None or isinstance(line[2], int))
+        and line[3] >= 1
+    )
+
+
+class AnonymousCart:
+    """The lines of a cart kept in a cookie or the cache"""
+    def __init__(self, lines=(), next_id=1, token=None):
+        # Lines that don't validate are dropped, not trusted
+        self.lines = [list(line) for line in lines if _valid(line)]
+        self.next_id = next_id
+        self.token = token
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def find(self, line_id):
+        for line in self.lines:
+            if line[0] == line_id:
+                return line
+        return None
+
+    def add(self, product_id, variant_id, quantity):
+        """Add units to the line for a product and variant; returns the line"""
+        _check(quantity)
+        for line in self.lines:
+            if line[1] == product_id and line[2] == variant_id:
+                line[3] += quantity
+                return line
+        line = [self.next_id, product_id, variant_id, quantity]
+        self.next_id += 1
+        self.lines.append(line)
+        return line
+
+    def update(self, line_id, quantity):
+        """Set a line's quantity; returns the line, or None if there is no such line"""
+        _check(quantity)
+        line = self.find(line_id)
+        if line is not None:
+            line[3] = quantity
+        return line
+
+    def remove(self, line_id):
+        self.lines = [line for line in self.lines if line[0] != line_id]
+
+    def build(self, products, variants):
+        """
+        An unsaved stand-in for a Cart that CartSerializer can render, given
+        the lines' products and variants by id. Lines whose product is gone
+        are left out.
+        """
+        items = []
+        for line_id, product_id, variant_id, quantity in self.lines:
+            product = products.get(product_id)
+            if product is None or (variant_id and variant_id not in variants):
+                continue
+            item = CartItem(id=line_id, product=product, variant=variants.get(variant_id), quantity=quantity)
+            item.unit_price = item.current_unit_price
+            item.total_price = item.unit_price * quantity
+            items.append(item)
+        return SimpleNamespace(
+            id=None, items=items, created_at=None, updated_at=None,
+            total_amount=sum((item.total_price for item in items), Decimal('0.00')),
+            total_items=sum(item.quantity for item in items),
+        )
+
+
+def load(request):
+    """The request's anonymous cart, or None when it has none"""
+    if get_storage() == 'db' or COOKIE_NAME not in request.COOKIES:
+        return None
+    try:
+        value = signing.loads(request.COOKIES[COOKIE_NAME], salt=SALT, max_age=get_max_age())
+    except signing.BadSignature:
+        return None
+    if get_storage() == 'cache':
+        data = cache.get(CACHE_KEY.format(value))
+        if data is None:
+            return None
+        return AnonymousCart(data['lines'], data['next'], token=value)
+    return AnonymousCart(value['lines'], value['next'])
+
+
+def save(cart, response):
+    """Write the cart back with the response, or drop it once empty"""
+    if not cart:
+        discard(cart, response)
+        return
+    data = {'lines': cart.lines, 'next': cart.next_id}
+    if get_storage() == 'cache':
+        cart.token = cart.token or secrets.token_urlsafe(16)
+        cache.set(CACHE_KEY.format(cart.token), data, get_max_age())
+        value = cart.token
+    else:
+        value = data
+    response.set_cookie(
+        COOKIE_NAME, signing.dumps(value, salt=SALT, compress=True),
+        max_age=get_max_age(), httponly=True, samesite='Lax',
+        secure=settings.SESSION_COOKIE_SECURE,
+    )
+
+
+def discard(cart, response):
+    if cart is not None and cart.token:
+        cache.delete(CACHE_KEY.format(cart.token))
+    response.delete_cookie(COOKIE_NAME, samesite='Lax')
+
+
+def in_stock(product, variant, quantity):
+    """Whether quantity units are available now; light carts hold none"""
+    if not product.track_inventory or product.allow_backorders:
+        return True
+    return (variant or product).available_stock >= quantity
+
+
+def materialize(anonymous, cart):
+    """
+    Copy an anonymous cart's lines into a stored cart and hold their stock,
+    in bulk: a fixed number of queries plus one reserve per held SKU
+    """
+    products = Product.objects.filter(status='active').in_bulk({line[1] for line in anonymous.lines})
+    variants = ProductVariant.objects.in_bulk({line[2] for line in anonymous.lines if line[2]})
+    lines = []
+    for _, product_id, variant_id, quantity in anonymous.lines:
+        product = products.get(product_id)
+        variant = variants.get(variant_id) if variant_id else None
+        if product is None or (variant_id and (variant is None or variant.product_id != product_id)):
+            continue
+        lines.append((product, variant, quantity))
+    with transaction.atomic():
+        items = carts.add_items(cart, lines)
+        # Best effort: units that can't be held stay in the cart and are
+        # checked again at checkout
+        inventory.hold_lines(cart, items)
+    return cart
+
+
+def adopt(request, user):
+    """
+    Move the request's anonymous cart, stored or not, into the user's cart.
+    Returns the cookie or cache cart, if any, so the caller can discard()
+    it with its response.
+    """
+    session_key = request.session.session_key
+    anonymous = load(request)
+    with transaction.atomic():
+        cart = Cart.objects.filter(user=user).first()
+        session_cart = Cart.objects.filter(session_key=session_key, user__isnull=True).first() if session_key else None
+        if session_cart is not None:
+            if cart is None:
+                # Nothing to merge with; the session cart becomes the user's
+                Cart.objects.filter(pk=session_cart.pk).update(user=user, session_key=None)
+                cart = session_cart
+            else:
+                carts.merge(session_cart, cart)
+        if anonymous:
+            if cart is None:
+                cart, _ = Cart.objects.get_or_create(user=user)
+            materialize(anonymous, cart)
+    return anonymous
@@ -0,0 +1,203 @@
+"""
+Running several store API calls in one HTTP request.
+
+POST /api/store/batch/ takes
+
+    {"requests": [
+        {"id": "product", "method": "GET", "path": "products/blue-tee/",
+         "headers": {"If-None-Match": "\"5d41...\""}},
+        {"id": "cart", "method": "POST", "path": "cart/?response=delta", "body": {"product_id": 7}}
+    ]}
+
+and answers with one entry per sub-request, in the same order:
+
+    {"responses": [{"id": "product", "status": 200, "headers": {...}, "body": {...}}, ...]}
+
+Paths are relative to /api/store/. Each sub-request is dispatched straight
+to its view with the outer request's user, token and session. Middleware,
+authentication and the session load run once for the whole batch. Cookies
+set by sub-requests are set on the batch response, and later sub-requests
+see them, as a browser would send them back: a POST to cart/ followed by a
+GET of cart/ reads the cart it just wrote. Sub-requests inherit
+the outer request's other headers, except conditional and body headers
+(If-None-Match, Content-Length...), which describe the batch itself; a
+sub-request gives its own in "headers".
+
+Sub-requests run in order. A run of consecutive GETs has no writes between
+them, so it is spread over STORE_BATCH_WORKERS threads; those GETs all see
+the cookies as they were when the run started. That happens only
+when the batch isn't inside a transaction, since worker threads use their
+own connections and couldn't see its uncommitted rows.
+"""
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connection, connections
+from django.http import Http404, StreamingHttpResponse
+from django.urls import Resolver404, resolve, reverse
+
+# Routes a batch may not call: itself, and streamed exports
+EXCLUDED_ROUTES = {'batch', 'export_products', 'export_orders'}
+
+# Headers copied from sub-responses into their entries
+HEADERS = ('ETag', 'Last-Modified', 'X-Cache', 'Cache-Control', 'Vary', 'Location')
+
+# Outer request headers that describe the batch, not its sub-requests
+OUTER_ONLY = {
+    'CONTENT_LENGTH', 'CONTENT_TYPE', 'HTTP_CONTENT_ENCODING', 'HTTP_TRANSFER_ENCODING',
+    'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE',
+    'HTTP_IF_RANGE', 'HTTP_RANGE',
+}
+
+
+class BatchError(Exception):
+    """The batch itself is malformed; nothing was run"""
+
+
+def get_max_requests():
+    return getattr(settings, 'STORE_BATCH_MAX_REQUESTS', 20)
+
+
+def get_workers():
+    return getattr(settings, 'STORE_BATCH_WORKERS', 4)
+
+
+def parse(data):
+    """The sub-requests of a batch body, validated"""
+    requests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(requests, list) or not requests:
+        raise BatchError('requests must be a non-empty list')
+    if len(requests) > get_max_requests():
+        raise BatchError(f'A batch may hold at most {get_max_requests()} requests')
+    parsed = []
+    for index, entry in enumerate(requests):
+        if not isinstance(entry, dict) or not isinstance(entry.get('path'), str):
+            raise BatchError(f'Request {index} needs a path')
+        method = str(entry.get('method', 'GET')).upper()
+        if method not in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+            raise BatchError(f'Request {index} has an unsupported method')
+        headers = entry.get('headers') or {}
+        if not isinstance(headers, dict) or not all(
+            isinstance(name, str) and isinstance(value, str) for name, value in headers.items()
+        ):
+            raise BatchError(f'Request {index} headers must map names to strings')
+        parsed.append({
+            'id': entry.get('id', index), 'method': method,
+            'path': entry['path'], 'body': entry.get('body'), 'headers': headers,
+        })
+    return parsed
+
+
+def build_request(outer, method, path, body, headers=None, cookies=None):
+    """A WSGI request for a sub-request, sharing the outer request's auth and session"""
+    base = reverse('store_api:batch').removesuffix('batch/')
+    url = urlsplit(path)
+    path = url.path if url.path.startswith(base) else base + url.path.lstrip('/')
+    content = json.dumps(body).encode() if body is not None else b''
+
+    environ = {name: value for name, value in outer._request.META.items() if name not in OUTER_ONLY}
+    for name, value in (headers or {}).items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            environ[key] = value
+    environ.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'SCRIPT_NAME': '',
+        'QUERY_STRING': url.query,
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(content)),
+        'wsgi.input': io.BytesIO(content),
+    })
+    request = WSGIRequest(environ)
+    if cookies is not None:
+        request.COOKIES = dict(cookies)
+    request.session = outer._request.session
+    request.user = outer.user
+    # DRF authenticates these as the outer user without running the
+    # authentication classes again
+    request._force_auth_user = outer.user
+    request._force_auth_token = outer.auth
+    return request
+
+
+def dispatch(outer, entry, cookies=None):
+    """Run one sub-request; returns (its entry in the batch response, its response)"""
+    try:
+        request = build_request(
+            outer, entry['method'], entry['path'], entry['body'], entry.get('headers'), cookies
+        )
+        match = resolve(request.path_info)
+        if match.namespace != 'store_api' or match.url_name in EXCLUDED_ROUTES:
+            raise Resolver404
+    except (Resolver404, Http404):
+        return {'id': entry['id'], 'status': 404, 'headers': {}, 'body': {'error': 'Not found'}}, None
+
+    request.resolver_match = match
+    response = match.func(request, *match.args, **match.kwargs)
+    if isinstance(response, StreamingHttpResponse):
+        body = None
+    elif hasattr(response, 'data'):
+        body = response.data
+    else:
+        content = response.content
+        body = json.loads(content) if content and response.get('Content-Type', '').startswith('application/json') else None
+    headers = {name: response[name] for name in HEADERS if response.has_header(name)}
+    return {'id': entry['id'], 'status': response.status_code, 'headers': headers, 'body': body}, response
+
+
+def _dispatch_in_thread(outer, entry, cookies):
+    try:
+        return dispatch(outer, entry, cookies)
+    finally:
+        connections.close_all()
+
+
+def carry_cookies(cookies, response):
+    """Apply a sub-response's Set-Cookie headers to the cookies later sub-requests send"""
+    for name, morsel in response.cookies.items():
+        # delete_cookie() sets max-age=0
+        if str(morsel['max-age']) == '0':
+            cookies.pop(name, None)
+        else:
+            cookies[name] = morsel.value
+
+
+def groups(entries, concurrent):
+    """Consecutive GETs together when they may run concurrently, everything else alone"""
+    reads = []
+    for entry in entries:
+        if concurrent and entry['method'] == 'GET':
+            reads.append(entry)
+            continue
+        if reads:
+            yield reads
+            reads = []
+        yield [entry]
+    if reads:
+        yield reads
+
+
+def run(outer, entries):
+    """Run sub-requests in order; returns (their batch entries, their responses)"""
+    # Load the session once, before threads share it
+    outer._request.session.keys()
+    concurrent = get_workers() > 1 and not connection.in_atomic_block
+    cookies = dict(outer._request.COOKIES)
+    results = []
+    with ThreadPoolExecutor(max_workers=get_workers()) if concurrent else nullcontext() as executor:
+        for group in groups(entries, concurrent):
+            if len(group) > 1:
+                done = list(executor.map(lambda entry: _dispatch_in_thread(outer, entry, cookies), group))
+            else:
+                done = [dispatch(outer, group[0], cookies)]
+            for _, response in done:
+                if response is not None:
+                    carry_cookies(cookies, response)
+            results.extend(done)
+    return [entry for entry, _ in results], [response for _, response in results if response is not None]
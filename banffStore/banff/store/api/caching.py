@@ -0,0 +1,87 @@
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+from .. import response_cache
+
+
+class CachedResponseMixin:
+    """
+    Serve GET responses from the response cache, with conditional GET.
+
+    Views declare the tags their output depends on in cache_tags, or
+    override get_cache_tags() when they depend on the object served. The
+    tag versions are read before anything else, so ETag/Last-Modified
+    checks can answer 304 without touching the database or serializer.
+    
+    The cached data is shared by every user. Per-user fields are added on
+    the way out by personalize(), and get_personal_tags() names the tags
+    they depend on; those only feed the validators, never the shared entry.
+    """
+    cache_tags = ()
+    
+    def get_cache_tags(self):
+        """Tags for this request, or None to bypass caching"""
+        return self.cache_tags
+    
+    def get_personal_tags(self):
+        """
+        Tags of the per-user data personalize() adds for this request, or
+        None when responses are the same for everyone
+        """
+        return None
+    
+    def personalize(self, data):
+        """The response data for this user, built from the shared copy"""
+        return data
+    
+    def get(self, request, *args, **kwargs):
+        tags = self.get_cache_tags()
+        if tags is None:
+            response = super().get(request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                response.data = self.personalize(response.data)
+            return response
+        
+        name = type(self).__name__
+        key = response_cache.make_key(request, name)
+        versions = response_cache.tag_versions(tags)
+        personal_tags = self.get_personal_tags()
+        validators = {**versions, **response_cache.tag_versions(personal_tags)} if personal_tags else versions
+        etag = response_cache.etag(key, validators)
+        last_modified = response_cache.last_modified(validators)
+        
+        if self.not_modified(request, etag, last_modified):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            data = response_cache.get(key, versions, stats_name=name)
+            if data is not None:
+                response = Response(self.personalize(data))
+                response['X-Cache'] = 'HIT'
+            else:
+                response = super().get(request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                response_cache.set(key, response.data, versions)
+                response.data = self.personalize(response.data)
+                response['X-Cache'] = 'MISS'
+        
+        if personal_tags is not None:
+            # Shared caches must not hand one user's copy to anyone else
+            patch_vary_headers(response, ['Authorization', 'Cookie'])
+            if personal_tags:
+                patch_cache_control(response, private=True)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+        return response
+    
+    def not_modified(self, request, etag, last_modified):
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            # If-None-Match uses weak comparison
+            candidates = [value.strip().removeprefix('W/') for value in if_none_match.split(',')]
+            return etag in candidates or '*' in candidates
+        
+        if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+        return if_modified_since is not None and last_modified.timestamp() <= if_modified_since
@@ -0,0 +1,230 @@
+"""
+Read-only fast path for product listings.
+
+A plan is compiled once per field selection: it lists the columns to pull
+with .values() and one small function per output field. Rows then go
+straight from the database tuple to a plain dict, producing the same
+output as ProductListSerializer / ProductSearchResultSerializer without
+building model instances or binding DRF fields per row.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.utils import timezone
+from django.utils.html import escape
+
+from .. import category_tree, renditions, search
+from ..models import Brand, Product
+from ..renditions import PRODUCT_IMAGE_URLS
+from .fieldsets import FieldSpec
+from .serializers import BrandSerializer, CategorySerializer
+
+CENTS = Decimal('0.01')
+
+_product_image_storage = Product._meta.get_field('image').storage
+_brand_logo_storage = Brand._meta.get_field('logo').storage
+_plans = {}
+
+
+def _decimal(value):
+    # Same rendering as serializers.DecimalField(decimal_places=2)
+    if value is None:
+        return None
+    return '{:f}'.format(value.quantize(CENTS, rounding=ROUND_HALF_UP))
+
+
+def _created_at_writer(request):
+    # Same rendering as serializers.DateTimeField; the active timezone is
+    # looked up once per page rather than per row
+    tz = timezone.get_current_timezone()
+
+    def render(row):
+        value = row['created_at']
+        if timezone.is_aware(value):
+            value = value.astimezone(tz)
+        value = value.isoformat()
+        if value.endswith('+00:00'):
+            value = value[:-6] + 'Z'
+        return value
+    return render
+
+
+def _is_on_sale(row):
+    # Mirrors Product.is_on_sale
+    compare = row['compare_at_price']
+    return compare and compare > row['price']
+
+
+def _discount_percentage(row):
+    if _is_on_sale(row):
+        compare = row['compare_at_price']
+        return int(((compare - row['price']) / compare) * 100)
+    return 0
+
+
+def _image(row):
+    if row['name'] in PRODUCT_IMAGE_URLS:
+        return PRODUCT_IMAGE_URLS[row['name']]
+    if row['image']:
+        card = renditions.fallback_url(row['image_renditions'], row['image'], 'card')
+        return card or _product_image_storage.url(row['image'])
+    return None
+
+
+def _image_srcset_writer(request):
+    def render(row):
+        return renditions.srcset(row['image_renditions'], row['image'], request)
+    return render
+
+
+def _category_writer(request):
+    tree = category_tree.get_tree()
+    by_id = tree.by_id
+
+    def render(row):
+        category_id = row['category_id']
+        if category_id not in by_id:
+            return None
+        return tree.memoize(
+            ('category', category_id), lambda: CategorySerializer(by_id[category_id]).data
+        )
+    return render
+
+
+BRAND_COLUMNS = {
+    'id': 'brand_id', 'name': 'brand__name', 'slug': 'brand__slug',
+    'description': 'brand__description', 'logo': 'brand__logo',
+    'logo_srcset': 'brand__logo_renditions', 'website': 'brand__website',
+}
+BRAND_FIELDS = [(name, BRAND_COLUMNS[name]) for name in BrandSerializer.Meta.fields]
+
+
+def _brand_writer(request):
+    logos = {}
+
+    def logo(name, logo_renditions):
+        # (logo, logo_srcset) rendered once per logo and page
+        if name not in logos:
+            url = _brand_logo_storage.url(name)
+            logos[name] = (
+                request.build_absolute_uri(url) if request is not None else url,
+                renditions.srcset(logo_renditions, name, request),
+            )
+        return logos[name]
+
+    def render(row):
+        if row['brand_id'] is None:
+            return None
+        brand = {name: row[column] for name, column in BRAND_FIELDS}
+        if brand['logo']:
+            brand['logo'], brand['logo_srcset'] = logo(brand['logo'], brand['logo_srcset'])
+        else:
+            brand['logo'] = brand['logo_srcset'] = None
+        return brand
+    return render
+
+
+def _snippet(row):
+    snippet = row.get('search_snippet')
+    if not snippet:
+        return None
+    return escape(snippet).replace(search.HIGHLIGHT_START, '<mark>').replace(search.HIGHLIGHT_END, '</mark>')
+
+
+# field -> (columns it reads, row -> value)
+FIELDS = {
+    'id': (['id'], lambda row: row['id']),
+    'name': (['name'], lambda row: row['name']),
+    'slug': (['slug'], lambda row: row['slug']),
+    'short_description': (['short_description'], lambda row: row['short_description']),
+    'price': (['price'], lambda row: _decimal(row['price'])),
+    'price_display': (['price'], lambda row: f"R$ {row['price']:.2f}"),
+    'compare_at_price': (['compare_at_price'], lambda row: _decimal(row['compare_at_price'])),
+    'compare_at_price_display': (
+        ['compare_at_price'],
+        lambda row: f"R$ {row['compare_at_price']:.2f}" if row['compare_at_price'] else None,
+    ),
+    'discount_percentage': (['price', 'compare_at_price'], _discount_percentage),
+    'is_on_sale': (['price', 'compare_at_price'], _is_on_sale),
+    'image': (['name', 'image', 'image_renditions'], _image),
+    'stock': (['stock'], lambda row: row['stock']),
+    'available_stock': (['stock', 'reserved'], lambda row: max(row['stock'] - row['reserved'], 0)),
+    'is_featured': (['is_featured'], lambda row: row['is_featured']),
+    'average_rating': (['average_rating'], lambda row: row['average_rating']),
+    'review_count': (['review_count'], lambda row: row['review_count']),
+    'snippet': (['search_snippet'], _snippet),
+}
+
+# Fields whose writer is built once per page (timezone, tree, absolute URLs)
+PAGE_FIELDS = {
+    'image_srcset': (['image', 'image_renditions'], _image_srcset_writer),
+    'created_at': (['created_at'], _created_at_writer),
+}
+
+# Relations collapse to their id when not expanded
+RELATIONS = {
+    'category': (['category_id'], _category_writer, 'category_id'),
+    'brand': (list(BRAND_COLUMNS.values()), _brand_writer, 'brand_id'),
+}
+
+
+class ProductRowPlan:
+    def __init__(self, field_names, spec):
+        columns = []
+        writers = []
+        for name in field_names:
+            if not spec.includes(name):
+                continue
+            if name in RELATIONS:
+                relation_columns, writer, id_column = RELATIONS[name]
+                if spec.expands(name):
+                    columns += relation_columns
+                    writers.append((name, writer, True))
+                else:
+                    columns.append(id_column)
+                    writers.append((name, lambda row, column=id_column: row[column], False))
+            elif name in PAGE_FIELDS:
+                field_columns, writer = PAGE_FIELDS[name]
+                columns += field_columns
+                writers.append((name, writer, True))
+            else:
+                field_columns, render = FIELDS[name]
+                columns += field_columns
+                writers.append((name, render, False))
+        self.columns = list(dict.fromkeys(['id'] + columns))
+        self.writers = writers
+
+    def render(self, rows, request=None):
+        writers = [
+            (name, render(request) if per_page else render)
+            for name, render, per_page in self.writers
+        ]
+        return [{name: render(row) for name, render in writers} for row in rows]
+
+
+def get_plan(serializer_class, request):
+    spec = FieldSpec.from_request(request)
+    params = request.query_params if request is not None else {}
+    key = (serializer_class, params.get('fields'), params.get('expand'))
+    plan = _plans.get(key)
+    if plan is None:
+        if len(_plans) > 1024:
+            _plans.clear()
+        plan = _plans[key] = ProductRowPlan(serializer_class.Meta.fields, spec)
+    return plan
+
+
+def project(queryset, plan, extra=()):
+    """Turn a product queryset into the .values() projection a plan needs, plus extra columns"""
+    annotations = queryset.query.annotations
+    columns = [
+        column for column in plan.columns
+        if column != 'search_snippet' or column in annotations
+    ]
+    columns += [column for column in extra if column not in columns]
+    # Keyset pagination reads the ordering key back from each row
+    ordering = queryset.query.order_by or Product._meta.ordering
+    if ordering and isinstance(ordering[0], str):
+        key = ordering[0].lstrip('-')
+        if key not in ('pk', 'id') and key not in columns:
+            columns.append(key)
+    return queryset.values(*columns)
@@ -0,0 +1,95 @@
+"""
+Sparse fieldsets (?fields=) and expansion control (?expand=).
+
+Both parameters take comma-separated, dot-nested field names:
+
+    ?fields=id,name,price,image
+    ?fields=id,total_amount,items.quantity,items.product.name
+    ?expand=brand                 # nest brand, render category as its id
+
+Without ?expand= every relation is nested as before. Once it is given,
+only the listed relations are nested and the rest collapse to their ids.
+"""
+from rest_framework import serializers
+
+
+def _parse(value):
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for part in path.strip().split('.'):
+            if part:
+                node = node.setdefault(part, {})
+    return tree
+
+
+class FieldSpec:
+    def __init__(self, fields=None, expand=None):
+        # None means "no restriction" for fields and "default nesting" for expand
+        self.fields = fields or None
+        self.expand = expand
+
+    @classmethod
+    def from_request(cls, request):
+        if request is None:
+            return cls()
+        params = request.query_params
+        fields = _parse(params['fields']) if params.get('fields') else None
+        expand = _parse(params['expand']) if 'expand' in params else None
+        return cls(fields, expand)
+
+    def includes(self, name):
+        return self.fields is None or name in self.fields
+
+    def expands(self, name):
+        """Whether a relation is rendered nested rather than as an id"""
+        return self.includes(name) and (self.expand is None or name in self.expand)
+
+    def child(self, name):
+        fields = self.fields.get(name) if self.fields is not None else None
+        expand = self.expand.get(name, {}) if self.expand is not None else None
+        return FieldSpec(fields, expand)
+
+
+class DynamicFieldsMixin:
+    """
+    Prune serializer fields according to the request's FieldSpec.
+
+    expandable_fields maps relation names to a factory for the field used
+    when the relation is collapsed. Pruned fields are never evaluated, so
+    their method calls and related lookups never run.
+    """
+    expandable_fields = {}
+
+    def get_field_spec(self):
+        spec = getattr(self, '_field_spec', None)
+        if spec is None:
+            # Only the top-level serializer reads the request; nested ones
+            # receive their slice of the spec from their parent
+            parent = self.parent
+            if isinstance(parent, serializers.ListSerializer):
+                parent = parent.parent
+            request = self.context.get('request') if parent is None else None
+            spec = self._field_spec = FieldSpec.from_request(request)
+        return spec
+
+    def get_fields(self):
+        fields = super().get_fields()
+        spec = self.get_field_spec()
+
+        if spec.fields is not None:
+            fields = {name: field for name, field in fields.items() if name in spec.fields}
+
+        for name in list(fields):
+            if name in self.expandable_fields and not spec.expands(name):
+                fields[name] = self.expandable_fields[name]()
+                continue
+            field = fields[name]
+            nested = field.child if isinstance(field, serializers.ListSerializer) else field
+            if isinstance(nested, DynamicFieldsMixin):
+                nested._field_spec = spec.child(name)
+        return fields
+
+
+def collapsed_pk(many=False):
+    return lambda: serializers.PrimaryKeyRelatedField(read_only=True, many=many)
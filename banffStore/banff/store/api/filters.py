@@ -0,0 +1,85 @@
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import F
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import OrderingFilter, SearchFilter
+
+from .. import category_tree, search
+
+
+def filter_products(queryset, params):
+    """Apply the catalog filters shared by product listings and search"""
+    # Filter by category
+    category = params.get('category')
+    if category:
+        # Include subcategories at any depth
+        category_ids = category_tree.get_tree().descendant_ids(category)
+        if category_ids is not None:
+            queryset = queryset.filter(category__id__in=category_ids)
+    
+    # Filter by brand
+    brand = params.get('brand')
+    if brand:
+        queryset = queryset.filter(brand__slug=brand)
+    
+    # Filter by price range
+    min_price = decimal_param(params, 'min_price')
+    max_price = decimal_param(params, 'max_price')
+    if min_price is not None:
+        queryset = queryset.filter(price__gte=min_price)
+    if max_price is not None:
+        queryset = queryset.filter(price__lte=max_price)
+    
+    # Filter by availability, leaving out units held by carts
+    in_stock = params.get('in_stock')
+    if in_stock and in_stock.lower() == 'true':
+        queryset = queryset.filter(stock__gt=F('reserved'))
+    
+    # Filter by featured
+    featured = params.get('featured')
+    if featured and featured.lower() == 'true':
+        queryset = queryset.filter(is_featured=True)
+    
+    # Filter by rating
+    min_rating = decimal_param(params, 'min_rating')
+    if min_rating is not None:
+        queryset = queryset.filter(average_rating__gte=min_rating)
+    
+    return queryset
+
+
+def decimal_param(params, name):
+    """A numeric filter value, None when absent; anything else is a 400"""
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        number = None
+    if number is None or not number.is_finite():
+        raise ValidationError({name: 'Expected a number'})
+    return number
+
+
+def wants_facets(request):
+    return request.query_params.get('facets', '').lower() == 'true'
+
+
+class ProductSearchFilter(SearchFilter):
+    """?search= served from the full-text product index"""
+    
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if not query:
+            return queryset
+        return search.search_products(queryset, query)
+
+
+class ProductOrderingFilter(OrderingFilter):
+    """Order search results by relevance unless ?ordering= is given"""
+    
+    def filter_queryset(self, request, queryset, view):
+        if 'search_rank' in queryset.query.annotations and not request.query_params.get(self.ordering_param):
+            return queryset
+        return super().filter_queryset(request, queryset, view)
@@ -0,0 +1,190 @@
+import base64
+import hashlib
+import json
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class StandardResultsSetPagination(PageNumberPagination):
+    """Custom pagination for API responses"""
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class KeysetResultsSetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination on (ordering field, id).
+
+    The ordering is taken from the queryset itself, so it follows
+    OrderingFilter or the model's Meta.ordering. Each page is a single
+    indexed range scan, and the total count is computed once per distinct
+    filter and cached, so deep pages cost the same as the first one.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    ordering_keys = ['created_at', 'price', 'average_rating', 'name', 'search_rank']
+    count_cache_timeout = 60
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.count = self.get_count(queryset)
+
+        self.field, descending = self.get_ordering(queryset)
+        cursor = self.decode_cursor(request, queryset)
+        reverse = bool(cursor and cursor['reverse'])
+
+        # Walking backwards flips the direction of both keys
+        backwards = descending != reverse
+        queryset = queryset.order_by(*self.order_by(backwards))
+        if cursor:
+            lookup = 'lt' if backwards else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__{lookup}': cursor['value']}) |
+                Q(**{self.field: cursor['value'], f'pk__{lookup}': cursor['pk']})
+            )
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = has_more if not reverse else True
+        self.has_previous = bool(cursor) if not reverse else has_more
+        self.results = results
+        return results
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return PageNumberPagination().get_paginated_response_schema(schema)
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def get_ordering(self, queryset):
+        ordering = queryset.query.order_by or queryset.model._meta.ordering or ['-pk']
+        first = ordering[0]
+        if not isinstance(first, str):
+            raise ValidationError({'ordering': 'Unsupported ordering for cursor pagination'})
+
+        field = first.lstrip('-')
+        if field in ('pk', 'id'):
+            field = 'pk'
+        elif field not in self.ordering_keys or (
+            field not in queryset.query.annotations and not _is_model_field(queryset.model, field)
+        ):
+            raise ValidationError({
+                'ordering': f'Cursor pagination supports: {", ".join(self.ordering_keys)}'
+            })
+        return field, first.startswith('-')
+
+    def order_by(self, descending):
+        prefix = '-' if descending else ''
+        if self.field == 'pk':
+            return [f'{prefix}pk']
+        return [f'{prefix}{self.field}', f'{prefix}pk']
+
+    def get_count(self, queryset):
+        """Count the unpaginated queryset once and cache it per filter"""
+        try:
+            sql = str(queryset.order_by().query)
+        except EmptyResultSet:
+            return 0
+        key = 'store:count:' + hashlib.md5(sql.encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = queryset.order_by().count()
+            cache.set(key, count, self.count_cache_timeout)
+        return count
+
+    def encode_cursor(self, row, reverse):
+        def value_of(name):
+            return row[name] if isinstance(row, dict) else getattr(row, name)
+
+        pk = value_of('id') if isinstance(row, dict) else row.pk
+        value = pk if self.field == 'pk' else value_of(self.field)
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        elif not isinstance(value, (int, float, str)):
+            value = str(value)
+
+        payload = {'v': value, 'pk': pk}
+        if reverse:
+            payload['r'] = 1
+        encoded = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode())
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded.decode())
+
+    def get_key_field(self, queryset):
+        if self.field == 'pk':
+            return queryset.model._meta.pk
+        if self.field in queryset.query.annotations:
+            return queryset.query.annotations[self.field].output_field
+        return queryset.model._meta.get_field(self.field)
+
+    def decode_cursor(self, request, queryset):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            field = self.get_key_field(queryset)
+            return {
+                'value': field.to_python(payload['v']),
+                'pk': int(payload['pk']),
+                'reverse': bool(payload.get('r')),
+            }
+        except (TypeError, ValueError, KeyError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next or not self.results:
+            return None
+        return self.encode_cursor(self.results[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.results:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.results[0], reverse=True)
+
+
+def _is_model_field(model, name):
+    try:
+        model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return True
+
+
+def get_paginator(request):
+    """Use keyset pagination when the client opts in, page numbers otherwise"""
+    if request.query_params.get('pagination') == 'cursor' or 'cursor' in request.query_params:
+        return KeysetResultsSetPagination()
+    return StandardResultsSetPagination()
@@ -0,0 +1,25 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+class ExportRenderer(BaseRenderer):
+    """
+    Selects an export format through content negotiation (?format= or
+    Accept). Exports stream their own response; only error payloads are
+    rendered here, as JSON.
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode(self.charset)
+
+
+class CSVExportRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class JSONLinesExportRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'jsonl'
@@ -1,5 +1,9 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.utils.html import escape
+from .. import category_tree, renditions, search
+from .fieldsets import DynamicFieldsMixin, collapsed_pk
+from ..renditions import PRODUCT_IMAGE_URLS
 from ..models import (
     Category, Brand, Product, ProductImage, ProductAttribute, ProductAttributeValue,
     ProductVariant, ProductReview, Wishlist, Cart, CartItem, Order, OrderItem,
@@ -17,19 +21,32 @@ class CategorySerializer(serializers.ModelSerializer):
         ]
     
     def get_children(self, obj):
-        if hasattr(obj, 'children') and obj.children.filter(is_active=True).exists():
-            return CategorySerializer(obj.children.filter(is_active=True), many=True).data
-        return []
+        tree = category_tree.get_tree()
+        return tree.memoize(
+            ('children', obj.id),
+            lambda: CategorySerializer(tree.children(obj.id), many=True).data
+        )
 
 class BrandSerializer(serializers.ModelSerializer):
+    logo_srcset = serializers.SerializerMethodField()
+    
     class Meta:
         model = Brand
-        fields = ['id', 'name', 'slug', 'description', 'logo', 'website']
+        fields = ['id', 'name', 'slug', 'description', 'logo', 'logo_srcset', 'website']
+    
+    def get_logo_srcset(self, obj):
+        # Absolute, like the logo field itself
+        return renditions.srcset(obj.logo_renditions, obj.logo.name, self.context.get('request'))
 
 class ProductImageSerializer(serializers.ModelSerializer):
+    image_srcset = serializers.SerializerMethodField()
+    
     class Meta:
         model = ProductImage
-        fields = ['id', 'image', 'alt_text', 'sort_order', 'is_primary']
+        fields = ['id', 'image', 'image_srcset', 'alt_text', 'sort_order', 'is_primary']
+    
+    def get_image_srcset(self, obj):
+        return renditions.srcset(obj.image_renditions, obj.image.name, self.context.get('request'))
 
 class ProductAttributeValueSerializer(serializers.ModelSerializer):
     attribute_name = serializers.CharField(source='attribute.name', read_only=True)
@@ -41,15 +58,22 @@ class ProductAttributeValueSerializer(serializers.ModelSerializer):
 class ProductVariantSerializer(serializers.ModelSerializer):
     attributes = ProductAttributeValueSerializer(many=True, read_only=True)
     price_display = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
     
     class Meta:
         model = ProductVariant
-        fields = ['id', 'sku', 'price', 'price_display', 'stock', 'image', 'attributes']
+        fields = [
+            'id', 'sku', 'price', 'price_display', 'stock', 'available_stock',
+            'image', 'image_srcset', 'attributes'
+        ]
     
     def get_price_display(self, obj):
         if obj.price:
             return f"R$ {obj.price:.2f}"
         return None
+    
+    def get_image_srcset(self, obj):
+        return renditions.srcset(obj.image_renditions, obj.image.name, self.context.get('request'))
 
 class ProductReviewSerializer(serializers.ModelSerializer):
     user_name = serializers.CharField(source='user.username', read_only=True)
@@ -70,8 +94,9 @@ class ProductReviewSerializer(serializers.ModelSerializer):
             pass
         return None
 
-class ProductListSerializer(serializers.ModelSerializer):
+class ProductListSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Simplified serializer for product listings"""
+    expandable_fields = {'category': collapsed_pk(), 'brand': collapsed_pk()}
     category = CategorySerializer(read_only=True)
     brand = BrandSerializer(read_only=True)
     price_display = serializers.SerializerMethodField()
@@ -81,13 +106,14 @@ class ProductListSerializer(serializers.ModelSerializer):
     average_rating = serializers.ReadOnlyField()
     review_count = serializers.ReadOnlyField()
     image = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
     
     class Meta:
         model = Product
         fields = [
             'id', 'name', 'slug', 'short_description', 'price', 'price_display',
             'compare_at_price', 'compare_at_price_display', 'discount_percentage',
-            'is_on_sale', 'category', 'brand', 'image', 'stock', 'is_featured',
+            'is_on_sale', 'category', 'brand', 'image', 'image_srcset', 'stock', 'available_stock', 'is_featured',
             'average_rating', 'review_count', 'created_at'
         ]
     
@@ -100,26 +126,36 @@ class ProductListSerializer(serializers.ModelSerializer):
         return None
     
     def get_image(self, obj):
-        # Define static image URLs for products
-        image_urls = {
-            'Basic Tee': 'https://images.unsplash.com/photo-1521572163474-6864f9cf17ab?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-            'Organic Cotton T-Shirt': 'https://images.unsplash.com/photo-1576566588028-4147f3842f27?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-            'Classic Baseball Cap': 'https://images.unsplash.com/photo-1588850561407-ed78c282e89b?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-            'Premium Hoodie': 'https://images.unsplash.com/photo-1556821840-3a63f95609a7?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-        }
-        
         # Return static image URL for known products
-        if obj.name in image_urls:
-            return image_urls[obj.name]
+        if obj.name in PRODUCT_IMAGE_URLS:
+            return PRODUCT_IMAGE_URLS[obj.name]
         
-        # Fallback to actual image field if it exists
+        # Grid cards use the card-sized rendition once it exists
         if obj.image:
-            return obj.image.url
+            card = renditions.fallback_url(obj.image_renditions, obj.image.name, 'card')
+            return card or obj.image.url
             
         return None
+    
+    def get_image_srcset(self, obj):
+        return renditions.srcset(obj.image_renditions, obj.image.name, self.context.get('request'))
 
-class ProductDetailSerializer(serializers.ModelSerializer):
+class ProductSearchResultSerializer(ProductListSerializer):
+    """Product listing plus the highlighted text that matched the search"""
+    snippet = serializers.SerializerMethodField()
+    
+    class Meta(ProductListSerializer.Meta):
+        fields = ProductListSerializer.Meta.fields + ['snippet']
+    
+    def get_snippet(self, obj):
+        snippet = getattr(obj, 'search_snippet', None)
+        if not snippet:
+            return None
+        return escape(snippet).replace(search.HIGHLIGHT_START, '<mark>').replace(search.HIGHLIGHT_END, '</mark>')
+
+class ProductDetailSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Detailed serializer for individual product views"""
+    expandable_fields = {'category': collapsed_pk(), 'brand': collapsed_pk()}
     category = CategorySerializer(read_only=True)
     brand = BrandSerializer(read_only=True)
     images = ProductImageSerializer(many=True, read_only=True)
@@ -132,17 +168,19 @@ class ProductDetailSerializer(serializers.ModelSerializer):
     is_low_stock = serializers.ReadOnlyField()
     average_rating = serializers.ReadOnlyField()
     review_count = serializers.ReadOnlyField()
+    rating_histogram = serializers.ReadOnlyField()
     image = serializers.SerializerMethodField()
+    image_srcset = serializers.SerializerMethodField()
     
     class Meta:
         model = Product
         fields = [
             'id', 'name', 'slug', 'description', 'short_description', 'sku',
             'price', 'price_display', 'compare_at_price', 'compare_at_price_display',
-            'discount_percentage', 'is_on_sale', 'category', 'brand', 'image',
-            'images', 'stock', 'is_low_stock', 'low_stock_threshold', 'weight',
+            'discount_percentage', 'is_on_sale', 'category', 'brand', 'image', 'image_srcset',
+            'images', 'stock', 'available_stock', 'is_low_stock', 'low_stock_threshold', 'weight',
             'dimensions', 'status', 'is_featured', 'variants', 'reviews',
-            'average_rating', 'review_count', 'meta_title', 'meta_description',
+            'average_rating', 'review_count', 'rating_histogram', 'meta_title', 'meta_description',
             'created_at', 'updated_at'
         ]
     
@@ -155,17 +193,9 @@ class ProductDetailSerializer(serializers.ModelSerializer):
         return None
     
     def get_image(self, obj):
-        # Define static image URLs for products
-        image_urls = {
-            'Basic Tee': 'https://images.unsplash.com/photo-1521572163474-6864f9cf17ab?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-            'Organic Cotton T-Shirt': 'https://images.unsplash.com/photo-1576566588028-4147f3842f27?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-            'Classic Baseball Cap': 'https://images.unsplash.com/photo-1588850561407-ed78c282e89b?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-            'Premium Hoodie': 'https://images.unsplash.com/photo-1556821840-3a63f95609a7?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
-        }
-        
         # Return static image URL for known products
-        if obj.name in image_urls:
-            return image_urls[obj.name]
+        if obj.name in PRODUCT_IMAGE_URLS:
+            return PRODUCT_IMAGE_URLS[obj.name]
         
         # Fallback to actual image field if it exists
         if obj.image:
@@ -173,9 +203,12 @@ class ProductDetailSerializer(serializers.ModelSerializer):
             
         return None
     
+    def get_image_srcset(self, obj):
+        return renditions.srcset(obj.image_renditions, obj.image.name, self.context.get('request'))
+    
     def get_reviews(self, obj):
         if hasattr(obj, 'reviews'):
-            reviews = obj.reviews.filter(is_approved=True)[:5]  # Latest 5 reviews
+            reviews = obj.reviews.filter(is_approved=True).select_related('user__profile')[:5]  # Latest 5 reviews
             return ProductReviewSerializer(reviews, many=True).data
         return []
 
@@ -195,7 +228,8 @@ class UserProfileSerializer(serializers.ModelSerializer):
             'default_state', 'default_zip_code', 'default_country'
         ]
 
-class CartItemSerializer(serializers.ModelSerializer):
+class CartItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'product': collapsed_pk(), 'variant': collapsed_pk()}
     product = ProductListSerializer(read_only=True)
     product_id = serializers.IntegerField(write_only=True)
     variant = ProductVariantSerializer(read_only=True)
@@ -223,7 +257,7 @@ class CartItemSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("Quantity must be greater than 0")
         return value
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     items = CartItemSerializer(many=True, read_only=True)
     total_amount = serializers.ReadOnlyField()
     total_items = serializers.ReadOnlyField()
@@ -239,7 +273,8 @@ class CartSerializer(serializers.ModelSerializer):
     def get_total_amount_display(self, obj):
         return f"R$ {obj.total_amount:.2f}"
 
-class WishlistSerializer(serializers.ModelSerializer):
+class WishlistSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'products': collapsed_pk(many=True)}
     products = ProductListSerializer(many=True, read_only=True)
     product_count = serializers.SerializerMethodField()
     
@@ -250,7 +285,8 @@ class WishlistSerializer(serializers.ModelSerializer):
     def get_product_count(self, obj):
         return obj.products.count()
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'product': collapsed_pk(), 'variant': collapsed_pk()}
     product = ProductListSerializer(read_only=True)
     variant = ProductVariantSerializer(read_only=True)
     unit_price_display = serializers.SerializerMethodField()
@@ -269,7 +305,8 @@ class OrderItemSerializer(serializers.ModelSerializer):
     def get_total_price_display(self, obj):
         return f"R$ {obj.total_price:.2f}"
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'user': collapsed_pk()}
     items = OrderItemSerializer(many=True, read_only=True)
     user = UserSerializer(read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
@@ -295,6 +332,43 @@ class OrderSerializer(serializers.ModelSerializer):
     def get_total_amount_display(self, obj):
         return f"R$ {obj.total_amount:.2f}"
 
+class OrderItemSummarySerializer(serializers.ModelSerializer):
+    """An order line from its purchase-time snapshot, without the catalog"""
+    unit_price_display = serializers.SerializerMethodField()
+    total_price_display = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = OrderItem
+        fields = [
+            'id', 'product_id', 'variant_id', 'product_name', 'product_sku',
+            'product_image', 'variant_label', 'quantity', 'unit_price',
+            'unit_price_display', 'total_price', 'total_price_display'
+        ]
+    
+    def get_unit_price_display(self, obj):
+        return f"R$ {obj.unit_price:.2f}"
+    
+    def get_total_price_display(self, obj):
+        return f"R$ {obj.total_price:.2f}"
+
+class OrderSummarySerializer(serializers.ModelSerializer):
+    """Order history rows, read from the order tables alone"""
+    items = OrderItemSummarySerializer(many=True, read_only=True)
+    status_display = serializers.CharField(source='get_status_display', read_only=True)
+    payment_status_display = serializers.CharField(source='get_payment_status_display', read_only=True)
+    total_amount_display = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Order
+        fields = [
+            'id', 'order_number', 'status', 'status_display', 'payment_status',
+            'payment_status_display', 'items', 'subtotal', 'discount_amount',
+            'total_amount', 'total_amount_display', 'created_at'
+        ]
+    
+    def get_total_amount_display(self, obj):
+        return f"R$ {obj.total_amount:.2f}"
+
 class CouponSerializer(serializers.ModelSerializer):
     discount_type_display = serializers.CharField(source='get_discount_type_display', read_only=True)
     is_valid = serializers.ReadOnlyField()
@@ -307,6 +381,30 @@ class CouponSerializer(serializers.ModelSerializer):
         ]
 
 # Create/Update Serializers
+class CheckoutSerializer(serializers.ModelSerializer):
+    """Addresses for a new order; shipping fields left out copy billing"""
+    coupon_code = serializers.CharField(required=False, allow_blank=True)
+    
+    class Meta:
+        model = Order
+        fields = [
+            'billing_first_name', 'billing_last_name', 'billing_email', 'billing_phone',
+            'billing_address_line1', 'billing_address_line2', 'billing_city',
+            'billing_state', 'billing_zip_code', 'billing_country',
+            'shipping_first_name', 'shipping_last_name', 'shipping_address_line1',
+            'shipping_address_line2', 'shipping_city', 'shipping_state',
+            'shipping_zip_code', 'shipping_country', 'notes', 'coupon_code'
+        ]
+        extra_kwargs = {
+            name: {'required': False} for name in fields if name.startswith('shipping_')
+        }
+    
+    def validate(self, attrs):
+        for name in self.Meta.fields:
+            if name.startswith('shipping_') and not attrs.get(name):
+                attrs[name] = attrs.get('billing_' + name[len('shipping_'):], '')
+        return attrs
+
 class CartItemCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
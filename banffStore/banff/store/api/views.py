@@ -1,111 +1,328 @@
 from rest_framework import generics, status, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.filters import SearchFilter, OrderingFilter
-from django.db.models import Q, Avg
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.db.models import Prefetch, prefetch_related_objects
 from django.contrib.auth import authenticate
 from rest_framework.authtoken.models import Token
 
+from .. import (
+    anonymous_carts, carts, category_tree, checkout, coupons, exports, facets, inventory, response_cache,
+    search, sessions, suggest, wishlists
+)
 from ..models import (
-    Product, Category, Brand, Cart, CartItem, Wishlist, ProductReview,
-    Order, Coupon, UserProfile
+    Product, ProductVariant, Category, Brand, Cart, CartItem, Wishlist, ProductReview,
+    Order, OrderItem, Coupon, UserProfile
 )
 from .serializers import (
     ProductListSerializer, ProductDetailSerializer, CategorySerializer, BrandSerializer,
     CartSerializer, CartItemSerializer, WishlistSerializer,
     ProductReviewSerializer, ProductReviewCreateSerializer, OrderSerializer,
-    CouponSerializer, UserSerializer, UserProfileSerializer
+    CouponSerializer, UserSerializer, UserProfileSerializer, ProductSearchResultSerializer,
+    CheckoutSerializer, OrderSummarySerializer
 )
+from . import batch, fast_serializers
+from .caching import CachedResponseMixin
+from .fieldsets import FieldSpec
+from .filters import ProductSearchFilter, ProductOrderingFilter, filter_products, wants_facets
+from .pagination import StandardResultsSetPagination, get_paginator
+from .renderers import CSVExportRenderer, JSONLinesExportRenderer
+
+def product_queryset(spec, queryset=None):
+    """Products with only the joins the requested fields need"""
+    if queryset is None:
+        queryset = Product.objects.filter(status='active')
+    related = [name for name in ('category', 'brand') if spec.expands(name)]
+    if related:
+        queryset = queryset.select_related(*related)
+    return queryset
+
+def cart_items_prefetch(spec):
+    """Prefetch for Cart.items; product and variant are always needed for prices"""
+    items = spec.child('items')
+    related = ['product', 'variant']
+    if items.expands('product'):
+        product = items.child('product')
+        related += [f'product__{name}' for name in ('category', 'brand') if product.expands(name)]
+    queryset = CartItem.objects.select_related(*related)
+    if items.expands('variant'):
+        queryset = queryset.prefetch_related('variant__attributes__attribute')
+    return Prefetch('items', queryset=queryset)
+
+def prefetch_cart(cart, request):
+    prefetch_related_objects([cart], cart_items_prefetch(FieldSpec.from_request(request)))
+    return cart
+
+def parse_quantity(value):
+    """A cart quantity from request data: a whole number of at least 1, or None"""
+    if isinstance(value, bool):
+        return None
+    try:
+        quantity = int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+    return quantity if quantity >= 1 else None
 
-class StandardResultsSetPagination(PageNumberPagination):
-    """Custom pagination for API responses"""
-    page_size = 20
-    page_size_query_param = 'page_size'
-    max_page_size = 100
+def cart_mutation_response(request, message, cart_id, item=None, item_id=None):
+    """
+    The whole cart after a change, or with ?response=delta only the line
+    that changed (null once removed) and the cart's new totals
+    """
+    if request.query_params.get('response') != 'delta':
+        cart = prefetch_cart(Cart.objects.get(pk=cart_id), request)
+        return Response({
+            'message': message,
+            'cart': CartSerializer(cart, context={'request': request}).data
+        })
+    
+    totals = Cart.objects.filter(pk=cart_id).values('id', 'total_amount', 'total_items').get()
+    totals['total_amount_display'] = f"R$ {totals['total_amount']:.2f}"
+    return Response({
+        'message': message,
+        'item_id': item.pk if item is not None else item_id,
+        'item': CartItemSerializer(item, context={'request': request}).data if item is not None else None,
+        'cart': totals
+    })
 
-class ProductListView(generics.ListAPIView):
+def current_cart(request):
     """
-    List all products with filtering, search, and ordering capabilities
+    The request's stored cart and, for a visitor without one, its cookie or
+    cache cart. Either may be None; nothing is created.
     """
+    if request.user.is_authenticated:
+        return Cart.objects.filter(user=request.user).first(), None
+    session_key = request.session.session_key
+    cart = Cart.objects.filter(session_key=session_key).first() if session_key else None
+    if cart is not None:
+        return cart, None
+    return None, anonymous_carts.load(request)
+
+def create_cart(request):
+    if request.user.is_authenticated:
+        return Cart.objects.get_or_create(user=request.user)[0]
+    if not request.session.session_key:
+        request.session.create()
+    return Cart.objects.get_or_create(session_key=request.session.session_key)[0]
+
+def build_anonymous_cart(anonymous, request):
+    """A cookie or cache cart with its products, ready for CartSerializer"""
+    spec = FieldSpec.from_request(request).child('items')
+    product_ids = {line[1] for line in anonymous.lines}
+    variant_ids = {line[2] for line in anonymous.lines if line[2]}
+    products = product_queryset(spec.child('product')).in_bulk(product_ids) if product_ids else {}
+    variants = ProductVariant.objects.filter(product_id__in=product_ids).in_bulk(variant_ids) if variant_ids else {}
+    if variants and spec.expands('variant'):
+        prefetch_related_objects(list(variants.values()), 'attributes__attribute')
+    return anonymous.build(products, variants)
+
+def anonymous_mutation_response(request, message, anonymous, line_id):
+    """cart_mutation_response for a cookie or cache cart, which it also saves"""
+    cart = build_anonymous_cart(anonymous, request)
+    if request.query_params.get('response') != 'delta':
+        response = Response({
+            'message': message,
+            'cart': CartSerializer(cart, context={'request': request}).data
+        })
+    else:
+        item = next((item for item in cart.items if item.pk == line_id), None)
+        response = Response({
+            'message': message,
+            'item_id': line_id,
+            'item': CartItemSerializer(item, context={'request': request}).data if item is not None else None,
+            'cart': {
+                'id': None,
+                'total_amount': cart.total_amount,
+                'total_items': cart.total_items,
+                'total_amount_display': f"R$ {cart.total_amount:.2f}"
+            }
+        })
+    anonymous_carts.save(anonymous, response)
+    return response
+
+def order_queryset(request, queryset):
+    spec = FieldSpec.from_request(request)
+    if spec.expands('user'):
+        queryset = queryset.select_related('user')
+    if spec.includes('items'):
+        items = spec.child('items')
+        item_queryset = OrderItem.objects.all()
+        if items.expands('product'):
+            item_queryset = item_queryset.select_related(
+                'product', *[f'product__{name}' for name in ('category', 'brand') if items.child('product').expands(name)]
+            )
+        if items.expands('variant'):
+            item_queryset = item_queryset.select_related('variant').prefetch_related('variant__attributes__attribute')
+        queryset = queryset.prefetch_related(Prefetch('items', queryset=item_queryset))
+    return queryset
+
+def prefetch_wishlist(wishlist, request):
+    spec = FieldSpec.from_request(request)
+    if spec.includes('products'):
+        products = Product.objects.all()
+        if spec.expands('products'):
+            products = product_queryset(spec.child('products'), products)
+        prefetch_related_objects([wishlist], Prefetch('products', queryset=products))
+    return wishlist
+
+class WishlistFlagMixin:
+    """
+    Adds is_wishlisted for the requesting user to cached product responses;
+    the shared copy never has it
+    """
+    def wants_wishlist_flag(self):
+        return FieldSpec.from_request(self.request).includes('is_wishlisted')
+    
+    def get_personal_tags(self):
+        if not self.wants_wishlist_flag():
+            return None
+        user = self.request.user
+        return [response_cache.wishlist_tag(user.pk)] if user.is_authenticated else []
+    
+    def mark_wishlisted(self, products):
+        return wishlists.mark(self.request.user, products)
+
+class ProductListView(WishlistFlagMixin, CachedResponseMixin, generics.ListAPIView):
+    """
+    List all products with filtering, search, and ordering capabilities.
+    ?ids=1,2,3 or ?slugs=a,b fetches exactly those products instead, in
+    that order, and lists the ones not found under "missing".
+    """
+    cache_tags = [response_cache.PRODUCTS, response_cache.CATEGORIES, response_cache.BRANDS]
     serializer_class = ProductListSerializer
     pagination_class = StandardResultsSetPagination
-    filter_backends = [SearchFilter, OrderingFilter]
-    search_fields = ['name', 'description', 'short_description', 'sku']
+    filter_backends = [ProductSearchFilter, ProductOrderingFilter]
     ordering_fields = ['name', 'price', 'created_at', 'average_rating']
     ordering = ['-created_at']
+    max_requested = 100
     
-    def get_queryset(self):
-        queryset = Product.objects.filter(status='active').select_related('category', 'brand')
-        
-        # Filter by category
-        category = self.request.query_params.get('category')
-        if category:
+    def get_requested(self):
+        """('id' | 'slug', values) from ?ids= or ?slugs=, or None for a regular listing"""
+        params = self.request.query_params
+        field = 'id' if params.get('ids') else 'slug' if params.get('slugs') else None
+        if field is None:
+            return None
+        values = [value.strip() for value in params[field + 's'].split(',') if value.strip()]
+        if field == 'id':
             try:
-                category_obj = Category.objects.get(slug=category, is_active=True)
-                # Include subcategories
-                category_ids = [category_obj.id]
-                category_ids.extend(category_obj.children.filter(is_active=True).values_list('id', flat=True))
-                queryset = queryset.filter(category__id__in=category_ids)
-            except Category.DoesNotExist:
-                pass
-        
-        # Filter by brand
-        brand = self.request.query_params.get('brand')
-        if brand:
-            queryset = queryset.filter(brand__slug=brand)
-        
-        # Filter by price range
-        min_price = self.request.query_params.get('min_price')
-        max_price = self.request.query_params.get('max_price')
-        if min_price:
-            queryset = queryset.filter(price__gte=min_price)
-        if max_price:
-            queryset = queryset.filter(price__lte=max_price)
-        
-        # Filter by availability
-        in_stock = self.request.query_params.get('in_stock')
-        if in_stock and in_stock.lower() == 'true':
-            queryset = queryset.filter(stock__gt=0)
-        
-        # Filter by featured
-        featured = self.request.query_params.get('featured')
-        if featured and featured.lower() == 'true':
-            queryset = queryset.filter(is_featured=True)
-        
-        # Filter by rating
-        min_rating = self.request.query_params.get('min_rating')
-        if min_rating:
-            queryset = queryset.annotate(
-                avg_rating=Avg('reviews__rating')
-            ).filter(avg_rating__gte=min_rating)
+                values = [int(value) for value in values]
+            except ValueError:
+                raise ValidationError({'ids': 'Expected comma-separated product ids'})
+        values = list(dict.fromkeys(values))
+        if len(values) > self.max_requested:
+            raise ValidationError({field + 's': f'At most {self.max_requested} products per request'})
+        return field, values
+    
+    def get_cache_tags(self):
+        requested = self.get_requested()
+        if requested is None:
+            return self.cache_tags
+        # Depend on just these products, so edits to others keep the entry
+        field, values = requested
+        ids = values if field == 'id' else list(response_cache.product_ids_for_slugs(values).values())
+        if None in ids:
+            # A missing slug may appear as any new product
+            return self.cache_tags
+        tags = [response_cache.product_tag(product_id) for product_id in ids]
+        return tags + [response_cache.CATEGORIES, response_cache.BRANDS]
+    
+    @property
+    def paginator(self):
+        # Opt-in keyset pagination via ?pagination=cursor
+        if not hasattr(self, '_paginator'):
+            self._paginator = get_paginator(self.request)
+        return self._paginator
+    
+    def get_serializer_class(self):
+        if self.request.query_params.get('search'):
+            return ProductSearchResultSerializer
+        return ProductListSerializer
+    
+    def get_queryset(self):
+        queryset = product_queryset(FieldSpec.from_request(self.request))
+        return filter_products(queryset, self.request.query_params)
+    
+    def list(self, request, *args, **kwargs):
+        requested = self.get_requested()
+        if requested is not None:
+            return self.list_requested(request, *requested)
         
-        return queryset.distinct()
+        queryset = self.filter_queryset(self.get_queryset())
+        # Rows go through the .values() fast path rather than the serializer
+        plan = fast_serializers.get_plan(self.get_serializer_class(), request)
+        page = self.paginate_queryset(fast_serializers.project(queryset, plan))
+        response = self.get_paginated_response(plan.render(page, request))
+        if wants_facets(request):
+            response.data['facets'] = facets.compute_facets(queryset)
+        return response
+    
+    def list_requested(self, request, field, values):
+        queryset = product_queryset(FieldSpec.from_request(request)).filter(**{f'{field}__in': values})
+        plan = fast_serializers.get_plan(ProductListSerializer, request)
+        rows = {row[field]: row for row in fast_serializers.project(queryset.order_by(), plan, extra=[field])}
+        return Response({
+            'count': len(rows),
+            'results': plan.render([rows[value] for value in values if value in rows], request),
+            'missing': [value for value in values if value not in rows]
+        })
+    
+    def personalize(self, data):
+        if not self.wants_wishlist_flag():
+            return data
+        return {**data, 'results': self.mark_wishlisted(data['results'])}
 
-class ProductDetailView(generics.RetrieveAPIView):
+class ProductDetailView(WishlistFlagMixin, CachedResponseMixin, generics.RetrieveAPIView):
     """
     Retrieve a single product by ID or slug
     """
     serializer_class = ProductDetailSerializer
     lookup_field = 'slug'
     
+    def get_cache_tags(self):
+        product_id = response_cache.product_id_for_slug(self.kwargs['slug'])
+        if product_id is None:
+            return None
+        return [response_cache.product_tag(product_id), response_cache.CATEGORIES, response_cache.BRANDS]
+    
     def get_queryset(self):
-        return Product.objects.filter(status='active').select_related('category', 'brand').prefetch_related(
-            'images', 'variants', 'reviews__user'
-        )
+        spec = FieldSpec.from_request(self.request)
+        queryset = product_queryset(spec)
+        if spec.includes('images'):
+            queryset = queryset.prefetch_related('images')
+        if spec.includes('variants'):
+            queryset = queryset.prefetch_related('variants__attributes__attribute')
+        return queryset
+    
+    def personalize(self, data):
+        if not self.wants_wishlist_flag():
+            return data
+        return self.mark_wishlisted([data])[0]
 
-class CategoryListView(generics.ListAPIView):
+class CategoryListView(CachedResponseMixin, generics.ListAPIView):
     """
-    List all active categories
+    List all active categories, served from the in-memory category tree
     """
     serializer_class = CategorySerializer
-    queryset = Category.objects.filter(is_active=True, parent=None).order_by('sort_order', 'name')
+    cache_tags = [response_cache.CATEGORIES]
+    
+    def list(self, request, *args, **kwargs):
+        tree = category_tree.get_tree()
+        categories = tree.memoize(
+            'roots', lambda: CategorySerializer(tree.roots(), many=True).data
+        )
+        page = self.paginate_queryset(categories)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(categories)
 
-class BrandListView(generics.ListAPIView):
+class BrandListView(CachedResponseMixin, generics.ListAPIView):
     """
     List all active brands
     """
+    cache_tags = [response_cache.BRANDS]
     serializer_class = BrandSerializer
     queryset = Brand.objects.filter(is_active=True).order_by('name')
 
@@ -150,11 +367,15 @@ def register_view(request):
         
         # Create auth token
         token, created = Token.objects.get_or_create(user=user)
+        anonymous = anonymous_carts.adopt(request, user)
         
-        return Response({
+        response = Response({
             'user': UserSerializer(user).data,
             'token': token.key
         }, status=status.HTTP_201_CREATED)
+        if anonymous is not None:
+            anonymous_carts.discard(anonymous, response)
+        return response
         
     except Exception as e:
         return Response({
@@ -178,10 +399,14 @@ def login_view(request):
     user = authenticate(username=username, password=password)
     if user:
         token, created = Token.objects.get_or_create(user=user)
-        return Response({
+        anonymous = anonymous_carts.adopt(request, user)
+        response = Response({
             'user': UserSerializer(user).data,
             'token': token.key
         })
+        if anonymous is not None:
+            anonymous_carts.discard(anonymous, response)
+        return response
     else:
         return Response({
             'error': 'Invalid credentials'
@@ -204,72 +429,90 @@ def cart_view(request):
     """
     Handle cart operations - get cart or add items
     """
-    # Get or create cart
-    if request.user.is_authenticated:
-        cart, created = Cart.objects.get_or_create(user=request.user)
-    else:
-        session_key = request.session.session_key
-        if not session_key:
-            request.session.create()
-            session_key = request.session.session_key
-        cart, created = Cart.objects.get_or_create(session_key=session_key)
+    # Nothing is created until the first item is added
+    cart, anonymous = current_cart(request)
     
     if request.method == 'GET':
-        serializer = CartSerializer(cart)
+        if cart is None:
+            empty = anonymous or anonymous_carts.AnonymousCart()
+            serializer = CartSerializer(build_anonymous_cart(empty, request), context={'request': request})
+        else:
+            serializer = CartSerializer(prefetch_cart(cart, request), context={'request': request})
         return Response(serializer.data)
     
     elif request.method == 'POST':
         # Add item to cart
         product_id = request.data.get('product_id')
         variant_id = request.data.get('variant_id')
-        quantity = int(request.data.get('quantity', 1))
+        quantity = parse_quantity(request.data.get('quantity', 1))
+        if quantity is None:
+            return Response({
+                'error': 'Invalid quantity'
+            }, status=status.HTTP_400_BAD_REQUEST)
         
         try:
             product = Product.objects.get(id=product_id, status='active')
-            
-            # Check if item already exists in cart
-            cart_item_filter = {'cart': cart, 'product': product}
-            if variant_id:
-                cart_item_filter['variant_id'] = variant_id
-            else:
-                cart_item_filter['variant'] = None
-            
-            cart_item, created = CartItem.objects.get_or_create(
-                **cart_item_filter,
-                defaults={'quantity': quantity}
-            )
-            
-            if not created:
-                cart_item.quantity += quantity
-                cart_item.save()
-            
-            return Response({
-                'message': 'Item added to cart',
-                'cart': CartSerializer(cart).data
-            })
-            
         except Product.DoesNotExist:
             return Response({
                 'error': 'Product not found'
             }, status=status.HTTP_404_NOT_FOUND)
+        
+        variant = None
+        if variant_id:
+            variant = ProductVariant.objects.filter(id=variant_id, product=product).first()
+            if variant is None:
+                return Response({
+                    'error': 'Variant not found'
+                }, status=status.HTTP_404_NOT_FOUND)
+        
+        spill = None
+        if cart is None and not request.user.is_authenticated and anonymous_carts.get_storage() != 'db':
+            anonymous = anonymous or anonymous_carts.AnonymousCart()
+            line = anonymous.add(product.pk, variant.pk if variant else None, quantity)
+            if len(anonymous.lines) <= anonymous_carts.get_max_lines():
+                if not anonymous_carts.in_stock(product, variant, line[3]):
+                    return Response({
+                        'error': 'Not enough stock available'
+                    }, status=status.HTTP_409_CONFLICT)
+                return anonymous_mutation_response(request, 'Item added to cart', anonymous, line[0])
+            # Too big to carry around; move it to the database
+            anonymous.remove(line[0])
+            spill = anonymous
+        
+        with transaction.atomic():
+            if cart is None:
+                cart = create_cart(request)
+            if spill is not None:
+                anonymous_carts.materialize(spill, cart)
+            cart_item, created = carts.add_item(cart, product, variant, quantity)
+            # Hold the units for this cart, or undo the add
+            held = inventory.hold(cart, product, cart_item.variant_id, cart_item.quantity)
+            if not held:
+                transaction.set_rollback(True)
+        
+        if not held:
+            return Response({
+                'error': 'Not enough stock available'
+            }, status=status.HTTP_409_CONFLICT)
+        
+        response = cart_mutation_response(request, 'Item added to cart', cart.pk, cart_item)
+        if spill is not None:
+            anonymous_carts.discard(spill, response)
+        return response
 
 @api_view(['PUT', 'DELETE'])
 def cart_item_view(request, item_id):
     """
     Update or remove cart items
     """
+    cart, anonymous = current_cart(request)
+    if anonymous is not None:
+        return anonymous_cart_item(request, anonymous, item_id)
+    
     try:
-        if request.user.is_authenticated:
-            cart_item = CartItem.objects.get(
-                id=item_id, 
-                cart__user=request.user
-            )
-        else:
-            session_key = request.session.session_key
-            cart_item = CartItem.objects.get(
-                id=item_id,
-                cart__session_key=session_key
-            )
+        if cart is None:
+            raise CartItem.DoesNotExist
+        cart_item = CartItem.objects.select_related('product', 'cart').get(id=item_id, cart=cart)
     except CartItem.DoesNotExist:
         return Response({
             'error': 'Cart item not found'
@@ -277,14 +520,21 @@ def cart_item_view(request, item_id):
     
     if request.method == 'PUT':
         # Update quantity
-        quantity = request.data.get('quantity')
-        if quantity and int(quantity) > 0:
-            cart_item.quantity = int(quantity)
-            cart_item.save()
-            return Response({
-                'message': 'Cart item updated',
-                'cart': CartSerializer(cart_item.cart).data
-            })
+        quantity = parse_quantity(request.data.get('quantity'))
+        if quantity is not None:
+            with transaction.atomic():
+                if not inventory.hold(cart_item.cart, cart_item.product, cart_item.variant_id, quantity):
+                    return Response({
+                        'error': 'Not enough stock available'
+                    }, status=status.HTTP_409_CONFLICT)
+                updated = carts.set_quantity(cart_item, quantity)
+                if updated is None:
+                    # The line went away meanwhile, so don't keep its hold
+                    transaction.set_rollback(True)
+                    return Response({
+                        'error': 'Cart item not found'
+                    }, status=status.HTTP_404_NOT_FOUND)
+            return cart_mutation_response(request, 'Cart item updated', cart_item.cart_id, updated)
         else:
             return Response({
                 'error': 'Invalid quantity'
@@ -292,44 +542,74 @@ def cart_item_view(request, item_id):
     
     elif request.method == 'DELETE':
         # Remove item
-        cart = cart_item.cart
-        cart_item.delete()
+        with transaction.atomic():
+            inventory.release(cart_item.cart_id, cart_item.product_id, cart_item.variant_id)
+            carts.remove_item(cart_item)
+        return cart_mutation_response(request, 'Item removed from cart', cart_item.cart_id, item_id=cart_item.pk)
+
+def anonymous_cart_item(request, anonymous, item_id):
+    """cart_item_view for a cookie or cache cart"""
+    line = anonymous.find(item_id)
+    if line is None:
         return Response({
-            'message': 'Item removed from cart',
-            'cart': CartSerializer(cart).data
-        })
+            'error': 'Cart item not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    if request.method == 'PUT':
+        quantity = parse_quantity(request.data.get('quantity'))
+        if quantity is None:
+            return Response({
+                'error': 'Invalid quantity'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        product = Product.objects.filter(id=line[1], status='active').first()
+        variant = ProductVariant.objects.filter(id=line[2]).first() if line[2] else None
+        if product is None or not anonymous_carts.in_stock(product, variant, quantity):
+            return Response({
+                'error': 'Not enough stock available'
+            }, status=status.HTTP_409_CONFLICT)
+        anonymous.update(item_id, quantity)
+        return anonymous_mutation_response(request, 'Cart item updated', anonymous, item_id)
+    
+    anonymous.remove(item_id)
+    return anonymous_mutation_response(request, 'Item removed from cart', anonymous, item_id)
 
 @api_view(['GET', 'POST'])
 @permission_classes([permissions.IsAuthenticated])
 def wishlist_view(request):
     """
-    Handle wishlist operations
+    Handle wishlist operations; POST toggles a product, and with
+    ?response=delta returns only its new state and the product count
     """
-    wishlist, created = Wishlist.objects.get_or_create(user=request.user)
-    
     if request.method == 'GET':
-        serializer = WishlistSerializer(wishlist)
+        wishlist, created = Wishlist.objects.get_or_create(user=request.user)
+        serializer = WishlistSerializer(prefetch_wishlist(wishlist, request), context={'request': request})
         return Response(serializer.data)
     
     elif request.method == 'POST':
         product_id = request.data.get('product_id')
-        try:
-            product = Product.objects.get(id=product_id, status='active')
-            if product in wishlist.products.all():
-                wishlist.products.remove(product)
-                message = 'Product removed from wishlist'
-            else:
-                wishlist.products.add(product)
-                message = 'Product added to wishlist'
-            
-            return Response({
-                'message': message,
-                'wishlist': WishlistSerializer(wishlist).data
-            })
-        except Product.DoesNotExist:
+        with transaction.atomic():
+            wishlisted, wishlist_id = wishlists.toggle(
+                request.user, product_id,
+                can_add=lambda: Product.objects.filter(id=product_id, status='active').exists()
+            )
+        if wishlisted is None:
             return Response({
                 'error': 'Product not found'
             }, status=status.HTTP_404_NOT_FOUND)
+        
+        message = 'Product added to wishlist' if wishlisted else 'Product removed from wishlist'
+        if request.query_params.get('response') != 'delta':
+            wishlist = Wishlist.objects.get(pk=wishlist_id)
+            return Response({
+                'message': message,
+                'wishlist': WishlistSerializer(prefetch_wishlist(wishlist, request), context={'request': request}).data
+            })
+        return Response({
+            'message': message,
+            'product_id': int(product_id),
+            'is_wishlisted': wishlisted,
+            'product_count': wishlists.count(wishlist_id)
+        })
 
 @api_view(['GET', 'POST'])
 @permission_classes([permissions.IsAuthenticated])
@@ -345,7 +625,7 @@ def reviews_view(request):
                 is_approved=True
             ).order_by('-created_at')
             
-            paginator = StandardResultsSetPagination()
+            paginator = get_paginator(request)
             page = paginator.paginate_queryset(reviews, request)
             serializer = ProductReviewSerializer(page, many=True)
             return paginator.get_paginated_response(serializer.data)
@@ -365,12 +645,19 @@ def reviews_view(request):
 @permission_classes([permissions.IsAuthenticated])
 def orders_view(request):
     """
-    List user orders
+    List user orders; ?view=summary reads them from the order tables alone,
+    each line showing its purchase-time snapshot instead of the live product
     """
     orders = Order.objects.filter(user=request.user).order_by('-created_at')
-    paginator = StandardResultsSetPagination()
+    if request.query_params.get('view') == 'summary':
+        orders = orders.prefetch_related(Prefetch('items', queryset=OrderItem.objects.order_by('pk')))
+        serializer_class = OrderSummarySerializer
+    else:
+        orders = order_queryset(request, orders)
+        serializer_class = OrderSerializer
+    paginator = get_paginator(request)
     page = paginator.paginate_queryset(orders, request)
-    serializer = OrderSerializer(page, many=True)
+    serializer = serializer_class(page, many=True, context={'request': request})
     return paginator.get_paginated_response(serializer.data)
 
 @api_view(['GET'])
@@ -380,14 +667,58 @@ def order_detail_view(request, order_number):
     Get order details
     """
     try:
-        order = Order.objects.get(order_number=order_number, user=request.user)
-        serializer = OrderSerializer(order)
+        order = order_queryset(request, Order.objects.all()).get(order_number=order_number, user=request.user)
+        serializer = OrderSerializer(order, context={'request': request})
         return Response(serializer.data)
     except Order.DoesNotExist:
         return Response({
             'error': 'Order not found'
         }, status=status.HTTP_404_NOT_FOUND)
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def checkout_view(request):
+    """
+    Place an order for everything in the user's cart
+    """
+    # A cart filled before logging in is ordered along with the account's
+    anonymous = anonymous_carts.adopt(request, request.user)
+    response = place_order_response(request)
+    if anonymous is not None:
+        anonymous_carts.discard(anonymous, response)
+    return response
+
+def place_order_response(request):
+    data = checkout.address_defaults(request.user)
+    data.update(request.data.items())
+    serializer = CheckoutSerializer(data=data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    address = dict(serializer.validated_data)
+    coupon_code = address.pop('coupon_code', None)
+    notes = address.pop('notes', '')
+    cart = Cart.objects.filter(user=request.user).first()
+    if cart is None:
+        return Response({
+            'error': 'Cart is empty'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        order = checkout.place_order(cart, request.user, address, coupon_code=coupon_code, notes=notes)
+    except checkout.CheckoutError as error:
+        if error.unavailable:
+            return Response({
+                'error': error.message,
+                'unavailable': error.unavailable
+            }, status=status.HTTP_409_CONFLICT)
+        return Response({
+            'error': error.message
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    order = order_queryset(request, Order.objects.all()).get(pk=order.pk)
+    return Response(OrderSerializer(order, context={'request': request}).data, status=status.HTTP_201_CREATED)
+
 @api_view(['POST'])
 def validate_coupon_view(request):
     """
@@ -414,6 +745,13 @@ def validate_coupon_view(request):
                 'error': f'Minimum order amount is R$ {coupon.minimum_amount:.2f}'
             }, status=status.HTTP_400_BAD_REQUEST)
         
+        try:
+            coupons.check(coupon, request.user)
+        except coupons.CouponUnavailable as error:
+            return Response({
+                'error': str(error)
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
         # Calculate discount
         if coupon.discount_type == 'percentage':
             discount = float(cart_total) * float(coupon.discount_value) / 100
@@ -450,25 +788,99 @@ def user_profile_view(request):
 @api_view(['GET'])
 def search_view(request):
     """
-    Advanced product search
+    Advanced product search, ranked by relevance with highlighted snippets
     """
-    query = request.query_params.get('q', '')
+    query = request.query_params.get('q', '').strip()
     if not query:
         return Response({
             'error': 'Search query is required'
         }, status=status.HTTP_400_BAD_REQUEST)
     
-    # Search in products
-    products = Product.objects.filter(
-        Q(name__icontains=query) |
-        Q(description__icontains=query) |
-        Q(short_description__icontains=query) |
-        Q(category__name__icontains=query) |
-        Q(brand__name__icontains=query),
-        status='active'
-    ).distinct()
-    
-    paginator = StandardResultsSetPagination()
-    page = paginator.paginate_queryset(products, request)
-    serializer = ProductListSerializer(page, many=True)
-    return paginator.get_paginated_response(serializer.data)
+    products = filter_products(
+        product_queryset(FieldSpec.from_request(request)), request.query_params
+    )
+    products = search.search_products(products, query)
+    
+    plan = fast_serializers.get_plan(ProductSearchResultSerializer, request)
+    paginator = get_paginator(request)
+    page = paginator.paginate_queryset(fast_serializers.project(products, plan), request)
+    response = paginator.get_paginated_response(plan.render(page, request))
+    if wants_facets(request):
+        response.data['facets'] = facets.compute_facets(products)
+    return response
+
+@api_view(['GET'])
+def suggest_view(request):
+    """
+    Typeahead suggestions for product, brand and category names
+    """
+    query = request.query_params.get('q', '')
+    try:
+        limit = min(max(int(request.query_params.get('limit', 8)), 1), suggest.MAX_RESULTS)
+    except ValueError:
+        limit = 8
+    
+    return Response({
+        'query': query,
+        'suggestions': suggest.suggest(query, limit),
+    })
+
+@api_view(['POST'])
+def batch_view(request):
+    """
+    Run several store API requests at once, authenticated as this request
+    """
+    try:
+        entries = batch.parse(request.data)
+    except batch.BatchError as error:
+        return Response({
+            'error': str(error)
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    results, responses = batch.run(request, entries)
+    response = Response({'responses': results})
+    for sub_response in responses:
+        for name, morsel in sub_response.cookies.items():
+            response.cookies[name] = morsel
+    return response
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def cache_stats_view(request):
+    """
+    Response cache hit rates for this server process
+    """
+    return Response(response_cache.stats())
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def session_stats_view(request):
+    """
+    Session writes per request for this server process
+    """
+    return Response(sessions.stats())
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+@renderer_classes([CSVExportRenderer, JSONLinesExportRenderer])
+def export_view(request, dataset):
+    """
+    Stream a whole dataset as CSV (default) or JSON Lines (?format=jsonl)
+    """
+    file_format = request.accepted_renderer.format
+    filters = {'status': request.query_params.get('status')}
+    if dataset == 'orders':
+        try:
+            for name in ('since', 'until'):
+                if request.query_params.get(name):
+                    filters[name] = exports.parse_moment(request.query_params[name])
+        except ValueError:
+            return Response({
+                'error': 'since and until must be ISO dates or datetimes'
+            }, status=status.HTTP_400_BAD_REQUEST)
+    
+    _, content_type = exports.ENCODERS[file_format]
+    response = StreamingHttpResponse(exports.export(dataset, file_format, **filters), content_type=content_type)
+    filename = f"{dataset}-{timezone.now():%Y%m%d-%H%M%S}.{file_format}"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -13,6 +13,7 @@ urlpatterns = [
     path('products/', views.ProductListView.as_view(), name='product_list'),
     path('products/<slug:slug>/', views.ProductDetailView.as_view(), name='product_detail'),
     path('search/', views.search_view, name='search'),
+    path('search/suggest/', views.suggest_view, name='search_suggest'),
     
     # Categories and Brands
     path('categories/', views.CategoryListView.as_view(), name='category_list'),
@@ -31,10 +32,22 @@ urlpatterns = [
     # Orders
     path('orders/', views.orders_view, name='orders'),
     path('orders/<str:order_number>/', views.order_detail_view, name='order_detail'),
+    path('checkout/', views.checkout_view, name='checkout'),
     
     # Coupons
     path('coupons/validate/', views.validate_coupon_view, name='validate_coupon'),
     
     # User Profile
     path('profile/', views.user_profile_view, name='user_profile'),
+    
+    # Several requests in one round trip
+    path('batch/', views.batch_view, name='batch'),
+    
+    # Exports (admin only)
+    path('exports/products/', views.export_view, {'dataset': 'products'}, name='export_products'),
+    path('exports/orders/', views.export_view, {'dataset': 'orders'}, name='export_orders'),
+    
+    # Monitoring
+    path('cache/stats/', views.cache_stats_view, name='cache_stats'),
+    path('sessions/stats/', views.session_stats_view, name='session_stats'),
 ]
\ No newline at end of file
@@ -0,0 +1,181 @@
+"""
+Cart mutations that keep the stored totals current.
+
+Each line stores its unit price and total. The cart stores the sums of its
+lines (total_amount, total_items), so reading a cart never walks its items.
+Every mutation goes through this module. It locks the line it changes and
+applies the difference to the cart as an F() delta in the same
+transaction, so concurrent changes to one cart add up instead of
+overwriting each other.
+
+Line prices are copied from the catalog whenever a line is written, and
+refresh_prices() updates them when a product or variant price changes.
+Checkout always prices from the catalog itself. merge() folds a visitor's
+session cart into their account's cart when they log in.
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
+from django.utils import timezone
+
+from . import inventory
+from .models import Cart, CartItem, Product, ProductVariant
+
+ZERO = Decimal('0.00')
+
+
+def _apply(cart_id, amount, quantity):
+    if amount or quantity:
+        Cart.objects.filter(pk=cart_id).update(
+            total_amount=F('total_amount') + amount,
+            total_items=F('total_items') + quantity,
+            updated_at=timezone.now(),
+        )
+
+
+def _locked(**lookups):
+    return CartItem.objects.select_for_update().select_related('product', 'variant').filter(**lookups).first()
+
+
+def _write(item, quantity):
+    """Save a line at a new quantity and move the cart totals by the difference"""
+    before_amount, before_quantity = (item.total_price, item.quantity) if item.pk else (ZERO, 0)
+    item.quantity = quantity
+    item.save()
+    _apply(item.cart_id, item.total_price - before_amount, quantity - before_quantity)
+    return item
+
+
+def add_item(cart, product, variant, quantity):
+    """Add units to a cart line, creating it if needed; returns (line, created)"""
+    with transaction.atomic():
+        item = _locked(cart=cart, product=product, variant=variant)
+        if item is None:
+            try:
+                with transaction.atomic():
+                    return _write(CartItem(cart=cart, product=product, variant=variant), quantity), True
+            except IntegrityError:
+                # A concurrent request created the line first, or the
+                # quantity broke a constraint
+                item = _locked(cart=cart, product=product, variant=variant)
+                if item is None:
+                    raise
+        return _write(item, item.quantity + quantity), False
+
+
+def add_items(cart, lines):
+    """
+    add_item() for many (product, variant, quantity) lines at once: new
+    lines are inserted and existing ones updated in bulk, then the cart's
+    totals are recomputed. Returns the lines written.
+    """
+    quantities = {}
+    for product, variant, quantity in lines:
+        key = (product, variant)
+        quantities[key] = quantities.get(key, 0) + quantity
+    if not quantities:
+        return []
+    with transaction.atomic():
+        existing = {
+            (item.product_id, item.variant_id): item
+            for item in CartItem.objects.select_for_update().filter(
+                cart=cart, product_id__in={product.pk for product, _ in quantities}
+            )
+        }
+        created, updated = [], []
+        for (product, variant), quantity in quantities.items():
+            item = existing.get((product.pk, variant.pk if variant else None))
+            if item is None:
+                item = CartItem(cart=cart, quantity=quantity)
+                created.append(item)
+            else:
+                item.quantity += quantity
+                updated.append(item)
+            item.product, item.variant = product, variant
+            # bulk writes skip save(), which prices the line
+            item.unit_price = item.current_unit_price
+            item.total_price = item.unit_price * item.quantity
+        CartItem.objects.bulk_create(created)
+        if updated:
+            CartItem.objects.bulk_update(updated, ['quantity', 'unit_price', 'total_price'])
+        recompute(Cart.objects.filter(pk=cart.pk))
+    return created + updated
+
+
+def set_quantity(item, quantity):
+    """Change a line's quantity; returns the line, or None if it is gone"""
+    with transaction.atomic():
+        item = _locked(pk=item.pk)
+        if item is None:
+            return None
+        return _write(item, quantity)
+
+
+def remove_item(item):
+    """Delete a line; returns whether it still existed"""
+    with transaction.atomic():
+        item = _locked(pk=item.pk)
+        if item is None:
+            return False
+        CartItem.objects.filter(pk=item.pk).delete()
+        _apply(item.cart_id, -item.total_price, -item.quantity)
+    return True
+
+
+def merge(source, target):
+    """
+    Move every line of source into target and delete source. Lines for the
+    same product and variant are added together. Takes the same number of
+    queries however big the carts are.
+    """
+    with transaction.atomic():
+        lines = list(CartItem.objects.select_for_update().filter(cart=source).values_list(
+            'pk', 'product_id', 'variant_id', 'quantity'
+        ))
+        if lines:
+            existing = {
+                (item.product_id, item.variant_id): item
+                for item in CartItem.objects.select_for_update().filter(
+                    cart=target, product_id__in={line[1] for line in lines}
+                )
+            }
+            moved, merged = [], []
+            for pk, product_id, variant_id, quantity in lines:
+                item = existing.get((product_id, variant_id))
+                if item is None:
+                    moved.append(pk)
+                else:
+                    item.quantity += quantity
+                    item.total_price = item.unit_price * item.quantity
+                    merged.append(item)
+            if merged:
+                CartItem.objects.bulk_update(merged, ['quantity', 'total_price'])
+            if moved:
+                CartItem.objects.filter(pk__in=moved).update(cart=target)
+            inventory.transfer(source, target)
+        source.delete()
+        recompute(Cart.objects.filter(pk=target.pk))
+
+
+def recompute(carts):
+    """Set the stored totals of a cart queryset from its lines"""
+    lines = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    return carts.update(
+        total_amount=Coalesce(Subquery(lines.annotate(amount=Sum('total_price')).values('amount')), Value(ZERO)),
+        total_items=Coalesce(Subquery(lines.annotate(count=Sum('quantity')).values('count')), Value(0)),
+    )
+
+
+def refresh_prices(product_ids):
+    """Re-price the cart lines of these products and the carts holding them"""
+    price = Coalesce(
+        NullIf(Subquery(ProductVariant.objects.filter(pk=OuterRef('variant_id')).values('price')), Value(0)),
+        Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')),
+    )
+    items = CartItem.objects.filter(product_id__in=product_ids)
+    changed = items.update(unit_price=price, total_price=price * F('quantity'))
+    if changed:
+        recompute(Cart.objects.filter(pk__in=items.values('cart_id')))
+    return changed
@@ -0,0 +1,487 @@
+"""
+Streaming bulk import of supplier catalogs from CSV or JSONL.
+
+Each row describes one product, keyed by sku. A row that also carries a
+variant_sku adds or updates one variant of that product, so a product with
+several variants simply appears on several rows:
+
+    sku,name,price,category,brand,variant_sku,variant_price,attributes
+    TEE-1,Basic Tee,19.90,Apparel > Tees,Acme,TEE-1-RED-M,,Color=Red;Size=M
+
+category is a "Parent > Child" path and attributes a "Name=Value;..."
+string (or an object in JSONL). Any other Product field can be given as a
+column of the same name; columns left out keep their current value.
+
+Rows are read lazily and written in batches. A batch costs a fixed number
+of queries whatever its size, and only lookup tables for categories,
+brands and attribute values are kept between batches, so memory stays
+flat however long the file is. Bulk writes skip model signals, so the
+search index is maintained per batch and the other caches are reset
+once at the end.
+"""
+import csv
+import json
+import sys
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.text import slugify
+
+from . import carts, response_cache, search, suggest
+from .models import (
+    Brand, Category, Product, ProductAttribute, ProductAttributeValue, ProductVariant,
+)
+
+CATEGORY_SEPARATOR = '>'
+# Room left at the end of a slug for a "-<n>" suffix
+SLUG_SUFFIX_ROOM = 8
+# OR-ed range lookups per query, well under SQLite's expression depth limit
+SLUG_RANGE_CHUNK = 200
+# Rejected rows whose messages are kept for the report
+MAX_ERRORS = 100
+
+
+def _text(value):
+    return str(value).strip()
+
+
+def _decimal(value):
+    try:
+        return Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f'not a number: {value!r}')
+
+
+def _int(value):
+    return int(str(value).strip())
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def _status(value):
+    value = str(value).strip().lower()
+    if value not in dict(Product.PRODUCT_STATUS_CHOICES):
+        raise ValueError(f'unknown status {value!r}')
+    return value
+
+
+# Product columns that map straight onto model fields
+PRODUCT_FIELDS = {
+    'name': _text,
+    'description': _text,
+    'short_description': _text,
+    'price': _decimal,
+    'compare_at_price': _decimal,
+    'cost_price': _decimal,
+    'stock': _int,
+    'low_stock_threshold': _int,
+    'weight': _decimal,
+    'dimensions': _text,
+    'status': _status,
+    'is_featured': _bool,
+    'allow_backorders': _bool,
+    'track_inventory': _bool,
+    'tax_class': _text,
+    'meta_title': _text,
+    'meta_description': _text,
+    'image': _text,
+}
+NULLABLE_FIELDS = {'compare_at_price', 'cost_price', 'weight', 'image'}
+
+VARIANT_FIELDS = {
+    'variant_price': ('price', _decimal),
+    'variant_stock': ('stock', _int),
+    'variant_image': ('image', _text),
+}
+
+
+class RowError(ValueError):
+    pass
+
+
+def read_rows(path, format=None):
+    """Yield (line number, raw row) pairs without loading the file"""
+    if format is None:
+        format = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+    with open(path, newline='', encoding='utf-8-sig') as handle:
+        if format == 'csv':
+            csv.field_size_limit(sys.maxsize)
+            for line_number, row in enumerate(csv.DictReader(handle), start=2):
+                yield line_number, row
+        else:
+            for line_number, line in enumerate(handle, start=1):
+                if line.strip():
+                    yield line_number, line
+
+
+def parse_attributes(value):
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        pairs = value.items()
+    else:
+        pairs = [item.split('=', 1) for item in str(value).split(';') if item.strip()]
+        if any(len(pair) != 2 for pair in pairs):
+            raise RowError(f'attributes must look like "Name=Value;Name=Value", got {value!r}')
+    return {_text(name): _text(attribute_value) for name, attribute_value in pairs}
+
+
+def parse_row(raw):
+    """Turn a raw CSV dict or JSONL line into the parts of one product (and variant)"""
+    from_csv = not isinstance(raw, str)
+    if not from_csv:
+        try:
+            raw = json.loads(raw)
+        except ValueError as error:
+            raise RowError(f'invalid JSON: {error}')
+        if not isinstance(raw, dict):
+            raise RowError('each JSONL line must be an object')
+
+    def convert(column, converter, nullable):
+        """(given, value): empty CSV cells are "not given", JSON null or "" clears"""
+        value = raw.get(column)
+        if value is None and not (column in raw and nullable):
+            return False, None
+        if value in ('', None):
+            if from_csv:
+                return False, None
+            if nullable:
+                return True, None
+        try:
+            return True, converter(value)
+        except ValueError as error:
+            raise RowError(f'{column}: {error}')
+
+    fields = {}
+    for name, converter in PRODUCT_FIELDS.items():
+        given, value = convert(name, converter, name in NULLABLE_FIELDS)
+        if given:
+            fields[name] = value
+
+    category = raw.get('category')
+    if category:
+        category = tuple(part.strip() for part in str(category).split(CATEGORY_SEPARATOR) if part.strip())
+    brand = _text(raw['brand']) if raw.get('brand') else None
+
+    variant = None
+    if raw.get('variant_sku'):
+        variant = {'sku': _text(raw['variant_sku']), 'fields': {}}
+        for column, (name, converter) in VARIANT_FIELDS.items():
+            given, value = convert(column, converter, name != 'stock')
+            if given:
+                variant['fields'][name] = value
+        variant['attributes'] = parse_attributes(raw.get('attributes'))
+
+    return {
+        'sku': _text(raw['sku']) if raw.get('sku') else None,
+        'slug': slugify(raw['slug']) if raw.get('slug') else None,
+        'fields': fields,
+        'category': category or None,
+        'brand': brand,
+        'variant': variant,
+    }
+
+
+def allocate_slugs(model, bases, max_length=50):
+    """
+    Unique slugs for a list of base slugs, numbering repeats "-2", "-3"...
+    against both the table and each other. A generated slug never takes a
+    base that comes later in the list. Costs one lookup, plus one range
+    query per SLUG_RANGE_CHUNK clashing bases.
+    """
+    bases = [(base or model._meta.model_name)[:max_length] for base in bases]
+    pending = set(bases)
+    taken = set(model.objects.filter(slug__in=pending).values_list('slug', flat=True))
+    counts = Counter(bases)
+    stems = {base: base[:max_length - SLUG_SUFFIX_ROOM] for base in pending}
+    stem_set = set(stems.values())
+
+    next_suffix = {}
+    scanned = set()
+
+    def scan(stem_list):
+        """Note the numbered slugs the table already has for these stems"""
+        for start in range(0, len(stem_list), SLUG_RANGE_CHUNK):
+            chunk = stem_list[start:start + SLUG_RANGE_CHUNK]
+            # Every "<stem>-..." slug sorts in [stem + '-', stem + '.'), an index range scan
+            query = Q()
+            for stem in chunk:
+                query |= Q(slug__gte=f'{stem}-', slug__lt=f'{stem}.')
+            for slug in model.objects.filter(query).values_list('slug', flat=True):
+                taken.add(slug)
+                stem, _, number = slug.rpartition('-')
+                if number.isdigit() and stem in stem_set:
+                    next_suffix[stem] = max(next_suffix.get(stem, 1), int(number))
+            scanned.update(chunk)
+
+    scan(sorted({stems[base] for base in pending if base in taken or counts[base] > 1}))
+
+    slugs = []
+    used = set()
+    for base in bases:
+        if base in taken or base in used:
+            stem = stems[base]
+            if stem not in scanned:
+                # Only reachable when an earlier generated slug took this base
+                scan([stem])
+            number = next_suffix.get(stem, 1)
+            candidate = base
+            while candidate in taken or candidate in used or candidate in pending:
+                number += 1
+                candidate = f'{stem}-{number}'
+            next_suffix[stem] = number
+            base = candidate
+        used.add(base)
+        slugs.append(base)
+    return slugs
+
+
+def allocate_skus(count, make=lambda: f"SKU-{uuid.uuid4().hex[:8].upper()}"):
+    """New SKUs in the Product.save format, checked against the table in bulk"""
+    skus = set()
+    while len(skus) < count:
+        candidates = {make() for _ in range(count - len(skus))} - skus
+        taken = set(Product.objects.filter(sku__in=candidates).values_list('sku', flat=True))
+        skus |= candidates - taken
+    return list(skus)
+
+
+class CatalogImporter:
+    def __init__(self, batch_size=1000, on_progress=None, max_errors=MAX_ERRORS):
+        self.batch_size = batch_size
+        self.on_progress = on_progress
+        self.stats = Counter()
+        # The first max_errors rejected rows; stats['errors'] counts them all
+        self.max_errors = max_errors
+        self.errors = []
+        # Small lookup tables kept for the whole run
+        self.category_ids = {}
+        self.brand_ids = {}
+        self.attribute_ids = {}
+        self.attribute_value_ids = {}
+
+    def run(self, rows):
+        started = time.monotonic()
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            with transaction.atomic():
+                self.import_batch(batch)
+            if self.on_progress:
+                self.on_progress(self.stats, time.monotonic() - started)
+        self.finish()
+        self.stats['seconds'] = time.monotonic() - started
+        return self.stats
+
+    def error(self, line_number, message):
+        self.stats['errors'] += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line_number, str(message)))
+
+    def import_batch(self, batch):
+        self.stats['rows'] += len(batch)
+        products = {}
+        variants = {}
+        for line_number, raw in batch:
+            try:
+                row = parse_row(raw)
+            except RowError as error:
+                self.error(line_number, error)
+                continue
+            # Rows without a sku each become a new product
+            key = row['sku'] or ('line', line_number)
+            entry = products.setdefault(key, {'line': line_number, 'fields': {}})
+            entry['line'] = line_number
+            entry['fields'].update(row['fields'])
+            for part in ('category', 'brand', 'slug'):
+                if row[part]:
+                    entry[part] = row[part]
+            if row['variant']:
+                variants[row['variant']['sku']] = dict(row['variant'], product=key, line=line_number)
+
+        product_ids = self.save_products(products)
+        self.save_variants(variants, product_ids)
+        search.index_products(product_ids.values())
+
+    def save_products(self, products):
+        """Upsert the batch's products; returns {key: product id}"""
+        for entry in products.values():
+            if 'category' in entry:
+                entry['category_id'] = self.category_id(entry['category'])
+            if 'brand' in entry:
+                entry['brand_id'] = self.brand_id(entry['brand'])
+
+        skus = [key for key in products if isinstance(key, str)]
+        existing = Product.objects.in_bulk(skus, field_name='sku')
+        now = timezone.now()
+        created = []
+        updated = []
+        update_fields = set()
+
+        for key, entry in products.items():
+            product = existing.get(key)
+            relations = {name: entry[name] for name in ('category_id', 'brand_id') if name in entry}
+            if product is None:
+                missing = [name for name in ('name', 'price') if name not in entry['fields']]
+                if 'category_id' not in relations:
+                    missing.append('category')
+                if missing:
+                    self.error(entry['line'], f'new product needs {", ".join(missing)}')
+                    continue
+                fields = dict(entry['fields'])
+                fields.setdefault('description', '')
+                product = Product(sku=key if isinstance(key, str) else '', **fields, **relations)
+                product.import_key = key
+                product.slug = entry.get('slug') or slugify(product.name)
+                created.append(product)
+            else:
+                for name, value in {**entry['fields'], **relations}.items():
+                    setattr(product, name, value)
+                update_fields.update(entry['fields'])
+                update_fields.update(name[:-3] for name in relations)
+                product.updated_at = now
+                product.import_key = key
+                updated.append(product)
+
+        if created:
+            for product, slug in zip(created, allocate_slugs(Product, [product.slug for product in created])):
+                product.slug = slug
+            unkeyed = [product for product in created if not product.sku]
+            for product, sku in zip(unkeyed, allocate_skus(len(unkeyed))):
+                product.sku = sku
+            Product.objects.bulk_create(created, batch_size=self.batch_size)
+            if any(product.pk is None for product in created):
+                # Backends that cannot return ids from a bulk insert
+                ids = dict(Product.objects.filter(sku__in=[product.sku for product in created]).values_list('sku', 'id'))
+                for product in created:
+                    product.pk = ids[product.sku]
+        if updated:
+            Product.objects.bulk_update(updated, sorted(update_fields | {'updated_at'}), batch_size=self.batch_size)
+            if 'price' in update_fields:
+                carts.refresh_prices([product.pk for product in updated])
+
+        self.stats['products_created'] += len(created)
+        self.stats['products_updated'] += len(updated)
+        self.stats['images'] += sum(1 for product in created + updated if product.image)
+        return {product.import_key: product.pk for product in created + updated}
+
+    def save_variants(self, variants, product_ids):
+        variants = {sku: variant for sku, variant in variants.items() if variant['product'] in product_ids}
+        if not variants:
+            return
+        existing = ProductVariant.objects.in_bulk(list(variants), field_name='sku')
+        created = []
+        updated = []
+        update_fields = {'product'}
+
+        for sku, variant in variants.items():
+            instance = existing.get(sku)
+            if instance is None:
+                instance = ProductVariant(sku=sku, **variant['fields'])
+                created.append(instance)
+            else:
+                for name, value in variant['fields'].items():
+                    setattr(instance, name, value)
+                update_fields.update(variant['fields'])
+                updated.append(instance)
+            instance.product_id = product_ids[variant['product']]
+
+        if created:
+            ProductVariant.objects.bulk_create(created, batch_size=self.batch_size)
+            if any(instance.pk is None for instance in created):
+                ids = dict(ProductVariant.objects.filter(sku__in=[instance.sku for instance in created]).values_list('sku', 'id'))
+                for instance in created:
+                    instance.pk = ids[instance.sku]
+        if updated:
+            ProductVariant.objects.bulk_update(updated, sorted(update_fields), batch_size=self.batch_size)
+            if 'price' in update_fields:
+                carts.refresh_prices({instance.product_id for instance in updated})
+
+        # Attributes given on a row replace the variant's current ones
+        instances = {instance.sku: instance for instance in created + updated}
+        with_attributes = {sku: variant['attributes'] for sku, variant in variants.items() if variant['attributes']}
+        value_ids = self.attribute_value_ids_for(with_attributes.values())
+        Through = ProductVariant.attributes.through
+        Through.objects.filter(productvariant_id__in=[instances[sku].pk for sku in with_attributes]).delete()
+        Through.objects.bulk_create([
+            Through(productvariant_id=instances[sku].pk, productattributevalue_id=value_ids[(name, value)])
+            for sku, attributes in with_attributes.items()
+            for name, value in attributes.items()
+        ], batch_size=self.batch_size)
+
+        self.stats['variants_created'] += len(created)
+        self.stats['variants_updated'] += len(updated)
+
+    def category_id(self, path):
+        if path not in self.category_ids:
+            parent_id = self.category_id(path[:-1]) if len(path) > 1 else None
+            category = Category.objects.filter(name=path[-1], parent_id=parent_id).values_list('id', flat=True).first()
+            if category is None:
+                slug = allocate_slugs(Category, [slugify(path[-1])])[0]
+                category = Category.objects.create(name=path[-1], slug=slug, parent_id=parent_id).pk
+                self.stats['categories_created'] += 1
+            self.category_ids[path] = category
+        return self.category_ids[path]
+
+    def brand_id(self, name):
+        if name not in self.brand_ids:
+            brand = Brand.objects.filter(name=name).values_list('id', flat=True).first()
+            if brand is None:
+                slug = allocate_slugs(Brand, [slugify(name)])[0]
+                brand = Brand.objects.create(name=name, slug=slug).pk
+                self.stats['brands_created'] += 1
+            self.brand_ids[name] = brand
+        return self.brand_ids[name]
+
+    def attribute_id(self, name):
+        if name not in self.attribute_ids:
+            attribute = ProductAttribute.objects.filter(name=name).values_list('id', flat=True).first()
+            if attribute is None:
+                slug = allocate_slugs(ProductAttribute, [slugify(name)])[0]
+                attribute = ProductAttribute.objects.create(name=name, slug=slug).pk
+            self.attribute_ids[name] = attribute
+        return self.attribute_ids[name]
+
+    def attribute_value_ids_for(self, attribute_maps):
+        """{(attribute name, value): id} for every pair, creating missing values in bulk"""
+        pairs = {(name, value) for attributes in attribute_maps for name, value in attributes.items()}
+        keys = {pair: (self.attribute_id(pair[0]), pair[1]) for pair in pairs}
+        missing = {key for key in keys.values() if key not in self.attribute_value_ids}
+        if missing:
+            for attribute_id, value, value_id in ProductAttributeValue.objects.filter(
+                attribute_id__in={attribute_id for attribute_id, _ in missing},
+                value__in={value for _, value in missing},
+            ).values_list('attribute_id', 'value', 'id'):
+                self.attribute_value_ids[(attribute_id, value)] = value_id
+            new = [key for key in missing if key not in self.attribute_value_ids]
+            if new:
+                ProductAttributeValue.objects.bulk_create([
+                    ProductAttributeValue(attribute_id=attribute_id, value=value, slug=slugify(value))
+                    for attribute_id, value in new
+                ])
+                for attribute_id, value, value_id in ProductAttributeValue.objects.filter(
+                    attribute_id__in={attribute_id for attribute_id, _ in new},
+                    value__in={value for _, value in new},
+                ).values_list('attribute_id', 'value', 'id'):
+                    self.attribute_value_ids[(attribute_id, value)] = value_id
+        return {pair: self.attribute_value_ids[key] for pair, key in keys.items()}
+
+    def finish(self):
+        if not (self.stats['products_created'] or self.stats['products_updated']):
+            return
+        # Every cached catalog response (detail pages included) carries one
+        # of these tags, so this drops them all in one write
+        response_cache.invalidate(response_cache.PRODUCTS, response_cache.CATEGORIES, response_cache.BRANDS)
+        suggest.invalidate()
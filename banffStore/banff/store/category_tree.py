@@ -0,0 +1,124 @@
+"""
+In-process index of the category hierarchy.
+
+The whole tree is loaded with a single query and kept in memory until a
+Category is saved or deleted, which moves a version stored in the cache.
+Every lookup reads that version, so every process rebuilds on its next
+lookup. That only reaches other processes through a cache they share
+(REDIS_URL); on the per-process LocMemCache the other workers keep their
+old tree, which is why `check --deploy` rejects it (see store.checks).
+"""
+import threading
+import time
+
+from django.core.cache import cache
+
+from .models import Category
+
+VERSION_KEY = 'store:category_tree:version'
+
+_lock = threading.Lock()
+_tree = None
+
+
+class CategoryTree:
+    def __init__(self, categories, version):
+        self.version = version
+        self.by_id = {category.id: category for category in categories}
+        self.by_slug = {category.slug: category for category in categories}
+        self._children = {category.id: [] for category in categories}
+        self._roots = []
+        self._memo = {}
+
+        # Categories arrive in Meta.ordering, so sibling lists stay sorted
+        for category in categories:
+            if not category.is_active:
+                continue
+            if category.parent_id is None:
+                self._roots.append(category)
+            elif category.parent_id in self._children:
+                self._children[category.parent_id].append(category)
+
+        self._descendants = {}
+        for category in categories:
+            if category.is_active:
+                self._descendants[category.id] = frozenset(self._collect(category.id))
+
+    def _collect(self, category_id):
+        seen = set()
+        stack = [category_id]
+        while stack:
+            current = stack.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            stack.extend(child.id for child in self._children[current])
+        return seen
+
+    def roots(self):
+        """Active top-level categories"""
+        return self._roots
+
+    def children(self, category_id):
+        """Active direct children of a category"""
+        return self._children.get(category_id, [])
+
+    def descendant_ids(self, slug):
+        """
+        Ids of an active category and all of its active descendants, or
+        None when the slug is unknown or inactive
+        """
+        category = self.by_slug.get(slug)
+        if category is None:
+            return None
+        return self._descendants.get(category.id)
+
+    def path(self, category_id):
+        """Names from the root down to a category, e.g. ['Apparel', 'Tees']"""
+        names = []
+        seen = set()
+        category = self.by_id.get(category_id)
+        while category is not None and category.id not in seen:
+            seen.add(category.id)
+            names.append(category.name)
+            category = self.by_id.get(category.parent_id)
+        return names[::-1]
+
+    def memoize(self, key, factory):
+        """Cache data derived from this version of the tree"""
+        try:
+            return self._memo[key]
+        except KeyError:
+            value = self._memo[key] = factory()
+            return value
+
+
+def get_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # A timestamp rather than 0, so a version the cache lost can never
+        # line up with the one an older tree was built from
+        cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def get_tree():
+    """Return the current tree, rebuilding it if a category changed"""
+    global _tree
+    version = get_version()
+    tree = _tree
+    if tree is not None and tree.version == version:
+        return tree
+
+    with _lock:
+        if _tree is None or _tree.version != version:
+            _tree = CategoryTree(list(Category.objects.all()), version)
+        return _tree
+
+
+def invalidate():
+    """Move the tree version so all processes rebuild"""
+    global _tree
+    cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+    _tree = None
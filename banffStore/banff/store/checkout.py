@@ -0,0 +1,206 @@
+"""
+Turning a cart into an order.
+
+place_order() converts a cart in one transaction: the cart lines are taken,
+the order and all of its items are inserted, the coupon is redeemed (see
+store.coupons) and stock is decremented. The lines are only taken with the
+quantities they were priced at, so a line edited in between fails the
+checkout instead of being ordered stale. Nothing is read and then written
+back. Stock changes through conditional UPDATEs:
+
+    UPDATE product SET stock = stock - 3 WHERE id = 7 AND stock >= 3
+
+Two checkouts racing for the last unit can't both win. When a statement
+matches no row, the whole order rolls back. Units the cart holds (see
+store.inventory) count as available to it and are taken off reserved in
+the same statement. Each order item keeps a snapshot of what was bought
+(see store.order_snapshots).
+
+The contended rows (coupon shards and stock) are written last, stock in
+primary key order. Each transaction holds their locks only for the moment before it
+commits. Checkouts that share several products always lock them in the
+same order, so they can't deadlock.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from . import carts, coupons, inventory, order_snapshots, response_cache
+from .models import Cart, Coupon, Order, OrderItem, Product, ProductVariant, UserProfile
+
+CENT = Decimal('0.01')
+
+ADDRESS_FIELDS = [
+    'first_name', 'last_name', 'address_line1', 'address_line2',
+    'city', 'state', 'zip_code', 'country',
+]
+
+
+class CheckoutError(Exception):
+    """The cart can't be ordered as it is; nothing was written"""
+    def __init__(self, message, unavailable=None):
+        super().__init__(message)
+        self.message = message
+        self.unavailable = unavailable or []
+
+
+def address_defaults(user):
+    """Billing fields prefilled from the account and its default address"""
+    defaults = {
+        'billing_first_name': user.first_name,
+        'billing_last_name': user.last_name,
+        'billing_email': user.email,
+    }
+    profile = UserProfile.objects.filter(user=user).first()
+    if profile is not None:
+        defaults['billing_phone'] = profile.phone
+        for name in ADDRESS_FIELDS[2:]:
+            defaults[f'billing_{name}'] = getattr(profile, f'default_{name}')
+    return {name: value for name, value in defaults.items() if value}
+
+
+def discount_for(coupon, subtotal):
+    if coupon.discount_type == 'percentage':
+        discount = (subtotal * coupon.discount_value / 100).quantize(CENT)
+    else:
+        discount = coupon.discount_value
+    return min(discount, subtotal)
+
+
+def get_coupon(code, subtotal, user):
+    """The coupon for a code, if it currently applies to this subtotal and user"""
+    coupon = Coupon.objects.filter(code=code.upper()).first()
+    if coupon is None:
+        raise CheckoutError('Invalid coupon code')
+    if not coupon.is_valid:
+        raise CheckoutError('Coupon is not valid or has expired')
+    if coupon.minimum_amount and subtotal < coupon.minimum_amount:
+        raise CheckoutError(f'Minimum order amount is R$ {coupon.minimum_amount:.2f}')
+    try:
+        coupons.check(coupon, user)
+    except coupons.CouponUnavailable as error:
+        raise CheckoutError(str(error))
+    return coupon
+
+
+def stock_demand(lines):
+    """Units to take per tracked product and variant, in lock order"""
+    products, variants = {}, {}
+    for line in lines:
+        if not line.product.track_inventory:
+            continue
+        if line.variant_id:
+            variants[line.variant_id] = variants.get(line.variant_id, 0) + line.quantity
+        else:
+            products[line.product_id] = products.get(line.product_id, 0) + line.quantity
+    return sorted(products.items()), sorted(variants.items())
+
+
+def unavailable_lines(lines):
+    """Lines that can't be ordered as the cart was read, for a fast failure"""
+    unavailable = []
+    for line in lines:
+        product, variant = line.product, line.variant
+        if product.status != 'active':
+            available = 0
+        elif not product.track_inventory or product.allow_backorders:
+            continue
+        else:
+            available = variant.stock if variant is not None else product.stock
+            if available >= line.quantity:
+                continue
+        unavailable.append({
+            'product_id': line.product_id, 'variant_id': line.variant_id,
+            'requested': line.quantity, 'available': available,
+        })
+    return unavailable
+
+
+def take_stock(model, demand, product_lookup, held):
+    """Decrement stock row by row, failing on the first row that is short"""
+    kind = 'variant' if model is ProductVariant else 'product'
+    for pk, quantity in demand:
+        own = held.pop((kind, pk), 0)
+        taken = model.objects.filter(
+            Q(stock__gte=F('reserved') - own + quantity) | Q(**{product_lookup + 'allow_backorders': True}),
+            pk=pk,
+        ).update(
+            stock=Greatest(F('stock') - quantity, 0),
+            reserved=Greatest(F('reserved') - own, 0),
+        )
+        if not taken:
+            stock, reserved = model.objects.filter(pk=pk).values_list('stock', 'reserved').first() or (0, 0)
+            raise CheckoutError('Not enough stock', unavailable=[
+                {f'{kind}_id': pk, 'requested': quantity, 'available': max(stock - reserved + own, 0)}
+            ])
+
+
+def place_order(cart, user, address, coupon_code=None, notes=''):
+    """Order everything in the cart and empty it, all or nothing"""
+    lines = list(
+        cart.items.select_related('product', 'variant')
+        .prefetch_related('variant__attributes__attribute').order_by('pk')
+    )
+    if not lines:
+        raise CheckoutError('Cart is empty')
+    unavailable = unavailable_lines(lines)
+    if unavailable:
+        raise CheckoutError('Some items are not available in the requested quantity', unavailable)
+
+    subtotal = sum((line.current_unit_price * line.quantity for line in lines), Decimal('0.00'))
+    coupon = get_coupon(coupon_code, subtotal, user) if coupon_code else None
+    discount = discount_for(coupon, subtotal) if coupon else Decimal('0.00')
+    products, variants = stock_demand(lines)
+
+    with transaction.atomic():
+        # Take the lines exactly as they were read and priced. A line changed
+        # or removed since then doesn't match, so the order is refused rather
+        # than placed for stale quantities. Taking them first also makes a
+        # repeated submit of the same cart wait here for the first one and
+        # then find nothing left to order
+        read = Q()
+        for line in lines:
+            read |= Q(pk=line.pk, quantity=line.quantity, variant_id=line.variant_id)
+        taken = cart.items.filter(read).delete()[0]
+        if taken != len(lines):
+            raise CheckoutError('The cart changed during checkout, please review it')
+        carts.recompute(Cart.objects.filter(pk=cart.pk))
+
+        order = Order(
+            user=user, subtotal=subtotal, discount_amount=discount,
+            total_amount=subtotal - discount, notes=notes, **address
+        )
+        order.save()
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order, product_id=line.product_id, variant_id=line.variant_id,
+                quantity=line.quantity, unit_price=line.current_unit_price,
+                total_price=line.current_unit_price * line.quantity,
+                **order_snapshots.snapshot(line.product, line.variant),
+            )
+            for line in lines
+        ])
+
+        held = inventory.claim(cart)
+        if coupon is not None:
+            try:
+                coupons.redeem(coupon, user, order)
+            except coupons.CouponUnavailable as error:
+                raise CheckoutError(str(error))
+        take_stock(Product, products, '', held)
+        take_stock(ProductVariant, variants, 'product__', held)
+        # Holds left for lines that weren't ordered
+        inventory.unreserve({
+            (ProductVariant if kind == 'variant' else Product, pk): quantity
+            for (kind, pk), quantity in held.items()
+        })
+
+        # Stock is shown in listings, and queryset updates skip the signals
+        changed = {product_id for product_id, _ in products}
+        changed.update(line.product_id for line in lines if line.variant_id and line.product.track_inventory)
+        if changed:
+            tags = [response_cache.PRODUCTS] + [response_cache.product_tag(pk) for pk in sorted(changed)]
+            transaction.on_commit(lambda: response_cache.invalidate(*tags))
+    return order
@@ -0,0 +1,31 @@
+"""
+System checks for the deployment settings the store relies on.
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+# Cache backends whose data never leaves the process that wrote it
+PROCESS_LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Response cache tags, the category tree and autocomplete versions and
+    cache-backed sessions reach other server processes only through the
+    default cache
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Error(
+        'The default cache is local to each process, so catalog changes only '
+        'invalidate cached responses, the category tree and autocomplete in the '
+        'process that made them.',
+        hint='Set REDIS_URL, or another cache every server process shares. A '
+             'deployment with a single server process may silence store.E001.',
+        id='store.E001',
+    )]
@@ -0,0 +1,141 @@
+"""
+Coupon redemption without a single hot row.
+
+Every use of a coupon is a CouponRedemption row tied to its order. A
+limited coupon's remaining uses are split across SHARDS CouponShard rows.
+A redemption takes one use from a random non-empty shard with a
+conditional UPDATE, and moves on to another shard only if that one ran
+dry meanwhile. Concurrent checkouts spread over SHARDS rows instead of
+queueing on one. The shards together never hand out more than
+usage_limit uses.
+
+Per-user limits use the unique (coupon, user, sequence) index. A user's
+nth use claims slot n, so two concurrent orders by the same user can't
+both take the last slot.
+
+Checkouts never write the coupon row itself. Coupon.used_count catches up
+in batches: reconcile() adds the redemptions not yet counted and marks
+them counted. Uses are always the sum of used_count and the uncounted
+redemptions.
+"""
+import random
+from collections import Counter
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Max, Q, Sum
+
+from .models import Coupon, CouponRedemption, CouponShard
+
+SHARDS = 16
+
+
+class CouponUnavailable(Exception):
+    """The coupon can't be used for this order"""
+
+
+def used(coupon):
+    """Uses so far, read in one statement so a concurrent reconcile can't be half seen"""
+    return Coupon.objects.filter(pk=coupon.pk).annotate(
+        uncounted=Count('redemptions', filter=Q(redemptions__counted=False))
+    ).values_list(F('used_count') + F('uncounted'), flat=True).first() or 0
+
+
+def allocate(coupon):
+    """Split a coupon's remaining uses evenly across its shards"""
+    with transaction.atomic():
+        shards = list(CouponShard.objects.select_for_update().filter(coupon=coupon).order_by('index'))
+        if coupon.usage_limit is None:
+            if shards:
+                CouponShard.objects.filter(coupon=coupon).delete()
+            return
+        # Shards are locked, so every use counted in them is committed here
+        base, extra = divmod(max(coupon.usage_limit - used(coupon), 0), SHARDS)
+        sizes = [base + (index < extra) for index in range(SHARDS)]
+        if shards:
+            for shard in shards:
+                shard.remaining = sizes[shard.index]
+            CouponShard.objects.bulk_update(shards, ['remaining'])
+        else:
+            CouponShard.objects.bulk_create([
+                CouponShard(coupon=coupon, index=index, remaining=size) for index, size in enumerate(sizes)
+            ])
+
+
+def remaining(coupon):
+    """Uses left, or None for an unlimited coupon"""
+    if coupon.usage_limit is None:
+        return None
+    total = CouponShard.objects.filter(coupon=coupon).aggregate(total=Sum('remaining'))['total']
+    if total is None:
+        return max(coupon.usage_limit - used(coupon), 0)
+    return total
+
+
+def check(coupon, user):
+    """Raise CouponUnavailable if the coupon is already used up, for all or for this user"""
+    if coupon.usage_limit is not None and not remaining(coupon):
+        raise CouponUnavailable('Coupon is not valid or has expired')
+    if coupon.usage_limit_per_user is not None and user.is_authenticated:
+        last = CouponRedemption.objects.filter(coupon=coupon, user=user).aggregate(last=Max('sequence'))['last']
+        if (last or 0) >= coupon.usage_limit_per_user:
+            raise CouponUnavailable('You have already used this coupon')
+
+
+def _take_use(coupon):
+    indexes = list(CouponShard.objects.filter(coupon=coupon, remaining__gt=0).values_list('index', flat=True))
+    if not indexes and not CouponShard.objects.filter(coupon=coupon).exists():
+        # Limited without shards, e.g. created by a queryset update
+        try:
+            with transaction.atomic():
+                allocate(coupon)
+        except IntegrityError:
+            pass
+        indexes = list(CouponShard.objects.filter(coupon=coupon, remaining__gt=0).values_list('index', flat=True))
+
+    start = random.randrange(len(indexes)) if indexes else 0
+    for index in indexes[start:] + indexes[:start]:
+        if CouponShard.objects.filter(coupon=coupon, index=index, remaining__gt=0).update(remaining=F('remaining') - 1):
+            return True
+    return False
+
+
+def redeem(coupon, user, order, attempts=3):
+    """
+    Record one use of the coupon for an order. Must run inside the order's
+    transaction; raises CouponUnavailable when no use is left.
+    """
+    for _ in range(attempts):
+        last = CouponRedemption.objects.filter(coupon=coupon, user=user).aggregate(last=Max('sequence'))['last']
+        sequence = (last or 0) + 1
+        if coupon.usage_limit_per_user is not None and sequence > coupon.usage_limit_per_user:
+            raise CouponUnavailable('You have already used this coupon')
+        try:
+            with transaction.atomic():
+                CouponRedemption.objects.create(coupon=coupon, user=user, order=order, sequence=sequence)
+            break
+        except IntegrityError:
+            # Another order by this user took the slot; count again
+            continue
+    else:
+        raise CouponUnavailable('You have already used this coupon')
+
+    if coupon.usage_limit is not None and not _take_use(coupon):
+        raise CouponUnavailable('Coupon is not valid or has expired')
+
+
+def reconcile(batch_size=500):
+    """Add uncounted redemptions to Coupon.used_count; returns how many were added"""
+    added = 0
+    while True:
+        with transaction.atomic():
+            batch = CouponRedemption.objects.filter(counted=False).order_by('pk')
+            batch = batch.select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+            batch = list(batch.values_list('pk', 'coupon_id')[:batch_size])
+            if not batch:
+                return added
+            CouponRedemption.objects.filter(pk__in=[pk for pk, _ in batch]).update(counted=True)
+            for coupon_id, uses in sorted(Counter(coupon_id for _, coupon_id in batch).items()):
+                Coupon.objects.filter(pk=coupon_id).update(used_count=F('used_count') + uses)
+        added += len(batch)
+        if len(batch) < batch_size:
+            return added
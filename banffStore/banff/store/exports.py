@@ -0,0 +1,182 @@
+"""
+Streaming exports of the catalog and order history.
+
+Each dataset is a generator of flat row dicts read with
+.iterator(chunk_size=...), so memory stays flat whatever the table size.
+Catalog rows carry one product or variant each, using the same columns
+import_catalog reads, so an export can be edited and imported back.
+Order rows carry one order item each, repeating the order's columns.
+
+The encoders turn rows into CSV or JSON Lines text in chunks, ready for a
+StreamingHttpResponse or a file.
+"""
+import csv
+from datetime import datetime, time
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from . import category_tree
+from .catalog_import import CATEGORY_SEPARATOR
+from .models import Order, Product, ProductVariant
+
+CHUNK_SIZE = 2000
+
+CATALOG_COLUMNS = [
+    'product_id', 'sku', 'name', 'slug', 'status', 'category', 'brand',
+    'price', 'compare_at_price', 'cost_price', 'stock', 'track_inventory', 'allow_backorders',
+    'variant_id', 'variant_sku', 'variant_price', 'variant_stock', 'attributes',
+    'created_at', 'updated_at',
+]
+
+ORDER_COLUMNS = [
+    'order_number', 'created_at', 'status', 'payment_status', 'username', 'email',
+    'subtotal', 'tax_amount', 'shipping_amount', 'discount_amount', 'total_amount',
+    'shipping_city', 'shipping_state', 'shipping_country',
+    'item_id', 'product_id', 'product_sku', 'product_name', 'variant_sku',
+    'quantity', 'unit_price', 'total_price',
+]
+
+# Order row column -> lookup, in ORDER_COLUMNS order
+ORDER_LOOKUPS = {
+    'order_number': 'order_number', 'created_at': 'created_at', 'status': 'status',
+    'payment_status': 'payment_status', 'username': 'user__username', 'email': 'user__email',
+    'subtotal': 'subtotal', 'tax_amount': 'tax_amount', 'shipping_amount': 'shipping_amount',
+    'discount_amount': 'discount_amount', 'total_amount': 'total_amount',
+    'shipping_city': 'shipping_city', 'shipping_state': 'shipping_state',
+    'shipping_country': 'shipping_country',
+    'item_id': 'items__id', 'product_id': 'items__product_id', 'product_sku': 'items__product__sku',
+    'product_name': 'items__product__name', 'variant_sku': 'items__variant__sku',
+    'quantity': 'items__quantity', 'unit_price': 'items__unit_price', 'total_price': 'items__total_price',
+}
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def catalog_rows(status=None, chunk_size=CHUNK_SIZE):
+    """One row per product, followed by one row per variant of it"""
+    products = Product.objects.order_by('pk')
+    if status:
+        products = products.filter(status=status)
+    products = products.values_list(
+        'id', 'sku', 'name', 'slug', 'status', 'category_id', 'brand__name',
+        'price', 'compare_at_price', 'cost_price', 'stock', 'track_inventory', 'allow_backorders',
+        'created_at', 'updated_at',
+    ).iterator(chunk_size=chunk_size)
+
+    tree = category_tree.get_tree()
+    category = {}
+    for chunk in _chunks(products, chunk_size):
+        # Variants and their attributes for the whole chunk in two queries
+        variants = {}
+        for variant in ProductVariant.objects.filter(
+            product_id__in=[row[0] for row in chunk]
+        ).order_by('pk').values_list('id', 'product_id', 'sku', 'price', 'stock'):
+            variants.setdefault(variant[1], []).append(variant)
+        attributes = {}
+        for variant_id, name, value in ProductVariant.attributes.through.objects.filter(
+            productvariant_id__in=[variant[0] for rows in variants.values() for variant in rows]
+        ).order_by('productattributevalue__attribute__name').values_list(
+            'productvariant_id', 'productattributevalue__attribute__name', 'productattributevalue__value'
+        ):
+            attributes.setdefault(variant_id, []).append(f'{name}={value}')
+
+        for (product_id, sku, name, slug, product_status, category_id, brand, price, compare_at_price,
+             cost_price, stock, track_inventory, allow_backorders, created_at, updated_at) in chunk:
+            if category_id not in category:
+                category[category_id] = f' {CATEGORY_SEPARATOR} '.join(tree.path(category_id))
+            row = {
+                'product_id': product_id, 'sku': sku, 'name': name, 'slug': slug,
+                'status': product_status, 'category': category[category_id], 'brand': brand,
+                'price': price, 'compare_at_price': compare_at_price, 'cost_price': cost_price,
+                'stock': stock, 'track_inventory': track_inventory, 'allow_backorders': allow_backorders,
+                'variant_id': None, 'variant_sku': None, 'variant_price': None, 'variant_stock': None,
+                'attributes': None, 'created_at': created_at, 'updated_at': updated_at,
+            }
+            yield row
+            for variant_id, _, variant_sku, variant_price, variant_stock in variants.get(product_id, ()):
+                yield dict(
+                    row, variant_id=variant_id, variant_sku=variant_sku, variant_price=variant_price,
+                    variant_stock=variant_stock, attributes=';'.join(attributes.get(variant_id, ())),
+                )
+
+
+def parse_moment(value):
+    """An ISO date or datetime; naive values are in the current timezone"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'not an ISO date or datetime: {value!r}')
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def order_rows(status=None, since=None, until=None, chunk_size=CHUNK_SIZE):
+    """One row per order item; orders without items get a single row"""
+    orders = Order.objects.order_by('created_at', 'pk', 'items__id')
+    if status:
+        orders = orders.filter(status=status)
+    if since:
+        orders = orders.filter(created_at__gte=since)
+    if until:
+        orders = orders.filter(created_at__lt=until)
+    for values in orders.values_list(*ORDER_LOOKUPS.values()).iterator(chunk_size=chunk_size):
+        yield dict(zip(ORDER_COLUMNS, values))
+
+
+DATASETS = {
+    'products': (CATALOG_COLUMNS, catalog_rows),
+    'orders': (ORDER_COLUMNS, order_rows),
+}
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to the caller"""
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def encode_csv(columns, rows, lines_per_chunk=500):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for chunk in _chunks(rows, lines_per_chunk):
+        yield ''.join(writer.writerow([_csv_value(row[column]) for column in columns]) for row in chunk)
+
+
+def encode_jsonl(columns, rows, lines_per_chunk=500):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for chunk in _chunks(rows, lines_per_chunk):
+        yield ''.join(encoder.encode(row) + '\n' for row in chunk)
+
+
+ENCODERS = {
+    'csv': (encode_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (encode_jsonl, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+def export(dataset, file_format, **filters):
+    """Text chunks of a whole dataset in the given format"""
+    columns, rows = DATASETS[dataset]
+    encode, _ = ENCODERS[file_format]
+    return encode(columns, rows(**filters))
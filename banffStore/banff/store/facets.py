@@ -0,0 +1,116 @@
+"""
+Facet counts for product listings.
+
+All facets come from a single GROUP BY over the filtered products, keyed on
+brand, category, price bucket, stock state and whole-star rating. The
+groups are then rolled up in Python into the individual facets.
+"""
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+from django.db.models import Case, Count, F, IntegerField, Max, Min, Q, Value, When
+
+from . import category_tree
+from .models import Product
+
+# Lower bounds of the price buckets; the last one is open-ended
+PRICE_BUCKETS = [Decimal('0'), Decimal('50'), Decimal('100'), Decimal('200'), Decimal('500')]
+RATING_THRESHOLDS = [4, 3, 2, 1]
+
+
+def _price_bucket():
+    whens = [
+        When(price__gte=lower, then=Value(index))
+        for index, lower in reversed(list(enumerate(PRICE_BUCKETS)))
+    ]
+    return Case(*whens, default=Value(0), output_field=IntegerField())
+
+
+def _rating_bucket():
+    whens = [
+        When(average_rating__gte=star, then=Value(star))
+        for star in range(5, 0, -1)
+    ]
+    return Case(*whens, default=Value(0), output_field=IntegerField())
+
+
+def _format_price(value):
+    # Match how DRF renders the DecimalField prices in the results
+    return f'{value:.2f}' if value is not None else None
+
+
+def compute_facets(queryset):
+    """Brand, category, price, stock and rating counts for a product queryset"""
+    if queryset.query.annotations:
+        # Search results carry per-row annotations that would leak into
+        # the GROUP BY, so facet over their ids instead
+        queryset = Product.objects.filter(pk__in=queryset.values('pk'))
+
+    groups = queryset.order_by().annotate(
+        price_bucket=_price_bucket(),
+        rating_bucket=_rating_bucket(),
+        # Units held by carts can't be bought, as with the in_stock filter
+        in_stock=Case(When(Q(stock__gt=F('reserved')), then=Value(1)), default=Value(0), output_field=IntegerField()),
+    ).values(
+        'brand__slug', 'brand__name', 'category_id', 'price_bucket', 'rating_bucket', 'in_stock'
+    ).annotate(
+        count=Count('id'), min_price=Min('price'), max_price=Max('price')
+    )
+
+    brands = {}
+    categories = Counter()
+    prices = Counter()
+    ratings = Counter()
+    stock = Counter()
+    min_price = max_price = None
+
+    for group in groups:
+        count = group['count']
+        if group['brand__slug'] is not None:
+            brand = brands.setdefault(group['brand__slug'], {
+                'slug': group['brand__slug'], 'name': group['brand__name'], 'count': 0
+            })
+            brand['count'] += count
+        categories[group['category_id']] += count
+        prices[group['price_bucket']] += count
+        ratings[group['rating_bucket']] += count
+        stock[group['in_stock']] += count
+        if min_price is None or group['min_price'] < min_price:
+            min_price = group['min_price']
+        if max_price is None or group['max_price'] > max_price:
+            max_price = group['max_price']
+
+    tree = category_tree.get_tree()
+    category_facets = []
+    for category_id, count in categories.items():
+        category = tree.by_id.get(category_id)
+        if category is not None:
+            category_facets.append({'slug': category.slug, 'name': category.name, 'count': count})
+
+    price_facets = []
+    for index, lower in enumerate(PRICE_BUCKETS):
+        upper = PRICE_BUCKETS[index + 1] if index + 1 < len(PRICE_BUCKETS) else None
+        price_facets.append({
+            'min': _format_price(lower),
+            'max': _format_price(upper),
+            'count': prices[index],
+        })
+
+    # "N stars & up" counts accumulate the whole-star buckets above them
+    at_least = defaultdict(int)
+    for star, count in ratings.items():
+        for threshold in RATING_THRESHOLDS:
+            if star >= threshold:
+                at_least[threshold] += count
+
+    return {
+        'brands': sorted(brands.values(), key=lambda item: (-item['count'], item['name'])),
+        'categories': sorted(category_facets, key=lambda item: (-item['count'], item['name'])),
+        'price_ranges': price_facets,
+        'in_stock': {'in_stock': stock[1], 'out_of_stock': stock[0]},
+        'ratings': [{'min_rating': threshold, 'count': at_least[threshold]} for threshold in RATING_THRESHOLDS],
+        'price': {
+            'min': _format_price(min_price),
+            'max': _format_price(max_price),
+        },
+    }
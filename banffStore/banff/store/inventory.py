@@ -0,0 +1,254 @@
+"""
+Time-limited inventory holds for cart lines.
+
+Adding a product to a cart holds those units for STORE_CART_HOLD_SECONDS.
+Each hold is an InventoryHold row. Its units are also counted in the
+reserved column of the product (or, for variant lines, the variant), so
+availability is a single row read:
+
+    available = stock - reserved
+
+The column only changes through conditional F() updates. A hold is granted
+only while available covers it, so concurrent carts can't hold more units
+than exist.
+
+Holds that expire stay counted until something releases them. sweep()
+reclaims them in batches. A hold that would fail first reclaims the
+expired holds of its own SKU. Checkout converts a cart's holds into the
+stock decrement, in the same statement (see store.checkout).
+
+Availability in cached catalog responses is advisory. Holds don't
+invalidate the response cache, so a busy SKU doesn't flush every listing.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import InventoryHold, Product, ProductVariant
+
+SWEEP_BATCH_SIZE = 1000
+
+
+def get_hold_seconds():
+    return getattr(settings, 'STORE_CART_HOLD_SECONDS', 900)
+
+
+def _sku(product, variant_id):
+    """The row whose reserved column a line counts against"""
+    if variant_id:
+        return ProductVariant, variant_id
+    return Product, product.pk
+
+
+def _reserve(model, pk, quantity):
+    lookup = 'product__allow_backorders' if model is ProductVariant else 'allow_backorders'
+    return model.objects.filter(
+        Q(stock__gte=F('reserved') + quantity) | Q(**{lookup: True}), pk=pk,
+    ).update(reserved=F('reserved') + quantity)
+
+
+def unreserve(totals):
+    """Give back units per (model, pk), one row at a time in lock order"""
+    for (model, pk), quantity in sorted(totals.items(), key=lambda item: (item[0][0]._meta.label, item[0][1])):
+        if quantity:
+            model.objects.filter(pk=pk).update(reserved=Greatest(F('reserved') - quantity, 0))
+
+
+def _release(holds, skip_locked=False):
+    """Delete holds and give back their units; returns how many were released"""
+    with transaction.atomic():
+        holds = holds.select_for_update(
+            skip_locked=skip_locked and connection.features.has_select_for_update_skip_locked
+        )
+        rows = list(holds.values_list('pk', 'product_id', 'variant_id', 'quantity'))
+        if not rows:
+            return 0
+        InventoryHold.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        totals = Counter()
+        for _, product_id, variant_id, quantity in rows:
+            if variant_id:
+                totals[ProductVariant, variant_id] += quantity
+            else:
+                totals[Product, product_id] += quantity
+        unreserve(totals)
+    return len(rows)
+
+
+def _adjust(model, pk, delta, current):
+    """Move reserved by delta for a line whose hold is current; False if the units aren't there"""
+    if delta > 0 and not _reserve(model, pk, delta):
+        # Expired holds may still be counted; reclaim them and retry once
+        release_expired(model, pk, keep=current)
+        if not _reserve(model, pk, delta):
+            return False
+    elif delta < 0:
+        unreserve({(model, pk): -delta})
+    return True
+
+
+def hold(cart, product, variant_id, quantity):
+    """
+    Hold quantity units for a cart line, replacing the line's previous hold
+    and restarting its clock. Returns False, leaving the line's hold as it
+    was, when the extra units aren't available.
+    """
+    if not product.track_inventory:
+        return True
+    try:
+        return _hold(cart, product, variant_id, quantity)
+    except IntegrityError:
+        # A concurrent request created the line's hold first; replace that one
+        return _hold(cart, product, variant_id, quantity)
+
+
+def _hold(cart, product, variant_id, quantity):
+    model, pk = _sku(product, variant_id)
+    with transaction.atomic():
+        current = InventoryHold.objects.select_for_update().filter(
+            cart=cart, product=product, variant_id=variant_id
+        ).first()
+        if not _adjust(model, pk, quantity - (current.quantity if current else 0), current):
+            return False
+
+        expires_at = timezone.now() + timedelta(seconds=get_hold_seconds())
+        if current is None:
+            InventoryHold.objects.create(
+                cart=cart, product=product, variant_id=variant_id, quantity=quantity, expires_at=expires_at
+            )
+        else:
+            InventoryHold.objects.filter(pk=current.pk).update(quantity=quantity, expires_at=expires_at)
+    return True
+
+
+def hold_lines(cart, items):
+    """
+    hold() for many cart lines in one pass: the cart's holds are read once
+    and written in bulk, and each SKU's reserved moves once, in lock order.
+    Returns the lines whose extra units weren't available; they keep their
+    previous hold.
+    """
+    items = [item for item in items if item.product.track_inventory]
+    if not items:
+        return []
+    refused = []
+    with transaction.atomic():
+        current = {
+            (held.product_id, held.variant_id): held
+            for held in InventoryHold.objects.select_for_update().filter(cart=cart)
+        }
+        expires_at = timezone.now() + timedelta(seconds=get_hold_seconds())
+        created, updated = [], []
+        lines = [(_sku(item.product, item.variant_id), item) for item in items]
+        for (model, pk), item in sorted(lines, key=lambda line: (line[0][0]._meta.label, line[0][1])):
+            held = current.get((item.product_id, item.variant_id))
+            if not _adjust(model, pk, item.quantity - (held.quantity if held else 0), held):
+                refused.append(item)
+            elif held is None:
+                created.append(InventoryHold(
+                    cart=cart, product_id=item.product_id, variant_id=item.variant_id,
+                    quantity=item.quantity, expires_at=expires_at,
+                ))
+            else:
+                held.quantity, held.expires_at = item.quantity, expires_at
+                updated.append(held)
+        InventoryHold.objects.bulk_create(created)
+        if updated:
+            InventoryHold.objects.bulk_update(updated, ['quantity', 'expires_at'])
+    return refused
+
+
+def release(cart, product_id, variant_id):
+    """Give back the hold of one cart line"""
+    return _release(InventoryHold.objects.filter(cart=cart, product_id=product_id, variant_id=variant_id))
+
+
+def transfer(source, target):
+    """Move a cart's holds to another cart, adding them to its holds for the same lines"""
+    holds = list(InventoryHold.objects.select_for_update().filter(cart=source))
+    if not holds:
+        return
+    existing = {
+        (current.product_id, current.variant_id): current
+        for current in InventoryHold.objects.select_for_update().filter(cart=target)
+    }
+    moved, merged = [], []
+    for held in holds:
+        current = existing.get((held.product_id, held.variant_id))
+        if current is None:
+            moved.append(held.pk)
+        else:
+            # The units stay reserved; only their owner changes
+            current.quantity += held.quantity
+            current.expires_at = max(current.expires_at, held.expires_at)
+            merged.append(current)
+    if merged:
+        InventoryHold.objects.filter(cart=source).exclude(pk__in=moved).delete()
+        InventoryHold.objects.bulk_update(merged, ['quantity', 'expires_at'])
+    if moved:
+        InventoryHold.objects.filter(pk__in=moved).update(cart=target)
+
+
+def release_expired(model, pk, keep=None):
+    """Give back the expired holds counted against one product or variant"""
+    holds = InventoryHold.objects.filter(expires_at__lte=timezone.now())
+    if keep is not None:
+        holds = holds.exclude(pk=keep.pk)
+    if model is ProductVariant:
+        holds = holds.filter(variant_id=pk)
+    else:
+        holds = holds.filter(product_id=pk, variant__isnull=True)
+    return _release(holds)
+
+
+def claim(cart):
+    """
+    Delete a cart's holds for checkout, leaving reserved untouched, and
+    return the held units per ('product' | 'variant', pk). The caller must
+    take them off reserved in the same transaction.
+    """
+    rows = list(
+        InventoryHold.objects.select_for_update().filter(cart=cart)
+        .values_list('pk', 'product_id', 'variant_id', 'quantity')
+    )
+    if not rows:
+        return Counter()
+    InventoryHold.objects.filter(pk__in=[row[0] for row in rows]).delete()
+    held = Counter()
+    for _, product_id, variant_id, quantity in rows:
+        if variant_id:
+            held['variant', variant_id] += quantity
+        else:
+            held['product', product_id] += quantity
+    return held
+
+
+def sweep(batch_size=SWEEP_BATCH_SIZE, now=None):
+    """Reclaim every expired hold, one transaction per batch"""
+    now = now or timezone.now()
+    released = 0
+    while True:
+        batch = InventoryHold.objects.filter(expires_at__lte=now).order_by('expires_at')
+        batch = list(batch.values_list('pk', flat=True)[:batch_size])
+        count = _release(InventoryHold.objects.filter(pk__in=batch), skip_locked=True)
+        released += count
+        if count < batch_size:
+            return released
+
+
+def reconcile():
+    """Recompute reserved from the live holds, e.g. after a crash or restore"""
+    fixed = 0
+    for model, key, extra in ((Product, 'product_id', {'variant__isnull': True}), (ProductVariant, 'variant_id', {})):
+        with transaction.atomic():
+            held = Counter()
+            for pk, quantity in InventoryHold.objects.filter(**extra).values_list(key, 'quantity'):
+                held[pk] += quantity
+            for pk, reserved in model.objects.filter(Q(reserved__gt=0) | Q(pk__in=list(held))).values_list('pk', 'reserved'):
+                if reserved != held[pk]:
+                    fixed += model.objects.filter(pk=pk).update(reserved=held[pk])
+    return fixed
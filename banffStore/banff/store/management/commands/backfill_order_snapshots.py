@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store import order_snapshots
+
+
+class Command(BaseCommand):
+    help = 'Fill in the product snapshot of order items placed before it was stored'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=order_snapshots.BATCH_SIZE, help='Order items written per transaction'
+        )
+        parser.add_argument(
+            '--refresh', action='store_true',
+            help='Retake every snapshot from the current catalog, not only the missing ones'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        written = order_snapshots.backfill(options['batch_size'], refresh=options['refresh'])
+        self.stdout.write(self.style.SUCCESS(f'Snapshotted {written} order items'))
@@ -0,0 +1,45 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store import exports
+
+
+class Command(BaseCommand):
+    help = 'Dump the catalog or the order history as CSV or JSON Lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=list(exports.DATASETS))
+        parser.add_argument('--format', choices=list(exports.ENCODERS), default='csv')
+        parser.add_argument('--output', '-o', help='File to write (default: stdout)')
+        parser.add_argument('--status', help='Only products or orders with this status')
+        parser.add_argument('--since', help='Orders created on or after this date/datetime')
+        parser.add_argument('--until', help='Orders created before this date/datetime')
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        filters = {'status': options['status'], 'chunk_size': options['chunk_size']}
+        if options['dataset'] == 'orders':
+            for name in ('since', 'until'):
+                if options[name]:
+                    try:
+                        filters[name] = exports.parse_moment(options[name])
+                    except ValueError as error:
+                        raise CommandError(f'--{name}: {error}')
+        elif options['since'] or options['until']:
+            raise CommandError('--since and --until only apply to orders')
+
+        started = time.monotonic()
+        output = open(options['output'], 'w', newline='', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            for chunk in exports.export(options['dataset'], options['format'], **filters):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Exported {options['dataset']} to {options['output']} in {time.monotonic() - started:.1f}s"
+            ))
@@ -0,0 +1,55 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.catalog_import import MAX_ERRORS, CatalogImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Stream a CSV or JSONL supplier catalog into products, variants and attributes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or JSONL file (one product or variant per row)')
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='File format (default: from the file extension)'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows written per transaction')
+        parser.add_argument(
+            '--max-errors', type=int, default=MAX_ERRORS,
+            help='Rejected rows to print (all are counted)'
+        )
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['path']):
+            raise CommandError(f"No such file: {options['path']}")
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        def progress(stats, elapsed):
+            self.stdout.write(
+                f"{stats['rows']} rows, {stats['rows'] / max(elapsed, 1e-6):.0f} rows/s", ending='\r'
+            )
+            self.stdout.flush()
+
+        importer = CatalogImporter(
+            batch_size=options['batch_size'], on_progress=progress, max_errors=options['max_errors']
+        )
+        stats = importer.run(read_rows(options['path'], options['format']))
+        self.stdout.write('')
+
+        for line_number, message in importer.errors:
+            self.stderr.write(f'line {line_number}: {message}')
+        if stats['errors'] > len(importer.errors):
+            self.stderr.write(f"... and {stats['errors'] - len(importer.errors)} more rejected rows")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['rows']} rows in {stats['seconds']:.1f}s "
+            f"({stats['rows'] / max(stats['seconds'], 1e-6):.0f} rows/s): "
+            f"{stats['products_created']} products created, {stats['products_updated']} updated, "
+            f"{stats['variants_created']} variants created, {stats['variants_updated']} updated, "
+            f"{stats['categories_created']} categories and {stats['brands_created']} brands created, "
+            f"{stats['errors']} rows rejected"
+        ))
+        if stats['images']:
+            self.stdout.write('Run regenerate_renditions to resize the imported images.')
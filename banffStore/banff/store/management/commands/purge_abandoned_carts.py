@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store import purge
+
+
+class Command(BaseCommand):
+    help = 'Delete anonymous carts idle past a given age, and expired sessions, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=float, default=None,
+            help='Idle days after which an anonymous cart is deleted (default: STORE_ABANDONED_CART_DAYS)'
+        )
+        parser.add_argument('--batch-size', type=int, default=purge.BATCH_SIZE, help='Rows deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to wait between batches')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['days'] is not None and options['days'] <= 0:
+            raise CommandError('--days must be positive')
+
+        max_age = timedelta(days=options['days']) if options['days'] is not None else None
+        result = purge.run(max_age=max_age, batch_size=options['batch_size'], pause=options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {result.carts} carts, {result.cart_items} cart items and {result.sessions} sessions '
+            f'in {result.batches} batches, {result.seconds:.2f}s ({result.rows_per_second} rows/s)'
+        ))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store.models import Product
+from store.ratings import recompute_ratings
+
+
+class Command(BaseCommand):
+    help = 'Backfill or repair the stored rating aggregates on products'
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--product', action='append', dest='slugs', default=[],
+            help='Only rebuild the product with this slug (repeatable)'
+        )
+    
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options['slugs']:
+            products = products.filter(slug__in=options['slugs'])
+        
+        with transaction.atomic():
+            repaired = recompute_ratings(products)
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {products.count()} products, repaired {repaired}'
+        ))
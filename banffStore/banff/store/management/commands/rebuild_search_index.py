@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from store import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text product search index'
+    
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('The product search index requires SQLite with FTS5')
+        
+        started = time.monotonic()
+        with transaction.atomic():
+            count = search.rebuild()
+        
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {count} products in {time.monotonic() - started:.2f}s'
+        ))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store import coupons
+
+
+class Command(BaseCommand):
+    help = 'Add recorded coupon redemptions to each coupon\'s used_count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Redemptions counted per transaction')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        added = coupons.reconcile(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Counted {added} redemptions'))
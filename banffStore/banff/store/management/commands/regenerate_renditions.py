@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from store import renditions
+
+
+class Command(BaseCommand):
+    help = 'Generate missing or stale image renditions for catalog images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model', action='append', dest='models', default=[],
+            choices=[label.split('.')[1].lower() for label in renditions.SOURCES],
+            help='Only process this model (repeatable)'
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Regenerate renditions that are already up to date'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Worker processes (defaults to STORE_RENDITION_WORKERS)'
+        )
+
+    def handle(self, *args, **options):
+        jobs = list(self.find_jobs(options['models'], options['force']))
+        workers = options['workers'] if options['workers'] is not None else renditions.get_workers()
+        started = time.monotonic()
+        done = failed = 0
+
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(renditions.generate, name): (label, pk) for label, pk, name in jobs}
+                for future in as_completed(futures):
+                    label, pk = futures[future]
+                    try:
+                        done += renditions.store(label, pk, future.result())
+                    except Exception as error:
+                        failed += 1
+                        self.stderr.write(f'{label} {pk}: {error}')
+        else:
+            for label, pk, name in jobs:
+                try:
+                    done += renditions.store(label, pk, renditions.generate(name))
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write(f'{label} {pk}: {error}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Regenerated {done} of {len(jobs)} images in {time.monotonic() - started:.1f}s'
+            f' ({failed} failed)'
+        ))
+
+    def find_jobs(self, models, force):
+        for label, (image_field, renditions_field) in renditions.SOURCES.items():
+            if models and label.split('.')[1].lower() not in models:
+                continue
+            rows = apps.get_model(label).objects.exclude(**{image_field: ''}).exclude(**{f'{image_field}__isnull': True})
+            rows = rows.values_list('pk', image_field, renditions_field)
+            for pk, name, current in rows.iterator(chunk_size=2000):
+                if force or not renditions.is_current(current, name):
+                    yield label, pk, name
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from store import inventory
+
+
+class Command(BaseCommand):
+    help = 'Give back the units of expired cart holds to available stock'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=inventory.SWEEP_BATCH_SIZE,
+            help='Holds released per transaction'
+        )
+        parser.add_argument(
+            '--reconcile', action='store_true',
+            help='Also recompute reserved counts from the remaining holds'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        released = inventory.sweep(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired holds'))
+        if options['reconcile']:
+            fixed = inventory.reconcile()
+            self.stdout.write(self.style.SUCCESS(f'Corrected reserved on {fixed} products and variants'))
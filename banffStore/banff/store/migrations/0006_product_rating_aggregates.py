@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:09
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductReview = apps.get_model('store', 'ProductReview')
+    rows = ProductReview.objects.filter(is_approved=True).values('product_id').annotate(
+        total=Sum('rating'),
+        count=Count('id'),
+        **{f'stars_{star}': Count('id', filter=Q(rating=star)) for star in range(1, 6)}
+    )
+    for row in rows:
+        Product.objects.filter(pk=row['product_id']).update(
+            rating_sum=row['total'],
+            review_count=row['count'],
+            average_rating=row['total'] / row['count'],
+            **{f'rating_{star}_count': row[f'stars_{star}'] for star in range(1, 6)}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0005_alter_product_sku_alter_productvariant_sku'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='average_rating',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_1_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_2_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_3_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_4_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_5_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
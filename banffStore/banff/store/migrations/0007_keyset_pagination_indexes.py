@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0006_product_rating_aggregates'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='store_order_user_id_5946cf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='store_produ_status_0255c0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['status', 'price', 'id'], name='store_produ_status_807d51_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['status', 'average_rating', 'id'], name='store_produ_status_3182f2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['product', 'is_approved', 'created_at', 'id'], name='store_produ_product_382d52_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, OperationalError
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE store_product_search USING fts5("
+            "name, sku, short_description, description, category, brand, "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+    except OperationalError:
+        # SQLite built without FTS5; search falls back to icontains
+        return
+    schema_editor.execute("""
+        INSERT INTO store_product_search (rowid, name, sku, short_description, description, category, brand)
+        SELECT p.id, p.name, p.sku, p.short_description, p.description, c.name, COALESCE(b.name, '')
+        FROM store_product p
+        INNER JOIN store_category c ON c.id = p.category_id
+        LEFT OUTER JOIN store_brand b ON b.id = p.brand_id
+        WHERE p.status = 'active'
+    """)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS store_product_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0007_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# store.coupons.SHARDS when this migration was written
+SHARDS = 16
+
+
+def allocate_coupon_shards(apps, schema_editor):
+    Coupon = apps.get_model('store', 'Coupon')
+    CouponShard = apps.get_model('store', 'CouponShard')
+    shards = []
+    for coupon in Coupon.objects.filter(usage_limit__isnull=False):
+        base, extra = divmod(max(coupon.usage_limit - coupon.used_count, 0), SHARDS)
+        shards += [
+            CouponShard(coupon=coupon, index=index, remaining=base + (index < extra))
+            for index in range(SHARDS)
+        ]
+    CouponShard.objects.bulk_create(shards)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0010_inventory_holds'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='usage_limit_per_user',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='CouponRedemption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('counted', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='redemptions', to='store.coupon')),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='coupon_redemption', to='store.order')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coupon_redemptions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('counted', False)), fields=['coupon'], name='store_redemption_uncounted')],
+                'unique_together': {('coupon', 'user', 'sequence')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CouponShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField()),
+                ('remaining', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='store.coupon')),
+            ],
+            options={
+                'unique_together': {('coupon', 'index')},
+            },
+        ),
+        migrations.RunPython(allocate_coupon_shards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:44
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
+
+
+def backfill_cart_totals(apps, schema_editor):
+    Cart = apps.get_model('store', 'Cart')
+    CartItem = apps.get_model('store', 'CartItem')
+    Product = apps.get_model('store', 'Product')
+    ProductVariant = apps.get_model('store', 'ProductVariant')
+    price = Coalesce(
+        NullIf(Subquery(ProductVariant.objects.filter(pk=OuterRef('variant_id')).values('price')), Value(0)),
+        Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('price')),
+    )
+    CartItem.objects.update(unit_price=price, total_price=price * F('quantity'))
+    lines = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart')
+    Cart.objects.update(
+        total_amount=Coalesce(Subquery(lines.annotate(amount=Sum('total_price')).values('amount')), Value(Decimal('0.00'))),
+        total_items=Coalesce(Subquery(lines.annotate(count=Sum('quantity')).values('count')), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0011_coupon_redemptions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total_items',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='total_price',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='cartitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), editable=False, max_digits=10),
+        ),
+        migrations.RunPython(backfill_cart_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:53
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0012_stored_cart_totals'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['user', 'updated_at'], name='store_cart_user_updated'),
+        ),
+    ]
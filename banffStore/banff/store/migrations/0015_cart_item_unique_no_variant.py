@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:07
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    CartItem = apps.get_model('store', 'CartItem')
+    duplicates = (
+        CartItem.objects.filter(variant__isnull=True).values('cart', 'product')
+        .annotate(lines=Count('pk'), keep=Min('pk'), quantity=Sum('quantity')).filter(lines__gt=1)
+    )
+    for duplicate in duplicates:
+        lines = CartItem.objects.filter(cart=duplicate['cart'], product=duplicate['product'], variant__isnull=True)
+        kept = lines.get(pk=duplicate['keep'])
+        lines.exclude(pk=kept.pk).delete()
+        # The cart's stored totals already count every unit
+        kept.quantity = duplicate['quantity']
+        kept.total_price = kept.unit_price * kept.quantity
+        kept.save(update_fields=['quantity', 'total_price'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0014_order_item_snapshots'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('variant__isnull', True)), fields=('cart', 'product'), name='store_cartitem_unique_no_variant'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:55
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+
+
+def merge_duplicate_holds(apps, schema_editor):
+    InventoryHold = apps.get_model('store', 'InventoryHold')
+    duplicates = (
+        InventoryHold.objects.filter(cart__isnull=False, variant__isnull=True).values('cart', 'product')
+        .annotate(
+            holds=Count('pk'), keep=Min('pk'), quantity=Sum('quantity'), expires_at=Max('expires_at')
+        ).filter(holds__gt=1)
+    )
+    for duplicate in duplicates:
+        holds = InventoryHold.objects.filter(cart=duplicate['cart'], product=duplicate['product'], variant__isnull=True)
+        holds.exclude(pk=duplicate['keep']).delete()
+        # The product's reserved already counts every unit
+        holds.filter(pk=duplicate['keep']).update(
+            quantity=duplicate['quantity'], expires_at=duplicate['expires_at']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0015_cart_item_unique_no_variant'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_holds, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='inventoryhold',
+            constraint=models.UniqueConstraint(condition=models.Q(('variant__isnull', True)), fields=('cart', 'product'), name='store_inventoryhold_unique_no_variant'),
+        ),
+    ]
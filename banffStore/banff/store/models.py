@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.utils.text import slugify
 from django.core.validators import MinValueValidator, MaxValueValidator
@@ -34,6 +34,8 @@ class Brand(models.Model):
     slug = models.SlugField(unique=True, blank=True)
     description = models.TextField(blank=True)
     logo = models.ImageField(upload_to='brands/', blank=True, null=True)
+    # Resized copies of the logo, see store.renditions
+    logo_renditions = models.JSONField(default=dict, blank=True, editable=False)
     website = models.URLField(blank=True)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -68,7 +70,10 @@ class Product(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     brand = models.ForeignKey(Brand, on_delete=models.SET_NULL, null=True, blank=True, related_name='products')
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
     stock = models.IntegerField(default=0, validators=[MinValueValidator(0)])
+    # Units held by carts (see store.inventory); available = stock - reserved
+    reserved = models.PositiveIntegerField(default=0, editable=False)
     low_stock_threshold = models.IntegerField(default=5, validators=[MinValueValidator(0)])
     weight = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)
     dimensions = models.CharField(max_length=100, blank=True)  # e.g., "10x5x2 cm"
@@ -79,6 +84,17 @@ class Product(models.Model):
     tax_class = models.CharField(max_length=50, blank=True)
     meta_title = models.CharField(max_length=200, blank=True)
     meta_description = models.TextField(blank=True)
+    
+    # Rating aggregates over approved reviews, maintained by store.ratings
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    average_rating = models.FloatField(default=0, editable=False)
+    rating_1_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_2_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_3_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_4_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_5_count = models.PositiveIntegerField(default=0, editable=False)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -88,6 +104,10 @@ class Product(models.Model):
             models.Index(fields=['status', 'is_featured']),
             models.Index(fields=['category', 'status']),
             models.Index(fields=['brand', 'status']),
+            # Keyset pagination scans for the supported orderings
+            models.Index(fields=['status', 'created_at', 'id']),
+            models.Index(fields=['status', 'price', 'id']),
+            models.Index(fields=['status', 'average_rating', 'id']),
         ]
     
     @property
@@ -98,6 +118,10 @@ class Product(models.Model):
             return self.stock > 0 or self.allow_backorders
         return True
     
+    @property
+    def available_stock(self):
+        return max(self.stock - self.reserved, 0)
+    
     @property
     def is_on_sale(self):
         return self.compare_at_price and self.compare_at_price > self.price
@@ -113,15 +137,8 @@ class Product(models.Model):
         return self.track_inventory and self.stock <= self.low_stock_threshold
     
     @property
-    def average_rating(self):
-        reviews = self.reviews.filter(is_approved=True)
-        if reviews.exists():
-            return reviews.aggregate(models.Avg('rating'))['rating__avg']
-        return 0
-    
-    @property
-    def review_count(self):
-        return self.reviews.filter(is_approved=True).count()
+    def rating_histogram(self):
+        return {star: getattr(self, f'rating_{star}_count') for star in range(1, 6)}
     
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -136,6 +153,7 @@ class Product(models.Model):
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='products/gallery/')
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
     alt_text = models.CharField(max_length=200, blank=True)
     sort_order = models.IntegerField(default=0)
     is_primary = models.BooleanField(default=False)
@@ -183,13 +201,19 @@ class ProductVariant(models.Model):
     sku = models.CharField(max_length=100, unique=True, blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     stock = models.IntegerField(default=0, validators=[MinValueValidator(0)])
+    reserved = models.PositiveIntegerField(default=0, editable=False)
     image = models.ImageField(upload_to='products/variants/', blank=True, null=True)
+    image_renditions = models.JSONField(default=dict, blank=True, editable=False)
     
     def save(self, *args, **kwargs):
         if not self.sku:
             self.sku = f"{self.product.sku}-VAR-{uuid.uuid4().hex[:6].upper()}"
         super().save(*args, **kwargs)
     
+    @property
+    def available_stock(self):
+        return max(self.stock - self.reserved, 0)
+    
     def __str__(self):
         attrs = ", ".join([str(attr) for attr in self.attributes.all()])
         return f"{self.product.name} ({attrs})"
@@ -211,6 +235,21 @@ class ProductReview(models.Model):
     class Meta:
         unique_together = ['product', 'user']
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['product', 'is_approved', 'created_at', 'id']),
+        ]
+    
+    def save(self, *args, **kwargs):
+        from .ratings import apply_review_change
+        
+        with transaction.atomic():
+            previous = None
+            if self.pk:
+                previous = ProductReview.objects.filter(pk=self.pk).values(
+                    'product_id', 'rating', 'is_approved'
+                ).first()
+            super().save(*args, **kwargs)
+            apply_review_change(previous, self)
     
     def __str__(self):
         return f"{self.product.name} - {self.rating}/5 by {self.user.username}"
@@ -227,6 +266,9 @@ class Wishlist(models.Model):
 class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     session_key = models.CharField(max_length=40, null=True, blank=True)
+    # Sums of the lines, kept current by store.carts
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), editable=False)
+    total_items = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -234,16 +276,10 @@ class Cart(models.Model):
         indexes = [
             models.Index(fields=['user']),
             models.Index(fields=['session_key']),
+            # Oldest anonymous carts first, for store.purge
+            models.Index(fields=['user', 'updated_at'], name='store_cart_user_updated'),
         ]
     
-    @property
-    def total_amount(self):
-        return sum(item.total_price for item in self.items.all())
-    
-    @property
-    def total_items(self):
-        return sum(item.quantity for item in self.items.all())
-    
     def __str__(self):
         if self.user:
             return f"Cart for {self.user.username}"
@@ -254,19 +290,31 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True)
     quantity = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
+    # Copied from the catalog on every write and on price changes
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), editable=False)
+    total_price = models.DecimalField(max_digits=10, decimal_places=2, default=Decimal('0.00'), editable=False)
     
     class Meta:
         unique_together = ['cart', 'product', 'variant']
+        constraints = [
+            # unique_together doesn't cover lines without a variant, since
+            # NULLs never compare equal
+            models.UniqueConstraint(
+                fields=['cart', 'product'], condition=models.Q(variant__isnull=True),
+                name='store_cartitem_unique_no_variant',
+            ),
+        ]
     
     @property
-    def unit_price(self):
+    def current_unit_price(self):
         if self.variant and self.variant.price:
             return self.variant.price
         return self.product.price
     
-    @property
-    def total_price(self):
-        return self.unit_price * self.quantity
+    def save(self, *args, **kwargs):
+        self.unit_price = self.current_unit_price
+        self.total_price = self.unit_price * self.quantity
+        super().save(*args, **kwargs)
     
     def get_total_price(self):
         return self.total_price
@@ -275,6 +323,33 @@ class CartItem(models.Model):
         variant_info = f" ({self.variant})" if self.variant else ""
         return f"{self.quantity} x {self.product.name}{variant_info}"
 
+class InventoryHold(models.Model):
+    """Units of a product or variant held for a cart line until expires_at"""
+    # Holds outlive a deleted cart so the sweeper still gives their units back
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, null=True, blank=True, related_name='holds')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='holds')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True, related_name='holds')
+    quantity = models.PositiveIntegerField(validators=[MinValueValidator(1)])
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ['cart', 'product', 'variant']
+        constraints = [
+            # As for CartItem, unique_together leaves holds without a variant
+            # uncovered
+            models.UniqueConstraint(
+                fields=['cart', 'product'], condition=models.Q(variant__isnull=True),
+                name='store_inventoryhold_unique_no_variant',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.quantity} x {self.variant or self.product} until {self.expires_at}"
+
 class Order(models.Model):
     ORDER_STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -333,6 +408,7 @@ class Order(models.Model):
         indexes = [
             models.Index(fields=['user', 'status']),
             models.Index(fields=['order_number']),
+            models.Index(fields=['user', 'created_at', 'id']),
         ]
     
     def save(self, *args, **kwargs):
@@ -350,6 +426,11 @@ class OrderItem(models.Model):
     quantity = models.PositiveIntegerField(validators=[MinValueValidator(1)])
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
+    # What was bought, as it was at checkout (see store.order_snapshots)
+    product_name = models.CharField(max_length=200, blank=True)
+    product_sku = models.CharField(max_length=100, blank=True)
+    product_image = models.CharField(max_length=500, blank=True)
+    variant_label = models.CharField(max_length=200, blank=True)
     
     def save(self, *args, **kwargs):
         self.total_price = self.unit_price * self.quantity
@@ -371,6 +452,8 @@ class Coupon(models.Model):
     discount_value = models.DecimalField(max_digits=10, decimal_places=2)
     minimum_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     usage_limit = models.IntegerField(null=True, blank=True)
+    usage_limit_per_user = models.PositiveIntegerField(null=True, blank=True)
+    # Catches up with CouponRedemption in batches (see store.coupons)
     used_count = models.IntegerField(default=0)
     is_active = models.BooleanField(default=True)
     valid_from = models.DateTimeField()
@@ -388,6 +471,37 @@ class Coupon(models.Model):
                 self.valid_from <= now <= self.valid_until and
                 (self.usage_limit is None or self.used_count < self.usage_limit))
 
+class CouponShard(models.Model):
+    """One slice of a limited coupon's remaining uses"""
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='shards')
+    index = models.PositiveSmallIntegerField()
+    remaining = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['coupon', 'index']
+    
+    def __str__(self):
+        return f"{self.coupon.code} #{self.index}: {self.remaining} left"
+
+class CouponRedemption(models.Model):
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='redemptions')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='coupon_redemptions')
+    order = models.OneToOneField('Order', on_delete=models.CASCADE, related_name='coupon_redemption')
+    # The user's nth use of the coupon; unique, so concurrent uses can't share a slot
+    sequence = models.PositiveIntegerField()
+    # Set once the use has been added to Coupon.used_count
+    counted = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ['coupon', 'user', 'sequence']
+        indexes = [
+            models.Index(fields=['coupon'], condition=models.Q(counted=False), name='store_redemption_uncounted'),
+        ]
+    
+    def __str__(self):
+        return f"{self.coupon.code} used by {self.user.username} on {self.order.order_number}"
+
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     phone = models.CharField(max_length=20, blank=True)
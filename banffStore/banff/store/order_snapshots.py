@@ -0,0 +1,76 @@
+"""
+What an order line looked like when it was bought.
+
+Each OrderItem keeps a copy of its product's name, SKU and card image URL,
+and the variant's attribute label, taken at checkout. Order history reads
+them from the order_item rows alone, without joining the catalog. They
+keep showing what was bought after a product is renamed or its variants
+change.
+
+Lines ordered before the snapshot existed are filled in by the
+backfill_order_snapshots command, in batches.
+"""
+from django.db import transaction
+
+from . import renditions
+from .models import OrderItem
+
+BATCH_SIZE = 500
+
+FIELDS = ['product_name', 'product_sku', 'product_image', 'variant_label']
+
+
+def image_url(product):
+    """The image product listings show for the product, as at this moment"""
+    if product.name in renditions.PRODUCT_IMAGE_URLS:
+        return renditions.PRODUCT_IMAGE_URLS[product.name]
+    if product.image:
+        card = renditions.fallback_url(product.image_renditions, product.image.name, 'card')
+        return card or product.image.url
+    return ''
+
+
+def variant_label(variant):
+    """e.g. "Color: Red, Size: L"; uses prefetched attributes when there are any"""
+    if variant is None:
+        return ''
+    return ", ".join(str(attr) for attr in variant.attributes.all())
+
+
+def snapshot(product, variant=None):
+    """The snapshot fields of a line for the product and variant"""
+    return {
+        'product_name': product.name,
+        'product_sku': variant.sku if variant is not None else product.sku,
+        'product_image': image_url(product),
+        'variant_label': variant_label(variant),
+    }
+
+
+def take(item):
+    """Fill in the item's snapshot from its product and variant"""
+    for name, value in snapshot(item.product, item.variant).items():
+        setattr(item, name, value)
+    return item
+
+
+def backfill(batch_size=BATCH_SIZE, refresh=False):
+    """
+    Snapshot order lines that don't have one yet (all of them with refresh),
+    batch_size lines per transaction. Returns how many were written.
+    """
+    items = OrderItem.objects.select_related('product', 'variant').prefetch_related(
+        'variant__attributes__attribute'
+    ).order_by('pk')
+    if not refresh:
+        items = items.filter(product_name='')
+    written = 0
+    last = 0
+    while True:
+        batch = list(items.filter(pk__gt=last)[:batch_size])
+        if not batch:
+            return written
+        with transaction.atomic():
+            OrderItem.objects.bulk_update([take(item) for item in batch], FIELDS)
+        written += len(batch)
+        last = batch[-1].pk
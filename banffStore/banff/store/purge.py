@@ -0,0 +1,113 @@
+"""
+Deleting abandoned anonymous carts and expired sessions.
+
+Nothing else ever deletes an anonymous cart. Its session is long gone by
+the time anyone could come back for it. purge_carts() walks these carts
+oldest first through the (user, updated_at) index and deletes them a
+batch at a time, each batch in its own short transaction, so the SQLite
+writer lock is never held for long. purge_sessions() does the same for
+expired django_session rows.
+
+Run it from cron with the purge_abandoned_carts command. Nothing runs it
+inside the server processes, so several workers never compete for the
+same rows.
+"""
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Cart, CartItem
+
+BATCH_SIZE = 500
+
+
+def get_cart_max_age():
+    return timedelta(days=getattr(settings, 'STORE_ABANDONED_CART_DAYS', 7))
+
+
+@dataclass
+class PurgeResult:
+    carts: int = 0
+    cart_items: int = 0
+    sessions: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows(self):
+        return self.carts + self.cart_items + self.sessions
+
+    @property
+    def rows_per_second(self):
+        return round(self.rows / self.seconds, 1) if self.seconds else 0.0
+
+
+def delete_in_batches(queryset, delete, batch_size=BATCH_SIZE, pause=0.0):
+    """
+    Call delete(pks) with the primary keys of an ordered queryset,
+    batch_size at a time, until it is empty. Each batch is read and deleted
+    in its own transaction. Yields what delete() returned once that
+    transaction has committed, and sleeps for pause seconds between batches.
+    """
+    while True:
+        with transaction.atomic():
+            batch = list(queryset.values_list('pk', flat=True)[:batch_size])
+            deleted = delete(batch) if batch else None
+        if batch:
+            yield deleted
+        if len(batch) < batch_size:
+            return
+        if pause:
+            # Let waiting writers in
+            time.sleep(pause)
+
+
+def purge_carts(max_age=None, batch_size=BATCH_SIZE, pause=0.0, result=None):
+    """Delete anonymous carts unchanged for max_age, with their lines"""
+    result = result or PurgeResult()
+    cutoff = timezone.now() - (max_age or get_cart_max_age())
+    idle = Cart.objects.filter(user__isnull=True, updated_at__lt=cutoff)
+
+    def delete(batch):
+        # Checked again in the writing statements, in case a cart was just used
+        carts = idle.filter(pk__in=batch)
+        items = CartItem.objects.filter(cart__in=carts).delete()[0]
+        return items, carts.delete()[1].get(Cart._meta.label, 0)
+
+    for items, carts in delete_in_batches(idle.order_by('updated_at'), delete, batch_size, pause):
+        result.cart_items += items
+        result.carts += carts
+        result.batches += 1
+    return result
+
+
+def purge_sessions(batch_size=BATCH_SIZE, pause=0.0, result=None, store=None):
+    """Delete expired sessions of the configured session engine from the database"""
+    result = result or PurgeResult()
+    store = store or import_module(settings.SESSION_ENGINE).SessionStore
+    if not hasattr(store, 'get_model_class'):
+        # Not kept in the database; the backend expires them itself
+        store.clear_expired()
+        return result
+    model = store.get_model_class()
+    expired = model.objects.filter(expire_date__lt=timezone.now()).order_by('expire_date')
+    for sessions in delete_in_batches(
+        expired, lambda batch: model.objects.filter(pk__in=batch).delete()[0], batch_size, pause
+    ):
+        result.sessions += sessions
+        result.batches += 1
+    return result
+
+
+def run(max_age=None, batch_size=BATCH_SIZE, pause=0.0):
+    """Purge abandoned carts, then expired sessions"""
+    started = time.monotonic()
+    result = purge_carts(max_age, batch_size, pause)
+    purge_sessions(batch_size, pause, result)
+    result.seconds = time.monotonic() - started
+    return result
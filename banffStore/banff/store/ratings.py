@@ -0,0 +1,117 @@
+"""
+Incremental maintenance of the rating aggregates stored on Product.
+
+Every approved review contributes its rating to the product's sum, count,
+average and star histogram. Changes are applied as single UPDATE statements
+with F() expressions so concurrent reviews never overwrite each other.
+"""
+from collections import Counter
+
+from django.db.models import Case, Count, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import Cast
+
+from .models import Product, ProductReview
+
+STARS = range(1, 6)
+
+
+def apply_rating_delta(product_id, added=(), removed=()):
+    """Add and remove individual ratings from a product's stored aggregates"""
+    added, removed = list(added), list(removed)
+    count_delta = len(added) - len(removed)
+    sum_delta = sum(added) - sum(removed)
+    histogram = Counter(added)
+    histogram.subtract(removed)
+
+    if not count_delta and not sum_delta and not any(histogram.values()):
+        return
+
+    updates = {
+        'rating_sum': F('rating_sum') + sum_delta,
+        'review_count': F('review_count') + count_delta,
+        # The right-hand side sees the pre-update row, so derive the new
+        # average from the same deltas instead of the updated columns.
+        'average_rating': Case(
+            When(
+                review_count__gt=-count_delta,
+                then=Cast(F('rating_sum') + sum_delta, FloatField()) / (F('review_count') + count_delta),
+            ),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ),
+    }
+    for star, delta in histogram.items():
+        if delta:
+            field = f'rating_{star}_count'
+            updates[field] = F(field) + delta
+
+    Product.objects.filter(pk=product_id).update(**updates)
+
+
+def apply_review_change(previous, review):
+    """
+    Apply the difference between a review's previous state (a values() dict
+    or None for new reviews) and its current state
+    """
+    if previous and previous['is_approved']:
+        old = (previous['product_id'], previous['rating'])
+    else:
+        old = None
+    new = (review.product_id, review.rating) if review.is_approved else None
+
+    if old == new:
+        return
+    if old and new and old[0] == new[0]:
+        apply_rating_delta(new[0], added=[new[1]], removed=[old[1]])
+        return
+    if old:
+        apply_rating_delta(old[0], removed=[old[1]])
+    if new:
+        apply_rating_delta(new[0], added=[new[1]])
+
+
+def remove_review(review):
+    """Withdraw a deleted review's contribution"""
+    if review.is_approved:
+        apply_rating_delta(review.product_id, removed=[review.rating])
+
+
+def recompute_ratings(products=None):
+    """
+    Rebuild the aggregates from the reviews table.
+
+    Returns the number of products whose stored values were out of date.
+    """
+    if products is None:
+        products = Product.objects.all()
+
+    aggregates = {
+        row['product_id']: row
+        for row in ProductReview.objects.filter(
+            is_approved=True, product__in=products
+        ).values('product_id').annotate(
+            total=Sum('rating'),
+            count=Count('id'),
+            **{f'stars_{star}': Count('id', filter=Q(rating=star)) for star in STARS}
+        )
+    }
+
+    fields = ['rating_sum', 'review_count', 'average_rating'] + [f'rating_{star}_count' for star in STARS]
+    stale = []
+    for product in products.only('id', *fields).iterator(chunk_size=1000):
+        row = aggregates.get(product.id)
+        values = {
+            'rating_sum': row['total'] if row else 0,
+            'review_count': row['count'] if row else 0,
+        }
+        values['average_rating'] = values['rating_sum'] / values['review_count'] if row else 0
+        for star in STARS:
+            values[f'rating_{star}_count'] = row[f'stars_{star}'] if row else 0
+
+        if any(getattr(product, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(product, field, value)
+            stale.append(product)
+
+    Product.objects.bulk_update(stale, fields, batch_size=500)
+    return len(stale)
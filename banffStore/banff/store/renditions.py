@@ -0,0 +1,205 @@
+"""
+Resized, recompressed copies ("renditions") of catalog images.
+
+Every uploaded Product, ProductImage and ProductVariant image and every
+Brand logo gets a thumbnail, card and zoom size, each encoded as WebP plus
+a fallback (JPEG, or PNG when the source has transparency). The files live
+under renditions/<original name, dots as underscores>/ and are recorded on
+the owning row:
+
+    {'source': 'products/tee.jpg', 'fallback': 'jpeg', 'sizes': {
+        'card': {'width': 480, 'height': 320,
+                 'webp': 'renditions/products/tee_jpg/card.webp',
+                 'jpeg': 'renditions/products/tee_jpg/card.jpg'}, ...}}
+
+Encoding is CPU bound, so saves hand it to a process pool and the parent
+process records the result. A map whose source no longer matches the
+image field is stale and is ignored until it is regenerated.
+"""
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from PIL import Image, ImageOps, features
+
+from . import response_cache
+
+logger = logging.getLogger(__name__)
+
+# Static image URLs for the demo products, shown instead of their uploads
+PRODUCT_IMAGE_URLS = {
+    'Basic Tee': 'https://images.unsplash.com/photo-1521572163474-6864f9cf17ab?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
+    'Organic Cotton T-Shirt': 'https://images.unsplash.com/photo-1576566588028-4147f3842f27?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
+    'Classic Baseball Cap': 'https://images.unsplash.com/photo-1588850561407-ed78c282e89b?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
+    'Premium Hoodie': 'https://images.unsplash.com/photo-1556821840-3a63f95609a7?ixlib=rb-4.0.3&ixid=M3wxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8fA%3D%3D&auto=format&fit=crop&w=500&q=80',
+}
+
+SIZES = {
+    'thumbnail': (160, 160),
+    'card': (480, 480),
+    'zoom': (1600, 1600),
+}
+
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'png': ('PNG', 'png', {'optimize': True}),
+}
+
+# model label -> (image field, renditions field)
+SOURCES = {
+    'store.Product': ('image', 'image_renditions'),
+    'store.ProductImage': ('image', 'image_renditions'),
+    'store.ProductVariant': ('image', 'image_renditions'),
+    'store.Brand': ('logo', 'logo_renditions'),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_workers():
+    return getattr(settings, 'STORE_RENDITION_WORKERS', 2)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=get_workers())
+        return _executor
+
+
+def rendition_dir(name):
+    # Keep the extension, so tee.jpg and tee.png don't overwrite each other
+    return 'renditions/' + name.replace('.', '_')
+
+
+def generate(name):
+    """Write every rendition of a stored image and return its map"""
+    with default_storage.open(name) as source:
+        image = Image.open(source)
+        image.load()
+    image = ImageOps.exif_transpose(image)
+
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    fallback = 'png' if has_alpha else 'jpeg'
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    encodings = ['webp', fallback] if features.check('webp') else [fallback]
+
+    directory = rendition_dir(name)
+    sizes = {}
+    for size, bounds in SIZES.items():
+        resized = image.copy()
+        resized.thumbnail(bounds, Image.LANCZOS)
+        entry = {'width': resized.width, 'height': resized.height}
+        for encoding in encodings:
+            pil_format, extension, options = FORMATS[encoding]
+            buffer = BytesIO()
+            resized.save(buffer, pil_format, **options)
+            path = f'{directory}/{size}.{extension}'
+            if default_storage.exists(path):
+                default_storage.delete(path)
+            entry[encoding] = default_storage.save(path, ContentFile(buffer.getvalue()))
+        sizes[size] = entry
+    return {'source': name, 'fallback': fallback, 'sizes': sizes}
+
+
+def delete_files(renditions):
+    for entry in renditions.get('sizes', {}).values():
+        for encoding in FORMATS:
+            if encoding in entry:
+                default_storage.delete(entry[encoding])
+
+
+def is_current(renditions, name):
+    return bool(name) and bool(renditions) and renditions.get('source') == name
+
+
+def store(label, pk, renditions):
+    """Record a finished map, unless the image changed while it was generated"""
+    model = apps.get_model(label)
+    image_field, renditions_field = SOURCES[label]
+    rows = model.objects.filter(pk=pk, **{image_field: renditions['source']})
+    previous = rows.values_list(renditions_field, flat=True).first()
+    if previous is None or not rows.update(**{renditions_field: renditions}):
+        delete_files(renditions)
+        return False
+    if previous and previous.get('source') != renditions['source']:
+        delete_files(previous)
+    invalidate(model, pk)
+    return True
+
+
+def invalidate(model, pk):
+    if model._meta.label == 'store.Brand':
+        response_cache.invalidate(response_cache.BRANDS, response_cache.PRODUCTS)
+        return
+    if model._meta.label == 'store.Product':
+        product_id = pk
+    else:
+        product_id = model.objects.filter(pk=pk).values_list('product_id', flat=True).first()
+    response_cache.invalidate(response_cache.PRODUCTS, response_cache.product_tag(product_id))
+
+
+def _stored(label, pk, future):
+    # Runs on the executor's result thread, outside any request
+    close_old_connections()
+    try:
+        store(label, pk, future.result())
+    except Exception:
+        logger.exception('Could not generate renditions for %s %s', label, pk)
+    finally:
+        close_old_connections()
+
+
+def schedule(label, pk, name):
+    """Generate renditions in the background, or inline when workers is 0"""
+    if not get_workers():
+        store(label, pk, generate(name))
+        return
+    future = get_executor().submit(generate, name)
+    future.add_done_callback(lambda future: _stored(label, pk, future))
+
+
+def srcset(renditions, name, request=None):
+    """
+    The srcset-style map exposed by the API, or None while the image has no
+    current renditions: one entry per size plus a ready-made srcset string
+    per encoding.
+    """
+    if not is_current(renditions, name):
+        return None
+
+    def url(path):
+        url = default_storage.url(path)
+        return request.build_absolute_uri(url) if request is not None else url
+
+    result = {}
+    candidates = {}
+    for size, entry in renditions['sizes'].items():
+        result[size] = {'width': entry['width'], 'height': entry['height']}
+        for encoding in FORMATS:
+            if encoding in entry:
+                result[size][encoding] = url(entry[encoding])
+                # Small sources give the same width for several sizes
+                candidates.setdefault(encoding, {}).setdefault(entry['width'], result[size][encoding])
+    result['srcset'] = {
+        encoding: ', '.join(f'{link} {width}w' for width, link in sorted(widths.items()))
+        for encoding, widths in candidates.items()
+    }
+    result['fallback'] = renditions['fallback']
+    return result
+
+
+def fallback_url(renditions, name, size):
+    """URL of one size in the fallback encoding, if it has been generated"""
+    if not is_current(renditions, name):
+        return None
+    return default_storage.url(renditions['sizes'][size][renditions['fallback']])
@@ -0,0 +1,152 @@
+"""
+Tag-versioned cache for catalog API responses.
+
+Each entry remembers the version of every tag it depends on ("products",
+"product:<id>", "categories", "brands"). Catalog writes bump the affected
+tags, which orphans exactly the entries built from the old data; they
+then age out on their own timeout.
+
+Tag versions are nanosecond timestamps of the last change, so they double
+as cheap HTTP validators: the ETag hashes them with the request key and
+Last-Modified is the newest of them.
+
+Versions are read from the cache on every request, so invalidation reaches
+every process that shares the cache. With more than one server process that
+has to be a shared cache (REDIS_URL): on the per-process LocMemCache a
+change only invalidates the process that made it. `check --deploy` reports
+a process-local default cache (see store.checks).
+"""
+import hashlib
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+
+TAG_KEY = 'store:response:tag:{}'
+ENTRY_KEY = 'store:response:{}'
+SLUG_KEY = 'store:response:slug:{}'
+
+PRODUCTS = 'products'
+CATEGORIES = 'categories'
+BRANDS = 'brands'
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def product_tag(product_id):
+    return f'product:{product_id}'
+
+
+def wishlist_tag(user_id):
+    return f'wishlist:{user_id}'
+
+
+def get_timeout():
+    return getattr(settings, 'STORE_RESPONSE_CACHE_TIMEOUT', 300)
+
+
+def make_key(request, namespace=''):
+    """Key a request on its host, path and normalized query params"""
+    params = sorted(
+        (name, value)
+        for name, values in request.GET.lists()
+        for value in values
+    )
+    raw = '|'.join([namespace, request.scheme, request.get_host(), request.path, repr(params)])
+    return ENTRY_KEY.format(hashlib.md5(raw.encode()).hexdigest())
+
+
+def tag_versions(tags):
+    keys = {tag: TAG_KEY.format(tag) for tag in tags}
+    found = cache.get_many(keys.values())
+    missing = [key for key in keys.values() if key not in found]
+    if missing:
+        # Start from a timestamp rather than 0 so an evicted tag can never
+        # line up with the versions recorded in an older entry
+        for key in missing:
+            cache.add(key, time.time_ns(), timeout=None)
+        found.update(cache.get_many(missing))
+    return {tag: found.get(key) for tag, key in keys.items()}
+
+
+def get(key, versions, stats_name=None):
+    """Return cached data for key, or None if absent or built from older versions"""
+    entry = cache.get(key)
+    hit = entry is not None and entry['tags'] == versions
+    if stats_name:
+        record(stats_name, hit)
+    return entry['data'] if hit else None
+
+
+def set(key, data, versions):
+    """Store data along with the tag versions read before it was built"""
+    cache.set(key, {'tags': versions, 'data': data}, get_timeout())
+
+
+def etag(key, versions):
+    raw = key + repr(sorted(versions.items()))
+    return '"{}"'.format(hashlib.md5(raw.encode()).hexdigest())
+
+
+def last_modified(versions):
+    return datetime.fromtimestamp(max(versions.values()) // 10 ** 9, tz=timezone.utc)
+
+
+def invalidate(*tags):
+    """Move tags to a new version so dependent entries and ETags stop matching"""
+    now = time.time_ns()
+    cache.set_many({TAG_KEY.format(tag): now for tag in tags}, timeout=None)
+
+
+def product_id_for_slug(slug):
+    """Resolve a product slug to its id, remembering the answer"""
+    from .models import Product
+
+    key = SLUG_KEY.format(slug)
+    product_id = cache.get(key)
+    if product_id is None:
+        product_id = Product.objects.filter(slug=slug).values_list('id', flat=True).first()
+        if product_id is not None:
+            cache.set(key, product_id, get_timeout())
+    return product_id
+
+
+def product_ids_for_slugs(slugs):
+    """product_id_for_slug for many slugs, with one cache read and at most one query"""
+    from .models import Product
+
+    keys = {slug: SLUG_KEY.format(slug) for slug in slugs}
+    found = cache.get_many(keys.values())
+    ids = {slug: found.get(key) for slug, key in keys.items()}
+    missing = [slug for slug, product_id in ids.items() if product_id is None]
+    if missing:
+        looked_up = dict(Product.objects.filter(slug__in=missing).values_list('slug', 'id'))
+        cache.set_many({keys[slug]: product_id for slug, product_id in looked_up.items()}, get_timeout())
+        ids.update(looked_up)
+    return ids
+
+
+def forget_slug(slug):
+    cache.delete(SLUG_KEY.format(slug))
+
+
+def record(name, hit):
+    with _stats_lock:
+        _stats[(name, 'hits' if hit else 'misses')] += 1
+
+
+def stats():
+    """Per-view hit/miss counters for this process"""
+    with _stats_lock:
+        snapshot = dict(_stats)
+    report = {}
+    for (name, outcome), count in snapshot.items():
+        report.setdefault(name, {'hits': 0, 'misses': 0})[outcome] = count
+    for counts in report.values():
+        total = counts['hits'] + counts['misses']
+        counts['hit_rate'] = round(counts['hits'] / total, 4) if total else 0.0
+    return report
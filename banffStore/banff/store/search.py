@@ -0,0 +1,153 @@
+"""
+Full-text product search backed by an SQLite FTS5 index.
+
+store_product_search holds one row per active product (rowid = product id)
+with the product text plus its category and brand names. Signals keep it
+in step with Product/Category/Brand writes and rebuild_search_index
+repopulates it from scratch. On databases without FTS5 the helpers fall
+back to the original icontains search.
+"""
+import re
+
+from django.db import connection
+from django.db.models import FloatField, Q, TextField
+from django.db.models.expressions import RawSQL
+
+TABLE = 'store_product_search'
+COLUMNS = ['name', 'sku', 'short_description', 'description', 'category', 'brand']
+# bm25 column weights, in COLUMNS order
+WEIGHTS = [10.0, 5.0, 4.0, 1.0, 3.0, 3.0]
+# Snippet delimiters, swapped for <mark> after the snippet is HTML-escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+CREATE_SQL = (
+    f"CREATE VIRTUAL TABLE {TABLE} USING fts5("
+    f"{', '.join(COLUMNS)}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+POPULATE_SQL = f"""
+    INSERT INTO {TABLE} (rowid, {', '.join(COLUMNS)})
+    SELECT p.id, p.name, p.sku, p.short_description, p.description, c.name, COALESCE(b.name, '')
+    FROM store_product p
+    INNER JOIN store_category c ON c.id = p.category_id
+    LEFT OUTER JOIN store_brand b ON b.id = p.brand_id
+    WHERE p.status = 'active'
+"""
+
+_available = None
+
+
+def is_available():
+    """Whether the FTS index exists on the current database"""
+    global _available
+    if _available is None:
+        if connection.vendor != 'sqlite':
+            _available = False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [TABLE])
+                _available = cursor.fetchone() is not None
+    return _available
+
+
+def to_match_expression(query):
+    """Turn free text into an FTS5 query: every term must match, as a prefix"""
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_products(queryset, query):
+    """
+    Filter a Product queryset to the matches for query, annotated with
+    search_rank (lower is better) and search_snippet, ordered by relevance
+    """
+    if not is_available():
+        return queryset.filter(
+            Q(name__icontains=query) |
+            Q(sku__icontains=query) |
+            Q(description__icontains=query) |
+            Q(short_description__icontains=query) |
+            Q(category__name__icontains=query) |
+            Q(brand__name__icontains=query)
+        ).distinct()
+
+    match = to_match_expression(query)
+    if not match:
+        return queryset.none()
+
+    weights = ', '.join(str(weight) for weight in WEIGHTS)
+    return queryset.filter(
+        pk__in=RawSQL(f'SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s', (match,))
+    ).annotate(
+        search_rank=RawSQL(_matched(f'bm25({TABLE}, {weights})'), (match,), output_field=FloatField()),
+        search_snippet=RawSQL(
+            _matched(f"snippet({TABLE}, -1, %s, %s, '…', 16)"),
+            (HIGHLIGHT_START, HIGHLIGHT_END, match),
+            output_field=TextField(),
+        ),
+    ).order_by('search_rank', 'pk')
+
+
+def _matched(function):
+    """
+    A subquery evaluating an FTS5 auxiliary function for the outer product.
+    They only work in a query that MATCHes the index, so each one repeats it.
+    """
+    return f'SELECT {function} FROM {TABLE} WHERE {TABLE} MATCH %s AND {TABLE}.rowid = "store_product"."id"'
+
+
+def _execute(sql, params=()):
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def index_product(product_id):
+    """(Re)index a single product, dropping it if it is no longer active"""
+    _execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [product_id])
+    _execute(f'{POPULATE_SQL} AND p.id = %s', [product_id])
+
+
+def index_products(product_ids):
+    """(Re)index a batch of products, e.g. after bulk writes that skip signals"""
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+    placeholders = ', '.join(['%s'] * len(product_ids))
+    _execute(f'DELETE FROM {TABLE} WHERE rowid IN ({placeholders})', product_ids)
+    _execute(f'{POPULATE_SQL} AND p.id IN ({placeholders})', product_ids)
+
+
+def remove_product(product_id):
+    _execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [product_id])
+
+
+def update_category_name(category_id, name):
+    _execute(
+        f'UPDATE {TABLE} SET category = %s WHERE rowid IN '
+        f'(SELECT id FROM store_product WHERE category_id = %s)',
+        [name, category_id]
+    )
+
+
+def update_brand_name(brand_id, name):
+    _execute(
+        f'UPDATE {TABLE} SET brand = %s WHERE rowid IN '
+        f'(SELECT id FROM store_product WHERE brand_id = %s)',
+        [name, brand_id]
+    )
+
+
+def rebuild():
+    """Drop and repopulate the whole index; returns the number of rows"""
+    global _available
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {TABLE}')
+        cursor.execute(CREATE_SQL)
+        cursor.execute(POPULATE_SQL)
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+        cursor.execute(f'SELECT COUNT(*) FROM {TABLE}')
+        count = cursor.fetchone()[0]
+    _available = True
+    return count
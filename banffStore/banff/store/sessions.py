@@ -0,0 +1,103 @@
+"""
+Session engine that only writes when there is something to write.
+
+With SESSION_SAVE_EVERY_REQUEST every request carrying a session rewrites
+it, only to push its expiry forward. On SQLite those writes all queue for
+the one writer lock. This engine keeps sessions in the cache, written
+through to the database when STORE_SESSION_WRITE_THROUGH is on (so they
+survive a cache flush), and skips the write unless
+
+    - the session data changed, or
+    - the stored copy was last written STORE_SESSION_REFRESH_SECONDS ago
+
+The cookie is still refreshed on every request. The stored copy may
+therefore expire up to STORE_SESSION_REFRESH_SECONDS before the cookie
+does; pick a refresh interval that is small next to SESSION_COOKIE_AGE.
+
+Use it with SESSION_ENGINE = 'store.sessions', and only with a cache that
+every server process shares (settings.py picks it when REDIS_URL is set).
+On a per-process cache such as LocMemCache each worker would keep serving
+its own copy of a session after another worker changed it, and sessions
+without write-through would be lost with the process.
+
+Expired database rows are deleted in batches by clear_expired(), which
+the clearsessions command calls. stats() reports how many writes the
+engine saved in this process.
+"""
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.sessions.backends import cache as cache_backend
+from django.contrib.sessions.backends import cached_db
+
+from . import purge
+
+SAVED_AT = '_store_saved_at'
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_refresh_seconds():
+    return getattr(settings, 'STORE_SESSION_REFRESH_SECONDS', 3600)
+
+
+def record(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats():
+    """Session writes per request for this process, without and with coalescing"""
+    with _stats_lock:
+        snapshot = dict(_stats)
+    requests, saves, writes = (snapshot.get(name, 0) for name in ('requests', 'saves', 'writes'))
+    return {
+        'engine': settings.SESSION_ENGINE,
+        'requests': requests,
+        'save_calls': saves,
+        'writes': writes,
+        'writes_per_request_before': round(saves / requests, 4) if requests else 0.0,
+        'writes_per_request_after': round(writes / requests, 4) if requests else 0.0,
+    }
+
+
+class CoalescedWritesMixin:
+    """Skips saves of sessions that are unchanged and not due for a refresh"""
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        record('requests')
+
+    def is_stale(self):
+        saved_at = self._get_session().get(SAVED_AT)
+        return saved_at is None or time.time() - saved_at >= get_refresh_seconds()
+
+    def save(self, must_create=False):
+        # Each call is a write without coalescing
+        record('saves')
+        if not must_create and not self.modified and self.session_key and not self.is_stale():
+            return
+        # Written into the data directly so the stamp itself doesn't count as a change
+        self._get_session()[SAVED_AT] = int(time.time())
+        super().save(must_create)
+        record('writes')
+
+
+class CacheSessionStore(CoalescedWritesMixin, cache_backend.SessionStore):
+    """Sessions in the cache only"""
+
+
+class CachedDBSessionStore(CoalescedWritesMixin, cached_db.SessionStore):
+    """Sessions in the cache, written through to the database"""
+    @classmethod
+    def clear_expired(cls, batch_size=purge.BATCH_SIZE):
+        """Delete expired rows a batch at a time; returns how many were deleted"""
+        return purge.purge_sessions(batch_size, store=cls).sessions
+
+
+if getattr(settings, 'STORE_SESSION_WRITE_THROUGH', True):
+    SessionStore = CachedDBSessionStore
+else:
+    SessionStore = CacheSessionStore
@@ -0,0 +1,170 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import carts, category_tree, coupons, renditions, response_cache, search, suggest
+from .models import Brand, Category, Coupon, Product, ProductImage, ProductReview, ProductVariant, Wishlist
+from .ratings import remove_review
+
+
+@receiver(post_delete, sender=ProductReview)
+def review_deleted(sender, instance, **kwargs):
+    """Keep product rating aggregates in sync when reviews are removed"""
+    remove_review(instance)
+
+
+def _invalidate_on_commit(*tags):
+    transaction.on_commit(lambda: response_cache.invalidate(*tags))
+
+
+@receiver(pre_save, sender=Product)
+def product_before_save(sender, instance, **kwargs):
+    """Remember the stored slug, so a rename also forgets the old one"""
+    instance._stored_slug = None
+    if instance.pk is not None:
+        instance._stored_slug = Product.objects.filter(pk=instance.pk).values_list('slug', flat=True).first()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, signal, created=False, raw=False, **kwargs):
+    """
+    Bring everything derived from a product up to date: its search row now,
+    and once committed its autocomplete entry, cart prices, cached
+    responses and slug lookups
+    """
+    deleted = signal is post_delete
+    product_id = instance.pk
+    slugs = {instance.slug, getattr(instance, '_stored_slug', None)} - {None}
+    if deleted:
+        search.remove_product(product_id)
+    elif not raw:
+        search.index_product(product_id)
+
+    def changed():
+        if not raw:
+            suggest.record_change('product', product_id)
+            if not (created or deleted):
+                carts.refresh_prices([product_id])
+        response_cache.invalidate(response_cache.PRODUCTS, response_cache.product_tag(product_id))
+        for slug in slugs:
+            response_cache.forget_slug(slug)
+
+    transaction.on_commit(changed)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, signal, created=False, raw=False, **kwargs):
+    """
+    Rename the category in the search index now, and once committed rebuild
+    the category tree and its autocomplete entry and drop cached responses
+    """
+    if signal is post_save and not (created or raw):
+        search.update_category_name(instance.pk, instance.name)
+    category_id = instance.pk
+
+    def changed():
+        category_tree.invalidate()
+        if not raw:
+            suggest.record_change('category', category_id)
+        response_cache.invalidate(response_cache.CATEGORIES, response_cache.PRODUCTS)
+
+    transaction.on_commit(changed)
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+def brand_changed(sender, instance, signal, created=False, raw=False, **kwargs):
+    """
+    Rename the brand in the search index now, and once committed update its
+    autocomplete entry and drop cached responses
+    """
+    if signal is post_save and not (created or raw):
+        search.update_brand_name(instance.pk, instance.name)
+    brand_id = instance.pk
+
+    def changed():
+        if not raw:
+            suggest.record_change('brand', brand_id)
+        response_cache.invalidate(response_cache.BRANDS, response_cache.PRODUCTS)
+
+    transaction.on_commit(changed)
+
+
+@receiver(pre_delete, sender=Brand)
+def brand_deleted(sender, instance, **kwargs):
+    # Products are SET_NULL without signals, so clear the name beforehand
+    search.update_brand_name(instance.pk, '')
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_delete, sender=ProductVariant)
+def product_detail_changed(sender, instance, signal, created=False, raw=False, **kwargs):
+    # Gallery images and variants only appear on the detail page
+    product_id = instance.product_id
+    _invalidate_on_commit(response_cache.product_tag(product_id))
+    if sender is ProductVariant and signal is post_save and not (created or raw):
+        # Variant prices override the product's in cart lines
+        transaction.on_commit(lambda: carts.refresh_prices([product_id]))
+
+
+@receiver(m2m_changed, sender=ProductVariant.attributes.through)
+def variant_attributes_cache_invalidation(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        _invalidate_on_commit(response_cache.product_tag(instance.product_id))
+        return
+    # An attribute value changed its variants; pk_set holds variant ids
+    product_ids = ProductVariant.objects.filter(pk__in=pk_set or ()).values_list('product_id', flat=True)
+    tags = [response_cache.product_tag(product_id) for product_id in set(product_ids)]
+    if tags:
+        _invalidate_on_commit(*tags)
+
+
+@receiver(m2m_changed, sender=Wishlist.products.through)
+def wishlist_cache_invalidation(sender, instance, action, reverse, pk_set, **kwargs):
+    """is_wishlisted is added per user; move the tags of the users whose wishlist changed"""
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        _invalidate_on_commit(response_cache.wishlist_tag(instance.user_id))
+        return
+    # A product changed wishlists; read who had it before a clear empties them
+    wishlists = instance.wishlisted_by.all() if action == 'pre_clear' else Wishlist.objects.filter(pk__in=pk_set)
+    tags = [response_cache.wishlist_tag(user_id) for user_id in wishlists.values_list('user_id', flat=True)]
+    if tags:
+        _invalidate_on_commit(*tags)
+
+
+@receiver(post_save, sender=ProductReview)
+@receiver(post_delete, sender=ProductReview)
+def review_cache_invalidation(sender, instance, **kwargs):
+    # Reviews change the rating aggregates shown in listings as well
+    _invalidate_on_commit(response_cache.PRODUCTS, response_cache.product_tag(instance.product_id))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=ProductVariant)
+@receiver(post_save, sender=Brand)
+def image_uploaded(sender, instance, raw=False, **kwargs):
+    """Generate renditions for a new or replaced image once it is committed"""
+    if raw:
+        return
+    image_field, renditions_field = renditions.SOURCES[sender._meta.label]
+    name = getattr(instance, image_field).name
+    if name and not renditions.is_current(getattr(instance, renditions_field), name):
+        label = sender._meta.label
+        object_id = instance.pk
+        transaction.on_commit(lambda: renditions.schedule(label, object_id, name))
+
+
+@receiver(post_save, sender=Coupon)
+def coupon_saved(sender, instance, raw=False, **kwargs):
+    """Spread the uses left under a new or changed limit over the shards"""
+    if not raw:
+        coupons.allocate(instance)
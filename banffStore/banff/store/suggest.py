@@ -0,0 +1,228 @@
+"""
+In-memory prefix index for search-box autocomplete.
+
+Product, brand and category names are indexed under every word-boundary
+suffix ("basic tee" and "tee") in one sorted list, so a prefix lookup is a
+bisect plus a short scan. Ranked results are memoized per prefix.
+
+Catalog writes append numbered change records to the cache. A process
+that is only a few changes behind replays them against a copy of its local
+index; one that has fallen further behind rebuilds from scratch. Either way
+the new index replaces the old one in a single assignment, so lookups never
+run against an index that is being changed. Other processes
+only see the records through a shared cache (REDIS_URL, see store.checks).
+"""
+import bisect
+import threading
+import time
+import unicodedata
+
+from django.core.cache import cache
+from django.db.models import Sum
+
+from .models import Brand, Category, OrderItem, Product
+
+VERSION_KEY = 'store:suggest:version'
+CHANGE_KEY = 'store:suggest:change:{}'
+MAX_REPLAY = 200
+MAX_RESULTS = 20
+MEMO_SIZE = 4096
+
+_lock = threading.Lock()
+_index = None
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in text if not unicodedata.combining(char)).strip()
+
+
+def _keys_for(label):
+    words = normalize(label).split()
+    return {' '.join(words[start:]) for start in range(len(words))}
+
+
+class SuggestIndex:
+    def __init__(self, version):
+        self.version = version
+        self._keys = []  # sorted (key, entry_id)
+        self._entries = {}
+        self._memo = {}
+
+    def add(self, entry_id, label, slug, popularity):
+        keys = _keys_for(label)
+        self._entries[entry_id] = {
+            'type': entry_id[0], 'id': entry_id[1], 'label': label, 'slug': slug,
+            'popularity': popularity, 'keys': keys,
+        }
+        for key in keys:
+            bisect.insort(self._keys, (key, entry_id))
+        self._memo.clear()
+
+    def remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in entry['keys']:
+            position = bisect.bisect_left(self._keys, (key, entry_id))
+            if position < len(self._keys) and self._keys[position] == (key, entry_id):
+                del self._keys[position]
+        self._memo.clear()
+
+    def bulk_load(self, rows):
+        """Load (entry_id, label, slug, popularity) rows and sort once"""
+        for entry_id, label, slug, popularity in rows:
+            keys = _keys_for(label)
+            self._entries[entry_id] = {
+                'type': entry_id[0], 'id': entry_id[1], 'label': label, 'slug': slug,
+                'popularity': popularity, 'keys': keys,
+            }
+            self._keys.extend((key, entry_id) for key in keys)
+        self._keys.sort()
+
+    def copy(self, version):
+        """A new index with the same entries, to apply changes to"""
+        index = SuggestIndex(version)
+        index._keys = list(self._keys)
+        index._entries = dict(self._entries)
+        return index
+
+    def lookup(self, prefix, limit):
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        results = self._memo.get(prefix)
+        if results is None:
+            seen = set()
+            position = bisect.bisect_left(self._keys, (prefix,))
+            while position < len(self._keys) and self._keys[position][0].startswith(prefix):
+                seen.add(self._keys[position][1])
+                position += 1
+            entries = sorted(
+                (self._entries[entry_id] for entry_id in seen),
+                key=lambda entry: (-entry['popularity'], entry['label'])
+            )
+            results = [
+                {'type': entry['type'], 'id': entry['id'], 'label': entry['label'], 'slug': entry['slug']}
+                for entry in entries[:MAX_RESULTS]
+            ]
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[prefix] = results
+        return results[:limit]
+
+    def reload(self, kind, object_id):
+        """Re-read one catalog object and replace its entry"""
+        entry_id = (kind, object_id)
+        previous = self._entries.get(entry_id)
+        self.remove(entry_id)
+
+        if kind == 'product':
+            product = Product.objects.filter(pk=object_id, status='active').values(
+                'name', 'slug', 'review_count'
+            ).first()
+            if product:
+                sold = OrderItem.objects.filter(product_id=object_id).aggregate(n=Sum('quantity'))['n'] or 0
+                self.add(entry_id, product['name'], product['slug'], sold + product['review_count'])
+            return
+
+        model = Brand if kind == 'brand' else Category
+        row = model.objects.filter(pk=object_id, is_active=True).values('name', 'slug').first()
+        if row:
+            popularity = previous['popularity'] if previous else 0
+            self.add(entry_id, row['name'], row['slug'], popularity)
+
+
+def build_index(version):
+    index = SuggestIndex(version)
+    sold = dict(
+        OrderItem.objects.values('product_id').annotate(n=Sum('quantity')).values_list('product_id', 'n')
+    )
+
+    rows = []
+    brand_popularity = {}
+    category_popularity = {}
+    products = Product.objects.filter(status='active').values_list(
+        'id', 'name', 'slug', 'review_count', 'brand_id', 'category_id'
+    )
+    for product_id, name, slug, review_count, brand_id, category_id in products.iterator(chunk_size=2000):
+        popularity = sold.get(product_id, 0) + review_count
+        rows.append((('product', product_id), name, slug, popularity))
+        if brand_id:
+            brand_popularity[brand_id] = brand_popularity.get(brand_id, 0) + popularity + 1
+        category_popularity[category_id] = category_popularity.get(category_id, 0) + popularity + 1
+
+    for brand_id, name, slug in Brand.objects.filter(is_active=True).values_list('id', 'name', 'slug'):
+        rows.append((('brand', brand_id), name, slug, brand_popularity.get(brand_id, 0)))
+    for category_id, name, slug in Category.objects.filter(is_active=True).values_list('id', 'name', 'slug'):
+        rows.append((('category', category_id), name, slug, category_popularity.get(category_id, 0)))
+
+    index.bulk_load(rows)
+    return index
+
+
+def get_index():
+    """Return the local index, catching up with changes from other processes"""
+    global _index
+    version = _current_version()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+
+    with _lock:
+        if _index is not None and _index.version == version:
+            return _index
+        behind = version - _index.version if _index is not None else None
+        changes = None
+        if behind is not None and 0 < behind <= MAX_REPLAY:
+            keys = [CHANGE_KEY.format(number) for number in range(_index.version + 1, version + 1)]
+            found = cache.get_many(keys)
+            if len(found) == len(keys):
+                changes = [found[key] for key in keys]
+
+        if changes is None:
+            index = build_index(version)
+        else:
+            index = _index.copy(version)
+            for kind, object_id in changes:
+                index.reload(kind, object_id)
+        _index = index
+        return index
+
+
+def _seed_version():
+    # Numbering restarts from a timestamp rather than 0 when the cache loses
+    # it, so a process's old index can never line up with the new numbers
+    cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def _current_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        _seed_version()
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _next_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        _seed_version()
+        return cache.incr(VERSION_KEY)
+
+
+def record_change(kind, object_id):
+    """Publish a catalog change so every process updates its index"""
+    version = _next_version()
+    cache.set(CHANGE_KEY.format(version), (kind, object_id), timeout=3600)
+
+
+def invalidate():
+    """Make every process rebuild its index, e.g. after a bulk import"""
+    # A version without a change record cannot be replayed
+    _next_version()
+
+
+def suggest(prefix, limit=8):
+    return get_index().lookup(prefix, limit)
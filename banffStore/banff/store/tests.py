@@ -1,3 +1,1294 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from . import (
+    anonymous_carts, carts, catalog_import, category_tree, checkout, checks, coupons, exports, inventory,
+    order_snapshots, purge, renditions, response_cache, search, sessions, suggest,
+)
+from .models import (
+    Brand, Cart, CartItem, Category, Coupon, CouponRedemption, CouponShard, InventoryHold, Order, OrderItem, Product,
+    ProductAttribute, ProductAttributeValue, ProductReview, ProductVariant,
+)
+
+ADDRESS = {
+    f'{kind}_{name}': 'x'
+    for kind in ('billing', 'shipping')
+    for name in ('first_name', 'last_name', 'address_line1', 'city', 'state', 'zip_code', 'country')
+}
+ADDRESS['billing_email'] = 'buyer@example.com'
+
+
+def make_coupon(**fields):
+    now = timezone.now()
+    return Coupon.objects.create(
+        code=fields.pop('code', 'SALE'), discount_type='fixed', discount_value=5,
+        valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1), **fields
+    )
+
+
+def make_cart(user, product):
+    cart = Cart.objects.create(user=user)
+    CartItem.objects.create(cart=cart, product=product, quantity=1)
+    return cart
+
+
+def make_order(user, product, quantity=1):
+    total = product.price * quantity
+    order = Order.objects.create(user=user, subtotal=total, total_amount=total, **ADDRESS)
+    OrderItem.objects.create(order=order, product=product, quantity=quantity, unit_price=product.price)
+    return order
+
+
+def race_checkouts(carts, **options):
+    """Check out every cart at once from its own thread; returns the outcomes"""
+    results = []
+    start = threading.Barrier(len(carts))
+
+    def buy(cart):
+        start.wait()
+        try:
+            while True:
+                try:
+                    checkout.place_order(cart, cart.user, ADDRESS, **options)
+                    results.append('ordered')
+                    return
+                except OperationalError:
+                    # SQLite lets one writer in at a time; try again
+                    time.sleep(0.005)
+                except checkout.CheckoutError:
+                    results.append('refused')
+                    return
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=buy, args=(cart,)) for cart in carts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', description='', price=20, category=self.category)
+        self.users = [User.objects.create_user(f'reviewer{i}') for i in range(3)]
+
+    def review(self, user, rating, **fields):
+        return ProductReview.objects.create(
+            product=self.product, user=user, rating=rating, title='t', comment='c', **fields
+        )
+
+    def assertRatings(self, count, average, histogram):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.review_count, count)
+        self.assertAlmostEqual(self.product.average_rating, average)
+        self.assertEqual([getattr(self.product, f'rating_{star}_count') for star in range(1, 6)], histogram)
+
+    def test_reviews_update_the_stored_aggregates(self):
+        first = self.review(self.users[0], 5)
+        self.review(self.users[1], 3)
+        hidden = self.review(self.users[2], 1, is_approved=False)
+        self.assertRatings(2, 4, [0, 0, 1, 0, 1])
+
+        hidden.is_approved = True
+        hidden.save()
+        self.assertRatings(3, 3, [1, 0, 1, 0, 1])
+
+        first.rating = 2
+        first.save()
+        self.assertRatings(3, 2, [1, 1, 1, 0, 0])
+
+        first.delete()
+        self.assertRatings(2, 2, [1, 0, 1, 0, 0])
+
+    def test_rebuild_repairs_drift(self):
+        self.review(self.users[0], 4)
+        Product.objects.filter(pk=self.product.pk).update(review_count=7, average_rating=1, rating_4_count=0)
+        stdout = io.StringIO()
+        call_command('rebuild_ratings', stdout=stdout)
+        self.assertIn('repaired 1', stdout.getvalue())
+        self.assertRatings(1, 4, [0, 0, 0, 1, 0])
+
+    def test_listing_orders_and_filters_by_the_stored_average(self):
+        low = Product.objects.create(name='Cap', description='', price=10, category=self.category)
+        ProductReview.objects.create(product=low, user=self.users[0], rating=2, title='t', comment='c')
+        self.review(self.users[0], 5)
+        client = APIClient()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/store/products/', {'ordering': '-average_rating'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Tee', 'Cap'])
+        self.assertEqual(response.data['results'][0]['review_count'], 1)
+        self.assertFalse(any('store_productreview' in query['sql'] for query in queries.captured_queries))
+
+        response = client.get('/api/store/products/', {'min_rating': 3})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Tee'])
+        for value in ('abc', 'nan'):
+            response = client.get('/api/store/products/', {'min_rating': value})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('min_rating', response.data)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        category = Category.objects.create(name='Tees')
+        for number, price in enumerate([30, 10, 20, 10, 30, 10, 20]):
+            Product.objects.create(name=f'Tee {number}', description='', price=price, category=category)
+        self.expected = list(Product.objects.order_by('price', 'pk').values_list('name', flat=True))
+
+    def walk(self, url, params=None, direction='next'):
+        pages = []
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+            url, params = response.data[direction], None
+        return pages
+
+    def test_pages_cover_ties_once_in_order(self):
+        pages = self.walk('/api/store/products/', {'pagination': 'cursor', 'ordering': 'price', 'page_size': 3})
+        self.assertEqual([len(page['results']) for page in pages], [3, 3, 1])
+        self.assertEqual([row['name'] for page in pages for row in page['results']], self.expected)
+        self.assertTrue(all(page['count'] == 7 for page in pages))
+
+        # Walking back from the last page retraces the same pages
+        back = self.walk(pages[-1]['previous'], direction='previous')
+        self.assertEqual(
+            [row['name'] for page in reversed(back) for row in page['results']], self.expected[:6]
+        )
+
+    def test_deeper_pages_are_a_range_scan_with_a_cached_count(self):
+        first = self.client.get('/api/store/products/', {'pagination': 'cursor', 'ordering': 'price', 'page_size': 2})
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(first.data['next'])
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertEqual(second.data['count'], 7)
+        self.assertNotIn('COUNT(', sql)
+        self.assertNotIn('OFFSET', sql)
+
+    def test_rejects_a_bad_cursor(self):
+        response = self.client.get('/api/store/products/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+class FacetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True):
+            tees = Category.objects.create(name='Tees')
+            hoodies = Category.objects.create(name='Hoodies')
+        acme = Brand.objects.create(name='Acme', slug='acme')
+        other = Brand.objects.create(name='Other', slug='other')
+        Product.objects.create(name='Tee', description='', price=20, stock=5, category=tees, brand=acme)
+        Product.objects.create(name='Hoodie', description='', price=120, stock=0, category=hoodies, brand=acme)
+        Product.objects.create(name='Polo', description='', price=60, stock=3, category=tees, brand=other)
+
+    def test_counts_every_facet_in_one_grouped_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/store/products/', {'facets': 'true'})
+        facets = response.data['facets']
+        self.assertEqual(
+            [(brand['slug'], brand['count']) for brand in facets['brands']], [('acme', 2), ('other', 1)]
+        )
+        self.assertEqual(
+            [(category['name'], category['count']) for category in facets['categories']],
+            [('Tees', 2), ('Hoodies', 1)]
+        )
+        self.assertEqual([bucket['count'] for bucket in facets['price_ranges']], [1, 1, 1, 0, 0])
+        self.assertEqual(facets['in_stock'], {'in_stock': 2, 'out_of_stock': 1})
+        self.assertEqual(facets['price'], {'min': '20.00', 'max': '120.00'})
+        grouped = [query for query in queries.captured_queries if 'GROUP BY' in query['sql']]
+        self.assertEqual(len(grouped), 1)
+
+    def test_follows_the_listing_filters(self):
+        response = self.client.get('/api/store/products/', {'facets': 'true', 'brand': 'acme', 'in_stock': 'true'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Tee'])
+        facets = response.data['facets']
+        self.assertEqual([(brand['slug'], brand['count']) for brand in facets['brands']], [('acme', 1)])
+        self.assertEqual(facets['price'], {'min': '20.00', 'max': '20.00'})
+
+    def test_units_held_by_carts_are_not_in_stock(self):
+        Product.objects.filter(name='Polo').update(reserved=3)
+        response = self.client.get('/api/store/products/', {'facets': 'true', 'in_stock': 'true'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Tee'])
+        response = self.client.get('/api/store/products/', {'facets': 'true'})
+        self.assertEqual(response.data['facets']['in_stock'], {'in_stock': 1, 'out_of_stock': 2})
+
+    def test_left_out_unless_asked_for(self):
+        self.assertNotIn('facets', self.client.get('/api/store/products/').data)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.category = Category.objects.create(name='Tees')
+        self.brand = Brand.objects.create(name='Acme', slug='acme')
+        self.product = Product.objects.create(
+            name='Tee', slug='tee', description='', price=20, category=self.category, brand=self.brand
+        )
+
+    def test_matching_etag_is_answered_without_queries(self):
+        for url in ['/api/store/products/', '/api/store/products/tee/', '/api/store/categories/', '/api/store/brands/']:
+            etag = self.client.get(url)['ETag']
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=f'W/{etag}')
+            self.assertEqual(response.status_code, 304, url)
+            self.assertEqual(response['ETag'], etag)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get('/api/store/products/tee/')['Last-Modified']
+        response = self.client.get('/api/store/products/tee/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_catalog_writes_change_the_validators(self):
+        before = {url: self.client.get(url)['ETag'] for url in ['/api/store/products/', '/api/store/products/tee/']}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 25
+            self.product.save()
+        for url, etag in before.items():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertNotEqual(response['ETag'], etag)
+
+
+class FieldSpecTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        category = Category.objects.create(name='Tees')
+        brand = Brand.objects.create(name='Acme', slug='acme')
+        self.product = Product.objects.create(
+            name='Tee', slug='tee', description='', price=20, stock=10, category=category, brand=brand
+        )
+
+    def test_fields_prune_the_response_and_its_joins(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/store/products/', {'fields': 'id,name,price'})
+        self.assertEqual(response.data['results'], [{'id': self.product.pk, 'name': 'Tee', 'price': '20.00'}])
+        sql = ' '.join(query['sql'] for query in queries.captured_queries)
+        self.assertNotIn('store_brand', sql)
+
+    def test_expand_nests_only_the_listed_relations(self):
+        row = self.client.get('/api/store/products/', {'expand': 'brand'}).data['results'][0]
+        self.assertEqual(row['brand']['slug'], 'acme')
+        self.assertEqual(row['category'], self.product.category_id)
+
+        row = self.client.get('/api/store/products/').data['results'][0]
+        self.assertEqual(row['category']['name'], 'Tees')
+
+    def test_nested_fields_on_orders(self):
+        user = User.objects.create_user('buyer')
+        make_order(user, self.product)
+        self.client.force_authenticate(user)
+        response = self.client.get('/api/store/orders/', {'fields': 'order_number,items.quantity'})
+        order = response.data['results'][0]
+        self.assertEqual(set(order), {'order_number', 'items'})
+        self.assertEqual(order['items'], [{'quantity': 1}])
+
+
+def make_image(name, size=(800, 600), mode='RGB'):
+    buffer = io.BytesIO()
+    Image.new(mode, size).save(buffer, 'PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+@override_settings(STORE_RENDITION_WORKERS=0)
+class RenditionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        self.category = Category.objects.create(name='Tees')
+
+    def make_product(self, image):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.create(
+                name='Tee', slug='tee', description='', price=20, category=self.category, image=image
+            )
+        product.refresh_from_db()
+        return product
+
+    def test_upload_generates_every_size_without_upscaling(self):
+        product = self.make_product(make_image('tee.png'))
+        sizes = product.image_renditions['sizes']
+        self.assertEqual(product.image_renditions['fallback'], 'jpeg')
+        self.assertEqual(
+            {size: (entry['width'], entry['height']) for size, entry in sizes.items()},
+            {'thumbnail': (160, 120), 'card': (480, 360), 'zoom': (800, 600)}
+        )
+        self.assertTrue(sizes['card']['jpeg'].endswith('card.jpg'))
+
+        data = self.client.get('/api/store/products/tee/').json()
+        self.assertIn('card.jpg 480w', data['image_srcset']['srcset']['jpeg'])
+        self.assertTrue(data['image_srcset']['card']['webp'].startswith('http://testserver/'))
+        listed = self.client.get('/api/store/products/').json()['results'][0]
+        self.assertTrue(listed['image'].endswith('card.jpg'))
+        self.assertTrue(listed['image_srcset']['card']['webp'].startswith('http://testserver/'))
+
+    def test_transparent_images_fall_back_to_png(self):
+        product = self.make_product(make_image('tee.png', mode='RGBA'))
+        self.assertEqual(product.image_renditions['fallback'], 'png')
+
+    def test_sources_differing_by_extension_keep_their_own_renditions(self):
+        jpeg = self.make_product(make_image('tee.jpg'))
+        with self.captureOnCommitCallbacks(execute=True):
+            png = Product.objects.create(
+                name='Tee 2', slug='tee-2', description='', price=20, category=self.category,
+                image=make_image('tee.png'),
+            )
+        png.refresh_from_db()
+        first = jpeg.image_renditions['sizes']['card']['jpeg']
+        self.assertNotEqual(first, png.image_renditions['sizes']['card']['jpeg'])
+        self.assertTrue(default_storage.exists(first))
+
+    def test_missing_or_stale_maps_are_regenerated(self):
+        product = self.make_product(make_image('tee.png'))
+        self.assertFalse(renditions.is_current(product.image_renditions, 'products/other.png'))
+
+        Product.objects.filter(pk=product.pk).update(image_renditions={})
+        stdout = io.StringIO()
+        call_command('regenerate_renditions', model=['product'], stdout=stdout)
+        self.assertIn('Regenerated 1 of 1', stdout.getvalue())
+        product.refresh_from_db()
+        self.assertTrue(renditions.is_current(product.image_renditions, product.image.name))
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user('admin', is_staff=True)
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', sku='TEE', description='', price=20, stock=10, category=category)
+        ProductVariant.objects.create(product=self.product, sku='TEE-L', stock=4)
+        self.buyer = User.objects.create_user('buyer')
+        make_order(self.buyer, self.product)
+
+    def read(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def test_admins_only(self):
+        self.client.force_authenticate(self.buyer)
+        self.assertEqual(self.client.get('/api/store/exports/products/').status_code, 403)
+
+    def test_catalog_csv_has_a_row_per_product_and_variant(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/store/exports/products/')
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="products-', response['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(self.read(response))))
+        self.assertEqual([(row['sku'], row['variant_sku']) for row in rows], [('TEE', ''), ('TEE', 'TEE-L')])
+        self.assertEqual(rows[1]['variant_stock'], '4')
+
+    def test_order_jsonl_filters_by_date(self):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/store/exports/orders/', {'format': 'jsonl'})
+        lines = [json.loads(line) for line in self.read(response).splitlines()]
+        self.assertEqual([(line['username'], line['product_sku'], line['quantity']) for line in lines], [('buyer', 'TEE', 1)])
+
+        tomorrow = (timezone.now() + timedelta(days=1)).date().isoformat()
+        response = self.client.get('/api/store/exports/orders/', {'format': 'jsonl', 'since': tomorrow})
+        self.assertEqual(self.read(response), '')
+        self.assertEqual(self.client.get('/api/store/exports/orders/', {'since': 'soon'}).status_code, 400)
+
+    def test_rows_are_read_in_chunks(self):
+        category = self.product.category
+        for number in range(5):
+            Product.objects.create(name=f'Cap {number}', sku=f'CAP{number}', description='', price=10, category=category)
+        category_tree.get_tree()
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(exports.catalog_rows(chunk_size=2))
+        self.assertEqual(len(rows), 7)
+        # One products query and a variants query per chunk of 2 products,
+        # plus attributes for the one chunk that has variants
+        self.assertEqual(len(queries), 1 + 3 + 1)
+
+    def test_command_writes_a_file(self):
+        with tempfile.NamedTemporaryFile(suffix='.jsonl') as output:
+            call_command('export_data', 'orders', format='jsonl', output=output.name, stdout=io.StringIO())
+            with open(output.name, encoding='utf-8') as written:
+                self.assertEqual(json.loads(written.readline())['order_number'], Order.objects.get().order_number)
+
+
+class CheckoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user('buyer')
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', description='', price=20, stock=10, category=category)
+        self.cart = Cart.objects.create(user=self.user)
+
+    def add(self, product, quantity, variant=None):
+        CartItem.objects.create(cart=self.cart, product=product, variant=variant, quantity=quantity)
+
+    def test_places_the_order_and_takes_the_stock(self):
+        variant = ProductVariant.objects.create(product=self.product, sku='TEE-L', stock=3)
+        self.add(self.product, 2)
+        self.add(self.product, 1, variant)
+        response = self.client.post('/api/store/checkout/', ADDRESS, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_amount'], '60.00')
+        self.assertEqual(OrderItem.objects.filter(order__user=self.user).count(), 2)
+        self.product.refresh_from_db()
+        variant.refresh_from_db()
+        self.assertEqual((self.product.stock, variant.stock), (8, 2))
+        self.assertFalse(self.cart.items.exists())
+
+    def test_short_stock_writes_nothing(self):
+        self.add(self.product, 11)
+        response = self.client.post('/api/store/checkout/', ADDRESS, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['unavailable'][0]['available'], 10)
+        self.assertFalse(Order.objects.exists())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+        self.assertTrue(self.cart.items.exists())
+
+    def test_untracked_and_backordered_products(self):
+        category = self.product.category
+        untracked = Product.objects.create(
+            name='Gift card', description='', price=50, stock=0, track_inventory=False, category=category
+        )
+        backordered = Product.objects.create(
+            name='Cap', description='', price=10, stock=1, allow_backorders=True, category=category
+        )
+        self.add(untracked, 2)
+        self.add(backordered, 3)
+        response = self.client.post('/api/store/checkout/', ADDRESS, format='json')
+        self.assertEqual(response.status_code, 201)
+        untracked.refresh_from_db()
+        backordered.refresh_from_db()
+        self.assertEqual((untracked.stock, backordered.stock), (0, 0))
+
+    def test_empty_cart(self):
+        self.assertEqual(self.client.post('/api/store/checkout/', ADDRESS, format='json').status_code, 400)
+
+    def test_lines_changed_after_they_were_read_are_not_ordered(self):
+        self.add(self.product, 2)
+        read = checkout.stock_demand
+
+        def change_quantity(lines):
+            # A concurrent PUT landing between the read and the transaction
+            CartItem.objects.filter(cart=self.cart).update(quantity=5)
+            return read(lines)
+
+        with mock.patch.object(checkout, 'stock_demand', change_quantity):
+            with self.assertRaisesMessage(checkout.CheckoutError, 'The cart changed'):
+                checkout.place_order(self.cart, self.user, ADDRESS)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.items.get().quantity, 5)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 10)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    def test_last_units_are_sold_once(self):
+        category = Category.objects.create(name='Tees')
+        product = Product.objects.create(name='Tee', description='', price=20, stock=5, category=category)
+        carts = [make_cart(User.objects.create_user(f'buyer{i}'), product) for i in range(20)]
+
+        results = race_checkouts(carts)
+
+        self.assertEqual(results.count('ordered'), 5)
+        self.assertEqual(Order.objects.count(), 5)
+        product.refresh_from_db()
+        self.assertEqual(product.stock, 0)
+
+
+class InventoryHoldTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', description='', price=20, stock=3, category=category)
+        self.first, self.second = APIClient(), APIClient()
+        self.first.force_authenticate(User.objects.create_user('first'))
+        self.second.force_authenticate(User.objects.create_user('second'))
+
+    def add(self, client, quantity):
+        return client.post('/api/store/cart/', {'product_id': self.product.pk, 'quantity': quantity})
+
+    def available(self):
+        self.product.refresh_from_db()
+        return self.product.available_stock
+
+    def test_carts_cannot_hold_more_than_the_stock(self):
+        self.assertEqual(self.add(self.first, 2).status_code, 200)
+        self.assertEqual(self.available(), 1)
+        self.assertEqual(self.add(self.second, 2).status_code, 409)
+        self.assertFalse(CartItem.objects.filter(cart__user__username='second').exists())
+        self.assertEqual(self.add(self.second, 1).status_code, 200)
+        self.assertEqual(self.available(), 0)
+
+        listed = self.first.get('/api/store/products/').data['results'][0]
+        self.assertEqual((listed['stock'], listed['available_stock']), (3, 0))
+
+    def test_changing_or_removing_a_line_gives_units_back(self):
+        self.add(self.first, 3)
+        item = CartItem.objects.get()
+        self.assertEqual(self.first.put(f'/api/store/cart/items/{item.pk}/', {'quantity': 1}).status_code, 200)
+        self.assertEqual(self.available(), 2)
+        self.first.delete(f'/api/store/cart/items/{item.pk}/')
+        self.assertEqual(self.available(), 3)
+        self.assertFalse(InventoryHold.objects.exists())
+
+    def test_a_line_removed_during_a_change_keeps_no_hold(self):
+        self.add(self.first, 1)
+        item = CartItem.objects.get()
+        set_quantity = carts.set_quantity
+
+        def removed_meanwhile(line, quantity):
+            CartItem.objects.filter(pk=line.pk).delete()
+            return set_quantity(line, quantity)
+
+        with mock.patch.object(carts, 'set_quantity', removed_meanwhile):
+            response = self.first.put(f'/api/store/cart/items/{item.pk}/', {'quantity': 3})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(InventoryHold.objects.get().quantity, 1)
+        self.assertEqual(self.available(), 2)
+
+    def test_one_hold_per_product_without_variant(self):
+        cart = Cart.objects.create(user=User.objects.get(username='first'))
+        expires_at = timezone.now() + timedelta(minutes=5)
+        InventoryHold.objects.create(cart=cart, product=self.product, quantity=1, expires_at=expires_at)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            InventoryHold.objects.create(cart=cart, product=self.product, quantity=1, expires_at=expires_at)
+
+    def test_expired_holds_are_reclaimed(self):
+        self.add(self.first, 3)
+        InventoryHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        # A cart short of units reclaims the expired holds of that SKU
+        self.assertEqual(self.add(self.second, 2).status_code, 200)
+        self.assertEqual(self.available(), 1)
+
+        InventoryHold.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        stdout = io.StringIO()
+        call_command('sweep_inventory_holds', batch_size=1, stdout=stdout)
+        self.assertIn('Released 1 expired holds', stdout.getvalue())
+        self.assertEqual(self.available(), 3)
+
+    def test_checkout_turns_the_hold_into_the_decrement(self):
+        self.add(self.first, 2)
+        user = User.objects.get(username='first')
+        checkout.place_order(Cart.objects.get(user=user), user, ADDRESS)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (1, 0))
+        self.assertFalse(InventoryHold.objects.exists())
+
+    def test_reconcile_repairs_reserved(self):
+        self.add(self.first, 2)
+        Product.objects.filter(pk=self.product.pk).update(reserved=0)
+        self.assertEqual(inventory.reconcile(), 1)
+        self.assertEqual(self.available(), 1)
+
+
+class CouponRedemptionTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', description='', price=20, category=category, stock=100)
+        self.user = User.objects.create_user('buyer')
+
+    def test_limit_is_split_across_shards(self):
+        coupon = make_coupon(usage_limit=40)
+        self.assertEqual(CouponShard.objects.filter(coupon=coupon).count(), coupons.SHARDS)
+        self.assertEqual(coupons.remaining(coupon), 40)
+
+    def test_per_user_limit(self):
+        coupon = make_coupon(usage_limit_per_user=1)
+        checkout.place_order(make_cart(self.user, self.product), self.user, ADDRESS, coupon_code='sale')
+        with self.assertRaisesMessage(checkout.CheckoutError, 'already used'):
+            checkout.place_order(make_cart(self.user, self.product), self.user, ADDRESS, coupon_code='sale')
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_reconcile_counts_each_redemption_once(self):
+        coupon = make_coupon(usage_limit=10)
+        for _ in range(3):
+            checkout.place_order(make_cart(self.user, self.product), self.user, ADDRESS, coupon_code='sale')
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 0)
+        self.assertEqual(coupons.used(coupon), 3)
+
+        self.assertEqual(coupons.reconcile(batch_size=2), 3)
+        self.assertEqual(coupons.reconcile(), 0)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, 3)
+        self.assertEqual(coupons.used(coupon), 3)
+
+        # Raising the limit later only adds the difference
+        coupon.usage_limit = 5
+        coupon.save()
+        self.assertEqual(coupons.remaining(coupon), 2)
+
+
+class ConcurrentRedemptionTests(TransactionTestCase):
+    """Many checkouts racing for the last uses of a coupon"""
+
+    buyers = 30
+    limit = 10
+
+    def setUp(self):
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', description='', price=20, category=category, stock=1000)
+
+    def test_no_over_redemption(self):
+        coupon = make_coupon(usage_limit=self.limit, usage_limit_per_user=1)
+        carts = [make_cart(User.objects.create_user(f'buyer{i}'), self.product) for i in range(self.buyers)]
+
+        results = race_checkouts(carts, coupon_code='sale')
+
+        self.assertEqual(results.count('ordered'), self.limit)
+        self.assertEqual(CouponRedemption.objects.filter(coupon=coupon).count(), self.limit)
+        self.assertEqual(coupons.remaining(coupon), 0)
+        coupons.reconcile()
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used_count, self.limit)
+
+    def test_user_racing_their_own_carts_redeems_once(self):
+        coupon = make_coupon(usage_limit=self.limit, usage_limit_per_user=1)
+        user = User.objects.create_user('buyer')
+        carts = [make_cart(user, self.product) for _ in range(5)]
+
+        results = race_checkouts(carts, coupon_code='sale')
+
+        self.assertEqual(results.count('ordered'), 1)
+        self.assertEqual(CouponRedemption.objects.filter(user=user).count(), 1)
+        self.assertEqual(coupons.remaining(coupon), self.limit - 1)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CartMergeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Tees')
+        self.products = [
+            Product.objects.create(name=f'Tee {number}', description='', price=10, stock=50, category=category)
+            for number in range(10)
+        ]
+        self.user = User.objects.create_user('buyer', password='secret')
+        self.client = APIClient()
+
+    def test_login_merges_the_session_cart(self):
+        user_cart = make_cart(self.user, self.products[0])
+        self.client.post('/api/store/cart/', {'product_id': self.products[0].pk, 'quantity': 2})
+        self.client.post('/api/store/cart/', {'product_id': self.products[1].pk, 'quantity': 1})
+        session_cart = Cart.objects.get(user__isnull=True)
+
+        response = self.client.post('/api/store/auth/login/', {'username': 'buyer', 'password': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Cart.objects.filter(pk=session_cart.pk).exists())
+        lines = dict(user_cart.items.values_list('product_id', 'quantity'))
+        self.assertEqual(lines, {self.products[0].pk: 3, self.products[1].pk: 1})
+        user_cart.refresh_from_db()
+        self.assertEqual((user_cart.total_items, user_cart.total_amount), (4, 40))
+        self.assertEqual(InventoryHold.objects.get(product=self.products[1]).cart_id, user_cart.pk)
+
+    def test_registering_keeps_the_session_cart(self):
+        self.client.post('/api/store/cart/', {'product_id': self.products[0].pk, 'quantity': 2})
+        response = self.client.post(
+            '/api/store/auth/register/', {'username': 'new', 'email': 'new@example.com', 'password': 'secret'}
+        )
+        self.assertEqual(response.status_code, 201)
+        cart = Cart.objects.get()
+        self.assertEqual((cart.user.username, cart.session_key), ('new', None))
+
+    def test_merge_takes_the_same_queries_for_any_size(self):
+        def merge_queries(size):
+            target = make_cart(self.user, self.products[0])
+            source = Cart.objects.create(session_key=f'session{size}')
+            for product in self.products[:size]:
+                CartItem.objects.create(cart=source, product=product, quantity=1)
+            with CaptureQueriesContext(connection) as queries:
+                carts.merge(source, target)
+            target.delete()
+            return len(queries)
+
+        self.assertEqual(merge_queries(2), merge_queries(10))
+
+
+class WishlistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Tees')
+        self.products = [
+            Product.objects.create(name=f'Tee {number}', description='', price=10, category=category)
+            for number in range(5)
+        ]
+        self.user = User.objects.create_user('buyer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def toggle(self, product_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/store/wishlist/?response=delta', {'product_id': product_id})
+
+    def test_toggle_returns_the_delta(self):
+        product_id = self.products[0].pk
+        self.assertEqual(
+            self.toggle(product_id).data,
+            {'message': 'Product added to wishlist', 'product_id': product_id, 'is_wishlisted': True, 'product_count': 1}
+        )
+        response = self.toggle(product_id)
+        self.assertEqual((response.data['is_wishlisted'], response.data['product_count']), (False, 0))
+        self.assertEqual(self.toggle(0).status_code, 404)
+
+    def test_listings_mark_wishlisted_products_per_user(self):
+        self.toggle(self.products[1].pk)
+        with CaptureQueriesContext(connection) as queries:
+            rows = self.client.get('/api/store/products/').data['results']
+        self.assertEqual(
+            {row['id'] for row in rows if row['is_wishlisted']}, {self.products[1].pk}
+        )
+        membership = [query for query in queries.captured_queries if 'store_wishlist_products' in query['sql']]
+        self.assertEqual(len(membership), 1)
+
+        # The shared cached copy isn't marked for anyone else
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user('other'))
+        self.assertFalse(any(row['is_wishlisted'] for row in other.get('/api/store/products/').data['results']))
+        detail = self.client.get(f'/api/store/products/{self.products[1].slug}/')
+        self.assertTrue(detail.data['is_wishlisted'])
+
+    def test_toggling_changes_the_users_etag(self):
+        etag = self.client.get('/api/store/products/')['ETag']
+        self.toggle(self.products[0].pk)
+        response = self.client.get('/api/store/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private')
+
+
+class BulkProductFetchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        category = Category.objects.create(name='Tees')
+        self.products = [
+            Product.objects.create(name=f'Tee {number}', slug=f'tee-{number}', description='', price=10, category=category)
+            for number in range(6)
+        ]
+
+    def ids(self, *products):
+        return ','.join(str(product.pk) for product in products)
+
+    def test_returns_the_requested_order_and_the_missing(self):
+        first, second, third = self.products[:3]
+        response = self.client.get('/api/store/products/', {'ids': f'{third.pk},{first.pk},0,{third.pk}'})
+        self.assertEqual([row['id'] for row in response.data['results']], [third.pk, first.pk])
+        self.assertEqual((response.data['count'], response.data['missing']), (2, [0]))
+
+        response = self.client.get('/api/store/products/', {'slugs': 'tee-1,nope,tee-0'})
+        self.assertEqual([row['slug'] for row in response.data['results']], ['tee-1', 'tee-0'])
+        self.assertEqual(response.data['missing'], ['nope'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/api/store/products/', {'ids': '1,x'}).status_code, 400)
+        too_many = ','.join(str(number) for number in range(1, 102))
+        self.assertEqual(self.client.get('/api/store/products/', {'ids': too_many}).status_code, 400)
+
+    def test_queries_do_not_grow_with_the_request(self):
+        def queries_for(products):
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get('/api/store/products/', {'ids': self.ids(*products)})
+            return len(queries)
+
+        self.assertEqual(queries_for(self.products[:2]), queries_for(self.products))
+
+    def test_cached_per_requested_product(self):
+        params = {'ids': self.ids(*self.products[:2])}
+        self.assertEqual(self.client.get('/api/store/products/', params)['X-Cache'], 'MISS')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[5].price = 12
+            self.products[5].save()
+        self.assertEqual(self.client.get('/api/store/products/', params)['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[1].price = 12
+            self.products[1].save()
+        response = self.client.get('/api/store/products/', params)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][1]['price'], '12.00')
+
+
+class CartTotalsTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', description='', price=20, category=category, stock=100)
+        self.user = User.objects.create_user('buyer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_totals_follow_every_change(self):
+        response = self.client.post('/api/store/cart/?response=delta', {'product_id': self.product.pk, 'quantity': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['cart']['total_items'], 2)
+        self.assertEqual(response.data['cart']['total_amount_display'], 'R$ 40.00')
+        item_id = response.data['item_id']
+
+        response = self.client.put(f'/api/store/cart/items/{item_id}/?response=delta', {'quantity': 5})
+        self.assertEqual(response.data['item']['quantity'], 5)
+        self.assertEqual(response.data['cart']['total_items'], 5)
+
+        response = self.client.delete(f'/api/store/cart/items/{item_id}/?response=delta')
+        self.assertIsNone(response.data['item'])
+        cart = Cart.objects.get(user=self.user)
+        self.assertEqual((cart.total_items, cart.total_amount), (0, 0))
+
+    def test_invalid_quantities_are_rejected(self):
+        for quantity in (-3, 0, 'abc', '1.5', ''):
+            with self.subTest(quantity=quantity):
+                response = self.client.post('/api/store/cart/', {'product_id': self.product.pk, 'quantity': quantity})
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartItem.objects.exists())
+
+        item_id = self.client.post('/api/store/cart/?response=delta', {'product_id': self.product.pk}).data['item_id']
+        for quantity in (-3, 0, 'abc'):
+            with self.subTest(quantity=quantity):
+                response = self.client.put(f'/api/store/cart/items/{item_id}/', {'quantity': quantity})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(CartItem.objects.get().quantity, 1)
+
+    def test_constraint_errors_are_not_mistaken_for_races(self):
+        cart = Cart.objects.create(user=self.user)
+        with self.assertRaises(IntegrityError):
+            carts.add_item(cart, self.product, None, -3)
+
+    def test_one_line_per_product_without_variant(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+
+
+class CatalogImportTests(TestCase):
+    def setUp(self):
+        Category.objects.create(name='Tees', slug='tees')
+
+    def test_slugs_are_unique_within_a_batch_and_the_table(self):
+        self.assertEqual(catalog_import.allocate_slugs(Product, ['tee', 'tee', 'tee-2']), ['tee', 'tee-3', 'tee-2'])
+        self.assertEqual(catalog_import.allocate_slugs(Category, ['tees', 'tees']), ['tees-2', 'tees-3'])
+
+    def test_rows_are_upserted_by_sku(self):
+        rows = [
+            {'sku': 'TEE-1', 'name': 'Tee', 'price': '10', 'category': 'Tees', 'variant_sku': 'TEE-1-M', 'attributes': 'Size=M'},
+            {'sku': 'TEE-1', 'variant_sku': 'TEE-1-L', 'attributes': 'Size=L'},
+            {'sku': 'TEE-2', 'name': 'Tee', 'price': '12', 'category': 'Tees'},
+        ]
+        stats = catalog_import.CatalogImporter(batch_size=2).run(enumerate(rows, start=2))
+        self.assertEqual((stats['products_created'], stats['variants_created'], stats['errors']), (2, 2, 0))
+        self.assertEqual(sorted(Product.objects.values_list('slug', flat=True)), ['tee', 'tee-2'])
+        self.assertEqual(str(ProductVariant.objects.get(sku='TEE-1-L').attributes.get()), 'Size: L')
+
+        stats = catalog_import.CatalogImporter().run([(2, {'sku': 'TEE-2', 'price': '15'})])
+        self.assertEqual(stats['products_updated'], 1)
+        self.assertEqual(Product.objects.get(sku='TEE-2').price, 15)
+
+    def test_only_the_first_errors_are_kept(self):
+        importer = catalog_import.CatalogImporter(max_errors=3)
+        stats = importer.run((line, {'sku': f'BAD-{line}', 'price': 'x'}) for line in range(10))
+        self.assertEqual(stats['errors'], 10)
+        self.assertEqual([line for line, _ in importer.errors], [0, 1, 2])
+
+
+class CoalescedSessionTests(TestCase):
+    def writes(self):
+        return sessions.stats()['writes']
+
+    def test_unchanged_sessions_are_not_rewritten(self):
+        session = sessions.CachedDBSessionStore()
+        session['cart'] = 1
+        session.save()
+        before = self.writes()
+
+        loaded = sessions.CachedDBSessionStore(session.session_key)
+        self.assertEqual(loaded['cart'], 1)
+        loaded.save()
+        self.assertEqual(self.writes(), before)
+
+        loaded['cart'] = 2
+        loaded.save()
+        self.assertEqual(self.writes(), before + 1)
+        self.assertEqual(sessions.CachedDBSessionStore(session.session_key)['cart'], 2)
+
+    @override_settings(STORE_SESSION_REFRESH_SECONDS=0)
+    def test_stale_sessions_are_refreshed(self):
+        session = sessions.CacheSessionStore()
+        session['cart'] = 1
+        session.save()
+        before = self.writes()
+        sessions.CacheSessionStore(session.session_key).save()
+        self.assertEqual(self.writes(), before + 1)
+
+    def test_clear_expired_deletes_expired_rows(self):
+        session = sessions.CachedDBSessionStore()
+        session['cart'] = 1
+        session.save()
+        Session = sessions.CachedDBSessionStore.get_model_class()
+        Session.objects.filter(pk=session.session_key).update(expire_date=timezone.now() - timedelta(days=1))
+        self.assertEqual(sessions.CachedDBSessionStore.clear_expired(batch_size=1), 1)
+        self.assertFalse(Session.objects.exists())
+
+
+@override_settings(STORE_ANONYMOUS_CART_STORAGE='cookie')
+class AnonymousCartTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Tees')
+        self.products = [
+            Product.objects.create(name=f'Tee {i}', description='', price=20, category=category, stock=10)
+            for i in range(3)
+        ]
+        self.client = APIClient()
+
+    def test_cookie_cart_costs_no_rows(self):
+        for product in self.products:
+            response = self.client.post('/api/store/cart/', {'product_id': product.pk, 'quantity': 2})
+            self.assertEqual(response.status_code, 200)
+        self.assertIn(anonymous_carts.COOKIE_NAME, response.cookies)
+        self.assertEqual(response.data['cart']['total_items'], 6)
+        self.assertFalse(Cart.objects.exists())
+
+        response = self.client.put('/api/store/cart/items/1/', {'quantity': 5})
+        self.assertEqual(response.data['cart']['total_items'], 9)
+        for quantity in (0, -1, 'abc'):
+            with self.subTest(quantity=quantity):
+                self.assertEqual(self.client.put('/api/store/cart/items/1/', {'quantity': quantity}).status_code, 400)
+                self.assertEqual(
+                    self.client.post('/api/store/cart/', {'product_id': self.products[0].pk, 'quantity': quantity}).status_code,
+                    400
+                )
+
+    def test_quantities_are_validated(self):
+        cart = anonymous_carts.AnonymousCart([[1, self.products[0].pk, None, 0], [2, self.products[1].pk, None, 1]])
+        self.assertEqual([line[0] for line in cart.lines], [2])
+        for quantity in (0, -2, 1.5, True):
+            with self.subTest(quantity=quantity), self.assertRaises(ValueError):
+                cart.add(self.products[0].pk, None, quantity)
+            with self.subTest(quantity=quantity), self.assertRaises(ValueError):
+                cart.update(2, quantity)
+
+    def test_login_materializes_and_holds_in_bulk(self):
+        user = User.objects.create_user('buyer', password='pw')
+        stored = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=stored, product=self.products[0], quantity=1)
+        for product in self.products:
+            self.client.post('/api/store/cart/', {'product_id': product.pk, 'quantity': 2})
+
+        response = self.client.post('/api/store/auth/login/', {'username': 'buyer', 'password': 'pw'})
+        self.assertEqual(response.status_code, 200)
+        stored.refresh_from_db()
+        self.assertEqual(stored.total_items, 7)
+        self.assertEqual(
+            sorted(stored.items.values_list('product_id', 'quantity')),
+            [(self.products[0].pk, 3), (self.products[1].pk, 2), (self.products[2].pk, 2)]
+        )
+        self.assertEqual(InventoryHold.objects.filter(cart=stored).count(), 3)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).reserved, 3)
+        self.assertEqual(response.cookies[anonymous_carts.COOKIE_NAME].value, '')
+
+
+class PurgeTests(TransactionTestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Tee', description='', price=20, category=category, stock=100)
+
+    def make_cart(self, days_idle, user=None):
+        cart = Cart.objects.create(user=user, session_key=None if user else f'session-{Cart.objects.count()}')
+        CartItem.objects.create(cart=cart, product=self.product, quantity=1)
+        Cart.objects.filter(pk=cart.pk).update(updated_at=timezone.now() - timedelta(days=days_idle))
+        return cart
+
+    def test_only_idle_anonymous_carts_are_deleted(self):
+        idle = [self.make_cart(10) for _ in range(5)]
+        recent = self.make_cart(1)
+        owned = self.make_cart(10, user=User.objects.create_user('buyer'))
+
+        result = purge.purge_carts(max_age=timedelta(days=7), batch_size=2)
+        self.assertEqual((result.carts, result.cart_items, result.batches), (5, 5, 3))
+        self.assertFalse(Cart.objects.filter(pk__in=[cart.pk for cart in idle]).exists())
+        self.assertEqual(set(Cart.objects.values_list('pk', flat=True)), {recent.pk, owned.pk})
+
+    def test_batches_commit_before_they_are_yielded(self):
+        for _ in range(3):
+            self.make_cart(10)
+        batches = purge.delete_in_batches(
+            Cart.objects.order_by('pk'), lambda batch: Cart.objects.filter(pk__in=batch).delete()[0], batch_size=2
+        )
+        self.assertEqual(next(batches), 4)
+        self.assertFalse(connection.in_atomic_block)
+        # Abandoning the loop keeps what was already deleted
+        batches.close()
+        self.assertEqual(Cart.objects.count(), 1)
+
+
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(
+            name='Tee', slug='tee', description='', price=20, category=category, stock=100, status='active'
+        )
+        self.client = APIClient()
+
+    def test_product_changes_invalidate_listings(self):
+        self.assertEqual(self.client.get('/api/store/products/')['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/api/store/products/')['X-Cache'], 'HIT')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 25
+            self.product.save()
+        response = self.client.get('/api/store/products/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['results'][0]['price_display'], 'R$ 25.00')
+
+    def test_conditional_get_answers_304(self):
+        etag = self.client.get('/api/store/products/tee/')['ETag']
+        self.assertEqual(self.client.get('/api/store/products/tee/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_renamed_slug_stops_resolving(self):
+        self.assertEqual(self.client.get('/api/store/products/tee/').status_code, 200)
+        self.assertEqual(response_cache.product_id_for_slug('tee'), self.product.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.slug = 'basic-tee'
+            self.product.save()
+        self.assertIsNone(response_cache.product_id_for_slug('tee'))
+        self.assertEqual(self.client.get('/api/store/products/tee/').status_code, 404)
+        self.assertEqual(self.client.get('/api/store/products/basic-tee/').status_code, 200)
+
+    def test_deploy_check_requires_a_shared_cache(self):
+        self.assertEqual([error.id for error in checks.check_shared_cache(None)], ['store.E001'])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://cache'}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+
+class CategoryTreeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.apparel = Category.objects.create(name='Apparel')
+        self.tees = Category.objects.create(name='Tees', parent=self.apparel)
+
+    def test_descendants_and_paths(self):
+        tree = category_tree.get_tree()
+        self.assertEqual(tree.descendant_ids(self.apparel.slug), {self.apparel.pk, self.tees.pk})
+        self.assertEqual(tree.path(self.tees.pk), ['Apparel', 'Tees'])
+        self.assertIs(category_tree.get_tree(), tree)
+
+    def test_other_processes_rebuild_when_the_version_moves(self):
+        tree = category_tree.get_tree()
+        # Another process saved a category
+        with self.captureOnCommitCallbacks(execute=False):
+            Category.objects.create(name='Hats', parent=self.apparel)
+        cache.set(category_tree.VERSION_KEY, time.time_ns(), timeout=None)
+        rebuilt = category_tree.get_tree()
+        self.assertIsNot(rebuilt, tree)
+        self.assertEqual(len(rebuilt.children(self.apparel.pk)), 2)
+
+    def test_lost_version_never_matches_an_old_tree(self):
+        tree = category_tree.get_tree()
+        cache.delete(category_tree.VERSION_KEY)
+        self.assertIsNot(category_tree.get_tree(), tree)
+
+
+class SuggestTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        suggest._index = None
+        category = Category.objects.create(name='Apparel')
+        self.product = Product.objects.create(
+            name='Basic Tee', description='', price=20, category=category, status='active'
+        )
+
+    def labels(self, prefix):
+        return [entry['label'] for entry in suggest.suggest(prefix)]
+
+    def test_prefixes_match_every_word(self):
+        self.assertEqual(self.labels('bas'), ['Basic Tee'])
+        self.assertEqual(self.labels('tee'), ['Basic Tee'])
+        self.assertEqual(self.labels('app'), ['Apparel'])
+
+    def test_changes_are_replayed(self):
+        index = suggest.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = 'Organic Tee'
+            self.product.save()
+        # Caught up by replaying the change, not by rebuilding
+        with mock.patch.object(suggest, 'build_index', side_effect=AssertionError):
+            self.assertEqual(self.labels('org'), ['Organic Tee'])
+        self.assertEqual(self.labels('bas'), [])
+        # The replay went into a copy; a lookup still holding the old index
+        # sees it unchanged
+        self.assertIsNot(suggest.get_index(), index)
+        self.assertEqual([entry['label'] for entry in index.lookup('bas', 8)], ['Basic Tee'])
+        self.assertEqual(index.lookup('org', 8), [])
+
+    def test_lost_version_rebuilds(self):
+        index = suggest.get_index()
+        cache.delete(suggest.VERSION_KEY)
+        self.assertIsNot(suggest.get_index(), index)
+
+
+class BatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(
+            name='Tee', slug='tee', description='', price=20, category=category, stock=10, status='active'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('buyer'))
+
+    def batch(self, requests, **extra):
+        return self.client.post('/api/store/batch/', {'requests': requests}, format='json', **extra)
+
+    def test_sub_requests_run_in_order(self):
+        response = self.batch([
+            {'id': 'add', 'method': 'POST', 'path': 'cart/?response=delta', 'body': {'product_id': self.product.pk}},
+            {'id': 'cart', 'path': 'cart/'},
+            {'id': 'export', 'path': 'exports/orders/'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        add, cart, export = response.data['responses']
+        self.assertEqual((add['id'], add['status']), ('add', 200))
+        self.assertEqual(cart['body']['total_items'], 1)
+        self.assertEqual(export['status'], 404)
+
+    def test_conditional_headers_belong_to_each_sub_request(self):
+        etag = self.client.get('/api/store/products/tee/')['ETag']
+        response = self.batch(
+            [{'path': 'products/tee/'}, {'path': 'products/tee/', 'headers': {'If-None-Match': etag}}],
+            HTTP_IF_NONE_MATCH=etag,
+        )
+        plain, conditional = response.data['responses']
+        self.assertEqual(plain['status'], 200)
+        self.assertEqual(plain['body']['slug'], 'tee')
+        self.assertEqual(conditional['status'], 304)
+
+    @override_settings(STORE_ANONYMOUS_CART_STORAGE='cookie')
+    def test_later_sub_requests_see_cookies_set_by_earlier_ones(self):
+        # The anonymous cart lives in the cookie the POST sets
+        response = APIClient().post('/api/store/batch/', {'requests': [
+            {'id': 'add', 'method': 'POST', 'path': 'cart/', 'body': {'product_id': self.product.pk, 'quantity': 2}},
+            {'id': 'cart', 'path': 'cart/'},
+        ]}, format='json')
+        add, cart = response.data['responses']
+        self.assertEqual(add['status'], 200)
+        self.assertEqual(cart['body']['total_items'], 2)
+        self.assertIn(anonymous_carts.COOKIE_NAME, response.cookies)
+
+    def test_malformed_batches_are_rejected(self):
+        for requests in ([], [{'method': 'GET'}], [{'path': 'cart/', 'headers': {'X': 1}}]):
+            with self.subTest(requests=requests):
+                self.assertEqual(self.batch(requests).status_code, 400)
+
+
+class OrderSnapshotTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Tees')
+        self.product = Product.objects.create(name='Basic Tee', description='', price=20, category=category, stock=100)
+        size = ProductAttribute.objects.create(name='Size')
+        self.variant = ProductVariant.objects.create(product=self.product, price=25, stock=10)
+        self.variant.attributes.add(ProductAttributeValue.objects.create(attribute=size, value='L'))
+        self.user = User.objects.create_user('buyer')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def order(self):
+        cart = make_cart(self.user, self.product)
+        CartItem.objects.create(cart=cart, product=self.product, variant=self.variant, quantity=2)
+        return checkout.place_order(cart, self.user, ADDRESS)
+
+    def test_checkout_snapshots_each_line(self):
+        lines = list(self.order().items.order_by('pk').values_list('product_name', 'product_sku', 'variant_label'))
+        self.assertEqual(lines, [('Basic Tee', self.product.sku, ''), ('Basic Tee', self.variant.sku, 'Size: L')])
+        self.product.name = 'Renamed Tee'
+        self.product.save()
+        response = self.client.get('/api/store/orders/?view=summary')
+        self.assertEqual(response.data['results'][0]['items'][0]['product_name'], 'Basic Tee')
+
+    def test_summary_takes_the_same_queries_for_any_number_of_orders(self):
+        counts = []
+        for orders in (1, 4):
+            while Order.objects.count() < orders:
+                self.order()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/api/store/orders/?view=summary')
+            self.assertEqual(len(response.data['results']), orders)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_backfill_fills_missing_snapshots(self):
+        self.order()
+        OrderItem.objects.update(product_name='', product_sku='', variant_label='')
+        call_command('backfill_order_snapshots', batch_size=1, stdout=io.StringIO())
+        self.assertEqual(
+            sorted(OrderItem.objects.values_list('product_name', 'variant_label')),
+            [('Basic Tee', ''), ('Basic Tee', 'Size: L')]
+        )
+        self.assertEqual(order_snapshots.backfill(), 0)
+
+
+class FastSerializerTests(TestCase):
+    def test_benchmark_matches_the_serializer_on_every_run(self):
+        for _ in range(2):
+            stdout, stderr = io.StringIO(), io.StringIO()
+            call_command('benchmark_serializers', page_size=5, rounds=1, repeat=1, stdout=stdout, stderr=stderr)
+            self.assertEqual(stderr.getvalue(), '')
+            self.assertIn('less CPU', stdout.getvalue())
+        self.assertFalse(Category.objects.exists())
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        category = Category.objects.create(name='Shirts')
+        self.tee = Product.objects.create(name='Red Tee', description='', price=20, category=category)
+        self.hoodie = Product.objects.create(
+            name='Hoodie', description='Warm enough to wear over a red tee', price=50, category=category
+        )
+        Product.objects.create(name='Blue Cap', description='', price=10, category=category)
+
+    def test_matches_are_ranked_by_where_the_terms_appear(self):
+        results = list(search.search_products(Product.objects.all(), 'red te'))
+        self.assertEqual(results, [self.tee, self.hoodie])
+        self.assertLess(results[0].search_rank, results[1].search_rank)
+        self.assertIn(f'{search.HIGHLIGHT_START}Red{search.HIGHLIGHT_END}', results[0].search_snippet)
+
+    def test_results_can_be_chained(self):
+        results = search.search_products(Product.objects.filter(price__lt=30), 'red')
+        self.assertEqual(list(results.values_list('name', flat=True)), ['Red Tee'])
+        self.assertEqual(results.count(), 1)
+        self.assertEqual(results.exclude(pk=self.tee.pk).count(), 0)
+        either = results | Product.objects.filter(name='Blue Cap')
+        self.assertEqual(sorted(either.values_list('name', flat=True)), ['Blue Cap', 'Red Tee'])
+
+    def test_view_returns_highlighted_results_and_facets(self):
+        response = self.client.get('/api/store/search/', {'q': 'red', 'facets': 'true'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['name'] for row in response.data['results']], ['Red Tee', 'Hoodie'])
+        self.assertIn('<mark>Red</mark>', response.data['results'][0]['snippet'])
+        self.assertEqual(response.data['facets']['categories'][0]['count'], 2)
+        self.assertEqual(self.client.get('/api/store/search/').status_code, 400)
@@ -0,0 +1,67 @@
+"""
+Wishlist membership without loading wishlists.
+
+Membership is one row of the products through table, which is unique on
+(wishlist, product). Marking a page of products is one query for the ids
+on that page. A toggle is one EXISTS on the unique index, then an insert or
+a delete.
+
+Catalog responses are cached for everyone, so is_wishlisted is added to
+them per request, after the shared copy is read (see
+CachedResponseMixin.personalize). Changing a user's wishlist moves its
+response cache tag so their ETags stop matching.
+"""
+from django.db import IntegrityError, transaction
+
+from . import response_cache
+from .models import Wishlist
+
+Membership = Wishlist.products.through
+
+
+def wishlisted_ids(user, product_ids):
+    """The ids among product_ids that are on the user's wishlist"""
+    if not user.is_authenticated or not product_ids:
+        return set()
+    return set(Membership.objects.filter(
+        wishlist__user=user, product_id__in=product_ids
+    ).values_list('product_id', flat=True))
+
+
+def mark(user, products):
+    """Copies of serialized products with is_wishlisted set, in one query"""
+    ids = wishlisted_ids(user, [product['id'] for product in products if 'id' in product])
+    return [{**product, 'is_wishlisted': product.get('id') in ids} for product in products]
+
+
+def count(wishlist_id):
+    return Membership.objects.filter(wishlist_id=wishlist_id).count()
+
+
+def toggle(user, product_id, can_add=None):
+    """
+    Add the product to the user's wishlist, or remove it if it is already
+    there. can_add() is only called before adding. Returns (whether the
+    product is now wishlisted, wishlist id); the first is None when can_add()
+    refused.
+    """
+    wishlist_id = Wishlist.objects.filter(user=user).values_list('pk', flat=True).first()
+    if wishlist_id is None:
+        wishlist_id = Wishlist.objects.get_or_create(user=user)[0].pk
+
+    membership = Membership.objects.filter(wishlist_id=wishlist_id, product_id=product_id)
+    if membership.exists():
+        membership.delete()
+        added = False
+    elif can_add is not None and not can_add():
+        return None, wishlist_id
+    else:
+        try:
+            with transaction.atomic():
+                Membership.objects.create(wishlist_id=wishlist_id, product_id=product_id)
+        except IntegrityError:
+            # Added by a concurrent request
+            pass
+        added = True
+    transaction.on_commit(lambda: response_cache.invalidate(response_cache.wishlist_tag(user.pk)))
+    return added, wishlist_id